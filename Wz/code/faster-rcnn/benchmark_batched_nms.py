@@ -0,0 +1,100 @@
+"""
+该脚本用于比较batched_nms中偏移量方法与逐类别nms在不同boxes数量、类别数下的速度，
+打印两者的交叉点(哪种方法更快)以及batched_nms自动选择的方法，可据此调整boxes.py中的阈值
+python benchmark_batched_nms.py --device cpu --num-boxes 500 1000 2000 4000 8000 16000 --num-classes 1 5 20 80 500
+"""
+
+import time
+import argparse
+
+import torch
+
+from network_files import boxes as box_ops
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def random_inputs(num_boxes, num_classes, device, image_size=(800, 1344)):
+    height, width = image_size
+    ctr = torch.rand(num_boxes, 2, device=device) * torch.tensor([width, height], device=device)
+    wh = torch.rand(num_boxes, 2, device=device) * 200 + 8
+    boxes = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1)
+    scores = torch.rand(num_boxes, device=device)
+    idxs = torch.randint(0, num_classes, (num_boxes,), device=device)
+    return boxes, scores, idxs
+
+
+def auto_strategy(boxes, idxs):
+    """与boxes.batched_nms中的判断条件相同"""
+    loop_numel = box_ops._BATCHED_NMS_LOOP_NUMEL["cpu" if boxes.device.type == "cpu" else "cuda"]
+    if boxes.numel() > loop_numel:
+        if boxes.shape[0] >= torch.unique(idxs).numel() * box_ops._BATCHED_NMS_MIN_BOXES_PER_CLASS:
+            return "loop"
+    return "offset"
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+    print("torchvision nms op available: {}".format(box_ops._USE_TORCHVISION_NMS))
+
+    torch.manual_seed(0)
+    header = "{:>10} | {:>8} | {:>11} | {:>9} | {:>7} | {:>6} | {}".format(
+        "num_boxes", "classes", "offset(ms)", "loop(ms)", "faster", "auto", "same")
+    if args.vectorized:
+        header += " | vectorized(ms)"
+    print(header)
+    with torch.no_grad():
+        for num_boxes in args.num_boxes:
+            for num_classes in args.num_classes:
+                boxes, scores, idxs = random_inputs(num_boxes, num_classes, device)
+                classes = torch.unique(idxs)
+
+                keep_offset = box_ops._batched_nms_coordinate_trick(boxes, scores, idxs, args.iou_thresh)
+                keep_loop = box_ops._batched_nms_per_class(boxes, scores, idxs, classes, args.iou_thresh)
+                same = torch.equal(keep_offset.sort()[0], keep_loop.sort()[0])
+
+                t_offset = benchmark(lambda: box_ops._batched_nms_coordinate_trick(boxes, scores, idxs,
+                                                                                   args.iou_thresh), args.repeats)
+                t_loop = benchmark(lambda: box_ops._batched_nms_per_class(boxes, scores, idxs, classes,
+                                                                          args.iou_thresh), args.repeats)
+                line = "{:>10} | {:>8} | {:>11.2f} | {:>9.2f} | {:>7} | {:>6} | {}".format(
+                    num_boxes, num_classes, t_offset * 1000, t_loop * 1000,
+                    "offset" if t_offset <= t_loop else "loop", auto_strategy(boxes, idxs), same)
+                if args.vectorized:
+                    # 纯PyTorch实现的nms需要N x N的iou矩阵, 只测试偏移量方法下的一次nms
+                    offsets = idxs.to(boxes) * (boxes.max() + 1)
+                    boxes_for_nms = boxes + offsets[:, None]
+                    t_vec = benchmark(lambda: box_ops._nms_vectorized(boxes_for_nms, scores, args.iou_thresh),
+                                      args.repeats)
+                    line += " | {:>14.2f}".format(t_vec * 1000)
+                print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--num-boxes', default=[500, 1000, 2000, 4000, 8000, 16000], type=int, nargs='+',
+                        help='number of boxes to test')
+    parser.add_argument('--num-classes', default=[1, 5, 20, 80, 500], type=int, nargs='+',
+                        help='number of classes to test')
+    parser.add_argument('--iou-thresh', default=0.5, type=float, help='nms iou threshold')
+    parser.add_argument('--repeats', default=10, type=int, help='number of timed runs per case')
+    parser.add_argument('--vectorized', action='store_true', help='also time the pure PyTorch nms fallback')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
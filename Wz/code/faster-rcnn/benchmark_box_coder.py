@@ -0,0 +1,128 @@
+"""
+该脚本用于在CPU上比较BoxCoder原先逐列计算的encode/decode与融合版本(encode_boxes_fused/decode_boxes_fused)的速度，
+并检查两者结果是否完全一致
+python benchmark_box_coder.py --num-threads 4
+"""
+
+import time
+import math
+import argparse
+
+import torch
+
+from network_files import det_utils
+
+
+def reference_decode(rel_codes, boxes, weights, bbox_xform_clip):
+    """原先BoxCoder.decode_single的实现, 作为速度和结果的对照"""
+    boxes = boxes.to(rel_codes.dtype)
+
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    ctr_x = boxes[:, 0] + 0.5 * widths
+    ctr_y = boxes[:, 1] + 0.5 * heights
+
+    wx, wy, ww, wh = weights
+    dx = rel_codes[:, 0::4] / wx
+    dy = rel_codes[:, 1::4] / wy
+    dw = rel_codes[:, 2::4] / ww
+    dh = rel_codes[:, 3::4] / wh
+
+    dw = torch.clamp(dw, max=bbox_xform_clip)
+    dh = torch.clamp(dh, max=bbox_xform_clip)
+
+    pred_ctr_x = dx * widths[:, None] + ctr_x[:, None]
+    pred_ctr_y = dy * heights[:, None] + ctr_y[:, None]
+    pred_w = torch.exp(dw) * widths[:, None]
+    pred_h = torch.exp(dh) * heights[:, None]
+
+    pred_boxes1 = pred_ctr_x - torch.tensor(0.5, dtype=pred_ctr_x.dtype, device=pred_w.device) * pred_w
+    pred_boxes2 = pred_ctr_y - torch.tensor(0.5, dtype=pred_ctr_y.dtype, device=pred_h.device) * pred_h
+    pred_boxes3 = pred_ctr_x + torch.tensor(0.5, dtype=pred_ctr_x.dtype, device=pred_w.device) * pred_w
+    pred_boxes4 = pred_ctr_y + torch.tensor(0.5, dtype=pred_ctr_y.dtype, device=pred_h.device) * pred_h
+    return torch.stack((pred_boxes1, pred_boxes2, pred_boxes3, pred_boxes4), dim=2).flatten(1)
+
+
+def random_boxes(num, image_size=(800, 1344)):
+    height, width = image_size
+    ctr = torch.rand(num, 2) * torch.tensor([width, height])
+    wh = torch.rand(num, 2) * 256 + 1
+    return torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1)
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t_start) / repeats
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    bbox_xform_clip = math.log(1000. / 16)
+
+    # 800x1344输入时RPN的anchors数量(5个预测特征层, 每个位置3个anchors)
+    num_anchors = sum((800 // s) * (1344 // s) * 3 for s in (4, 8, 16, 32, 64))
+    cases = [
+        # name, 框的数量, 每个框的回归参数组数, weights
+        ("rpn decode (1 image)", num_anchors, 1, (1., 1., 1., 1.)),
+        ("rpn decode (top-k, 2 images)", 2 * 4000, 1, (1., 1., 1., 1.)),
+        ("roi_heads decode (1000 x 91)", 1000, 91, (10., 10., 5., 5.)),
+        ("roi_heads decode (4 x 1000 x 21)", 4000, 21, (10., 10., 5., 5.)),
+    ]
+
+    print("using {} cpu threads.".format(torch.get_num_threads()))
+    print("{:>34} | {:>10} | {:>10} | {:>12} | {:>8} | {}".format(
+        "case", "ref(ms)", "fused(ms)", "fused+out(ms)", "speedup", "same"))
+    with torch.no_grad():
+        for name, num_boxes, num_codes, weights in cases:
+            boxes = random_boxes(num_boxes)
+            rel_codes = torch.randn(num_boxes, num_codes * 4)
+            # 部分dw, dh超过bbox_xform_clip, 测试clamp
+            rel_codes[::7, 2::4] += 10.
+            weights_t = torch.as_tensor(weights)
+            out = torch.empty_like(rel_codes)
+
+            ref = reference_decode(rel_codes, boxes, weights, bbox_xform_clip)
+            fused = det_utils.decode_boxes_fused(rel_codes, boxes, weights_t, bbox_xform_clip, out)
+            same = torch.equal(ref, fused)
+
+            t_ref = benchmark(lambda: reference_decode(rel_codes, boxes, weights, bbox_xform_clip), args.repeats)
+            t_fused = benchmark(lambda: det_utils.decode_boxes_fused(rel_codes, boxes, weights_t, bbox_xform_clip),
+                                args.repeats)
+            t_out = benchmark(lambda: det_utils.decode_boxes_fused(rel_codes, boxes, weights_t, bbox_xform_clip, out),
+                              args.repeats)
+            print("{:>34} | {:>10.2f} | {:>10.2f} | {:>12.2f} | {:>7.2f}x | {}".format(
+                name, t_ref * 1000, t_fused * 1000, t_out * 1000, t_ref / t_out, same))
+
+        # rpn训练时对每个anchor计算回归目标, roi_heads训练时对512 x batch个proposals计算回归目标
+        for name, num_boxes, weights in [("rpn encode (2 images)", 2 * num_anchors, (1., 1., 1., 1.)),
+                                         ("roi_heads encode (4 x 512)", 4 * 512, (10., 10., 5., 5.))]:
+            anchors = random_boxes(num_boxes)
+            gt_boxes = anchors + torch.randn(num_boxes, 4) * 4
+            weights_t = torch.as_tensor(weights)
+            out = torch.empty_like(anchors)
+
+            ref = det_utils.encode_boxes(gt_boxes, anchors, weights_t)
+            fused = det_utils.encode_boxes_fused(gt_boxes, anchors, weights_t, out)
+            same = torch.equal(ref, fused)
+
+            t_ref = benchmark(lambda: det_utils.encode_boxes(gt_boxes, anchors, weights_t), args.repeats)
+            t_fused = benchmark(lambda: det_utils.encode_boxes_fused(gt_boxes, anchors, weights_t), args.repeats)
+            t_out = benchmark(lambda: det_utils.encode_boxes_fused(gt_boxes, anchors, weights_t, out), args.repeats)
+            print("{:>34} | {:>10.2f} | {:>10.2f} | {:>12.2f} | {:>7.2f}x | {}".format(
+                name, t_ref * 1000, t_fused * 1000, t_out * 1000, t_ref / t_out, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--num-threads', default=1, type=int, help='number of cpu threads')
+    parser.add_argument('--repeats', default=50, type=int, help='number of timed runs per case')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,103 @@
+"""
+该脚本用于比较RegionProposalNetwork中filter_proposals(逐张图像处理)
+与filter_proposals_batched(整个batch只进行一次nms)的速度，并检查两者结果是否一致
+python benchmark_filter_proposals.py --batch-sizes 1 2 4 8 16
+"""
+
+import time
+import argparse
+
+import torch
+
+from network_files.rpn_function import RegionProposalNetwork
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def create_rpn(args):
+    # filter_proposals只需要nms相关参数, anchor生成器和head不会被用到
+    rpn = RegionProposalNetwork(
+        anchor_generator=None, head=None,
+        fg_iou_thresh=0.7, bg_iou_thresh=0.3,
+        batch_size_per_image=256, positive_fraction=0.5,
+        pre_nms_top_n=dict(training=2000, testing=args.pre_nms_top_n),
+        post_nms_top_n=dict(training=2000, testing=args.post_nms_top_n),
+        nms_thresh=0.7, score_thresh=args.score_thresh)
+    rpn.eval()
+    return rpn
+
+
+def random_inputs(batch_size, num_anchors_per_level, image_size, device):
+    """随机生成proposals以及objectness, 模拟800x1333输入时FPN各层的anchors数量"""
+    num_anchors = sum(num_anchors_per_level)
+    height, width = image_size
+    ctr = torch.rand(batch_size, num_anchors, 2, device=device) * torch.tensor([width, height], device=device)
+    wh = torch.rand(batch_size, num_anchors, 2, device=device) * 256 + 1
+    # 部分boxes越界, 测试clip
+    proposals = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=2)
+    objectness = torch.randn(batch_size * num_anchors, 1, device=device)
+    # 每张图像的有效尺寸不同
+    image_shapes = [(height - 16 * i, width - 32 * i) for i in range(batch_size)]
+    return proposals, objectness, image_shapes
+
+
+def check_same(rpn, proposals, objectness, image_shapes, num_anchors_per_level):
+    boxes, scores = rpn.filter_proposals(proposals, objectness, image_shapes, num_anchors_per_level)
+    boxes_b, scores_b, num_per_image = rpn.filter_proposals_batched(proposals, objectness, image_shapes,
+                                                                    num_anchors_per_level)
+    for i, (b, s) in enumerate(zip(boxes, scores)):
+        n = int(num_per_image[i])
+        if n != b.shape[0] or not torch.equal(b, boxes_b[i, :n]) or not torch.equal(s, scores_b[i, :n]):
+            return False
+    return True
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    rpn = create_rpn(args)
+    # 800x1344输入, 5个预测特征层(stride 4, 8, 16, 32, 64), 每个位置3个anchors
+    image_size = (800, 1344)
+    num_anchors_per_level = [(image_size[0] // s) * (image_size[1] // s) * 3 for s in (4, 8, 16, 32, 64)]
+
+    print("{:>10} | {:>12} | {:>12} | {:>8} | {}".format("batch_size", "loop(ms)", "batched(ms)", "speedup", "same"))
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            proposals, objectness, image_shapes = random_inputs(batch_size, num_anchors_per_level,
+                                                                image_size, device)
+            same = check_same(rpn, proposals, objectness, image_shapes, num_anchors_per_level)
+            t_loop = benchmark(lambda: rpn.filter_proposals(proposals, objectness, image_shapes,
+                                                            num_anchors_per_level), args.repeats)
+            t_batched = benchmark(lambda: rpn.filter_proposals_batched(proposals, objectness, image_shapes,
+                                                                       num_anchors_per_level), args.repeats)
+            print("{:>10} | {:>12.2f} | {:>12.2f} | {:>7.2f}x | {}".format(
+                batch_size, t_loop * 1000, t_batched * 1000, t_loop / t_batched, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--batch-sizes', default=[1, 2, 4, 8, 16], type=int, nargs='+', help='batch sizes to test')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed runs per batch size')
+    parser.add_argument('--pre-nms-top-n', default=1000, type=int, help='rpn pre nms top n (testing)')
+    parser.add_argument('--post-nms-top-n', default=1000, type=int, help='rpn post nms top n (testing)')
+    parser.add_argument('--score-thresh', default=0.0, type=float, help='rpn score thresh')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,130 @@
+"""
+该脚本用于比较RoIHeads.postprocess_detections中先对所有proposal的所有类别decode再筛选(原先的实现)
+与先根据score_thresh筛选再只对保留下来的(proposal, 类别)decode的速度，并检查两者结果是否一致
+python benchmark_postprocess_detections.py --num-classes 21 91 --batch-sizes 1 4 8
+"""
+
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from network_files.roi_head import RoIHeads
+from network_files import boxes as box_ops
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def create_roi_heads(args):
+    # postprocess_detections只需要box_coder以及推理相关参数, roi pooling和head不会被用到
+    roi_heads = RoIHeads(
+        box_roi_pool=None, box_head=None, box_predictor=None,
+        fg_iou_thresh=0.5, bg_iou_thresh=0.5,
+        batch_size_per_image=512, positive_fraction=0.25,
+        bbox_reg_weights=None,
+        score_thresh=args.score_thresh, nms_thresh=0.5, detection_per_img=100)
+    roi_heads.eval()
+    return roi_heads
+
+
+def reference_postprocess(roi_heads, class_logits, box_regression, proposals, image_shapes):
+    """原先的实现: 对所有proposal的所有类别decode并裁剪, 再移除背景以及低概率目标"""
+    device = class_logits.device
+    num_classes = class_logits.shape[-1]
+    boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
+    pred_boxes = roi_heads.box_coder.decode(box_regression, proposals)
+    pred_scores = F.softmax(class_logits, -1)
+
+    all_boxes, all_scores, all_labels = [], [], []
+    for boxes, scores, image_shape in zip(pred_boxes.split(boxes_per_image, 0),
+                                          pred_scores.split(boxes_per_image, 0), image_shapes):
+        boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
+        labels = torch.arange(num_classes, device=device).view(1, -1).expand_as(scores)
+        boxes = boxes[:, 1:].reshape(-1, 4)
+        scores = scores[:, 1:].reshape(-1)
+        labels = labels[:, 1:].reshape(-1)
+
+        inds = torch.where(torch.gt(scores, roi_heads.score_thresh))[0]
+        boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+        keep = box_ops.remove_small_boxes(boxes, min_size=1.)
+        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+        keep = box_ops.batched_nms(boxes, scores, labels, roi_heads.nms_thresh)
+        keep = keep[:roi_heads.detection_per_img]
+        all_boxes.append(boxes[keep])
+        all_scores.append(scores[keep])
+        all_labels.append(labels[keep])
+    return all_boxes, all_scores, all_labels
+
+
+def random_inputs(batch_size, num_proposals, num_classes, image_size, device):
+    """随机生成proposals以及box predictor的输出, 大部分类别的分数远低于score_thresh"""
+    height, width = image_size
+    ctr = torch.rand(batch_size * num_proposals, 2, device=device) * torch.tensor([width, height], device=device)
+    wh = torch.rand(batch_size * num_proposals, 2, device=device) * 256 + 8
+    proposals = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1).split(num_proposals, 0)
+    # 背景类的logits更大, 与训练好的模型输出的分布类似
+    class_logits = torch.randn(batch_size * num_proposals, num_classes, device=device) * 2
+    class_logits[:, 0] += 4
+    box_regression = torch.randn(batch_size * num_proposals, num_classes * 4, device=device) * 0.5
+    image_shapes = [image_size] * batch_size
+    return class_logits, box_regression, list(proposals), image_shapes
+
+
+def check_same(roi_heads, inputs):
+    ref = reference_postprocess(roi_heads, *inputs)
+    res = roi_heads.postprocess_detections(*inputs)
+    for a_list, b_list in zip(ref, res):
+        for a, b in zip(a_list, b_list):
+            if a.shape != b.shape or not torch.allclose(a.float(), b.float(), atol=1e-4):
+                return False
+    return True
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    roi_heads = create_roi_heads(args)
+    image_size = (800, 1344)
+
+    print("{:>11} | {:>10} | {:>16} | {:>18} | {:>8} | {}".format(
+        "num_classes", "batch_size", "decode all(ms)", "thresh first(ms)", "speedup", "same"))
+    with torch.no_grad():
+        for num_classes in args.num_classes:
+            for batch_size in args.batch_sizes:
+                inputs = random_inputs(batch_size, args.num_proposals, num_classes, image_size, device)
+                same = check_same(roi_heads, inputs)
+                t_ref = benchmark(lambda: reference_postprocess(roi_heads, *inputs), args.repeats)
+                t_new = benchmark(lambda: roi_heads.postprocess_detections(*inputs), args.repeats)
+                print("{:>11} | {:>10} | {:>16.2f} | {:>18.2f} | {:>7.2f}x | {}".format(
+                    num_classes, batch_size, t_ref * 1000, t_new * 1000, t_ref / t_new, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--num-classes', default=[21, 91], type=int, nargs='+',
+                        help='number of classes(包含背景) to test')
+    parser.add_argument('--batch-sizes', default=[1, 4, 8], type=int, nargs='+', help='batch sizes to test')
+    parser.add_argument('--num-proposals', default=1000, type=int, help='number of proposals per image')
+    parser.add_argument('--score-thresh', default=0.05, type=float, help='box score thresh')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed runs per case')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,143 @@
+"""
+该脚本用于比较RoIHeads中逐张图像(assign_targets_to_proposals + subsample + encode)
+与整个batch一起(select_training_samples_batched)划分正负样本的速度，
+并检查两者的匹配结果是否一致，以及每张图像采样得到的正负样本数量是否一致(采样本身是随机的)
+整个batch一起处理默认关闭，根据这里的结果在FasterRCNN/MaskRCNN中指定box_batched_sampling=True启用
+python benchmark_select_training_samples.py --batch-sizes 2 4 8 16
+"""
+
+import time
+import argparse
+
+import torch
+
+from network_files.roi_head import RoIHeads
+from network_files import det_utils
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def create_roi_heads():
+    # 只用到匹配、采样以及box_coder, roi pooling和head不会被用到
+    roi_heads = RoIHeads(
+        box_roi_pool=None, box_head=None, box_predictor=None,
+        fg_iou_thresh=0.5, bg_iou_thresh=0.5,
+        batch_size_per_image=512, positive_fraction=0.25,
+        bbox_reg_weights=None,
+        score_thresh=0.05, nms_thresh=0.5, detection_per_img=100)
+    return roi_heads
+
+
+def random_inputs(batch_size, num_proposals, max_gt, image_size, device):
+    """随机生成proposals以及gt, 每张图像的gt数量不同(包括没有gt的图像)"""
+    height, width = image_size
+    scale = torch.tensor([width, height], device=device)
+    proposals, gt_boxes, gt_labels = [], [], []
+    for i in range(batch_size):
+        num_gt = int(torch.randint(0, max_gt + 1, (1,))) if i > 0 else max_gt
+        gt_ctr = torch.rand(num_gt, 2, device=device) * scale
+        gt_wh = torch.rand(num_gt, 2, device=device) * 200 + 16
+        gt = torch.cat([gt_ctr - gt_wh / 2, gt_ctr + gt_wh / 2], dim=1)
+        # 一半的proposals在gt附近, 保证有足够的正样本
+        num_near = num_proposals // 2 if num_gt > 0 else 0
+        near = gt[torch.randint(0, max(num_gt, 1), (num_near,), device=device)] if num_gt > 0 else gt
+        near = near + torch.randn(num_near, 4, device=device) * 16
+        ctr = torch.rand(num_proposals - num_near, 2, device=device) * scale
+        wh = torch.rand(num_proposals - num_near, 2, device=device) * 256 + 8
+        far = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1)
+        proposals.append(torch.cat([near, far]))
+        gt_boxes.append(gt)
+        gt_labels.append(torch.randint(1, 21, (num_gt,), device=device))
+    return proposals, gt_boxes, gt_labels
+
+
+def loop_select(roi_heads, proposals, gt_boxes, gt_labels):
+    """原先逐张图像处理的实现"""
+    matched_idxs, labels = roi_heads.assign_targets_to_proposals(proposals, gt_boxes, gt_labels)
+    sampled_inds = roi_heads.subsample(labels)
+    matched_gt_boxes, sampled_proposals, sampled_labels = [], [], []
+    for img_id, img_sampled_inds in enumerate(sampled_inds):
+        sampled_proposals.append(proposals[img_id][img_sampled_inds])
+        sampled_labels.append(labels[img_id][img_sampled_inds])
+        gt_boxes_in_image = gt_boxes[img_id]
+        if gt_boxes_in_image.numel() == 0:
+            gt_boxes_in_image = torch.zeros((1, 4), dtype=proposals[0].dtype, device=proposals[0].device)
+        matched_gt_boxes.append(gt_boxes_in_image[matched_idxs[img_id][img_sampled_inds]])
+    regression_targets = roi_heads.box_coder.encode(matched_gt_boxes, sampled_proposals)
+    return sampled_proposals, sampled_labels, regression_targets
+
+
+def check_same(roi_heads, proposals, gt_boxes, gt_labels):
+    """匹配结果必须完全一致, 采样的结果只比较每张图像的正负样本数量"""
+    device = proposals[0].device
+    _, labels = roi_heads.assign_targets_to_proposals(proposals, gt_boxes, gt_labels)
+    proposals_padded = torch.nn.utils.rnn.pad_sequence(proposals, batch_first=True)
+    gt_boxes_padded = torch.nn.utils.rnn.pad_sequence(gt_boxes, batch_first=True)
+    gt_labels_padded = torch.nn.utils.rnn.pad_sequence(gt_labels, batch_first=True)
+    width = proposals_padded.shape[1]
+    num_proposals = torch.as_tensor([p.shape[0] for p in proposals], device=device)
+    num_gt = torch.as_tensor([g.shape[0] for g in gt_boxes], device=device)
+    proposal_valid = torch.arange(width, device=device)[None, :] < num_proposals[:, None]
+    gt_valid = torch.arange(gt_boxes_padded.shape[1], device=device)[None, :] < num_gt[:, None]
+    _, labels_b = roi_heads.assign_targets_to_proposals_batched(proposals_padded, proposal_valid,
+                                                                gt_boxes_padded, gt_labels_padded, gt_valid)
+    for i, l in enumerate(labels):
+        if not torch.equal(l, labels_b[i, :l.shape[0]]):
+            return False
+
+    _, sampled_labels, _ = loop_select(roi_heads, proposals, gt_boxes, gt_labels)
+    _, _, sampled_labels_b, _ = roi_heads.select_training_samples_batched(proposals, gt_boxes, gt_labels)
+    for l, l_b in zip(sampled_labels, sampled_labels_b):
+        if int((l > 0).sum()) != int((l_b > 0).sum()) or int((l == 0).sum()) != int((l_b == 0).sum()):
+            return False
+    return True
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    roi_heads = create_roi_heads()
+    assert not isinstance(roi_heads.proposal_matcher, det_utils.ChunkedMatcher)
+    image_size = (800, 1344)
+
+    print("{:>10} | {:>12} | {:>12} | {:>8} | {}".format("batch_size", "loop(ms)", "batched(ms)", "speedup", "same"))
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            proposals, gt_boxes, gt_labels = random_inputs(batch_size, args.num_proposals, args.max_gt,
+                                                           image_size, device)
+            # 与select_training_samples相同, 先将gt_boxes拼接到proposals后面
+            proposals = roi_heads.add_gt_proposals(proposals, gt_boxes)
+            same = check_same(roi_heads, proposals, gt_boxes, gt_labels)
+            t_loop = benchmark(lambda: loop_select(roi_heads, proposals, gt_boxes, gt_labels), args.repeats)
+            t_batched = benchmark(lambda: roi_heads.select_training_samples_batched(proposals, gt_boxes, gt_labels),
+                                  args.repeats)
+            print("{:>10} | {:>12.2f} | {:>12.2f} | {:>7.2f}x | {}".format(
+                batch_size, t_loop * 1000, t_batched * 1000, t_loop / t_batched, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--batch-sizes', default=[2, 4, 8, 16], type=int, nargs='+', help='batch sizes to test')
+    parser.add_argument('--num-proposals', default=2000, type=int, help='number of rpn proposals per image')
+    parser.add_argument('--max-gt', default=20, type=int, help='max number of gt boxes per image')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed runs per batch size')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -10,14 +10,19 @@ import json
 from PIL import Image
 from lxml import etree
 
+from train_utils import draft_jpeg, get_draft_size
+
 
 class VOCDataSet(Dataset):
     """读取解析PASCAL VOC2007/2012数据集"""
 
-    def __init__(self, voc_root, year="2012", transforms=None, txt_name: str = "train.txt"):
+    def __init__(self, voc_root, year="2012", transforms=None, txt_name: str = "train.txt", draft_size=None):
         """
         voc_root: 数据集根目录 ./
         txt_name: 返回哪一个文件中的图片
+        draft_size: (min_size, max_size), 与模型的GeneralizedRCNNTransform相同, 默认为None即解码完整的图像
+                    指定后JPEG图像解码时会直接缩小到不小于模型输入尺寸的1/2^n, boxes会同步缩放
+                    返回的图像与原图尺寸不同, 因此只建议在训练集上使用
         """
         assert year in ["2007", "2012"], "year must be in ['2007', '2012']"
         # 增加容错能力
@@ -55,6 +60,7 @@ class VOCDataSet(Dataset):
             self.class_dict = json.load(f)
 
         self.transforms = transforms
+        self.draft_size = draft_size
 
     def __len__(self):
         return len(self.xml_list)
@@ -83,6 +89,10 @@ class VOCDataSet(Dataset):
         image = Image.open(img_path)
         if image.format != "JPEG":
             raise ValueError("Image '{}' format not JPEG".format(img_path))
+        scale_x, scale_y = 1., 1.
+        if self.draft_size is not None:
+            width, height = image.size
+            scale_x, scale_y = draft_jpeg(image, get_draft_size(width, height, *self.draft_size))
 
         #---------------------------------------------#
         #   根据xml中的数据获取box(左上右下),label的索引值
@@ -106,7 +116,8 @@ class VOCDataSet(Dataset):
                 print("Warning: in '{}' xml, there are some bbox w/h <=0".format(xml_path))
                 continue
 
-            boxes.append([xmin, ymin, xmax, ymax])
+            # 图像解码时被缩小的话, box也要同步缩放
+            boxes.append([xmin * scale_x, ymin * scale_y, xmax * scale_x, ymax * scale_y])
             labels.append(self.class_dict[obj["name"]])
             if "difficult" in obj:
                 iscrowd.append(int(obj["difficult"]))
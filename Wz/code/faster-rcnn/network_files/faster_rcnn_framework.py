@@ -280,6 +280,14 @@ class FasterRCNN(FasterRCNNBase):
             of the classification head
         bbox_reg_weights (Tuple[float, float, float, float]): weights for the encoding/decoding of the
             bounding boxes
+        rpn_batched_filter (bool): filter the RPN proposals of the whole batch with a single batched NMS
+            instead of looping over the images
+        matcher_memory_budget (int): if not None, the RPN and RoIHeads match boxes to the ground-truth
+            in chunks, each using at most this many bytes, instead of building the full IoU matrix
+        box_nms_method (str): "nms" for greedy NMS or "matrix" for Matrix NMS when postprocessing
+            the predictions of the classification head
+        box_batched_sampling (bool): match and sample the training proposals of the whole batch at once
+            instead of looping over the images (ignored when matcher_memory_budget is set)
 
     """
 
@@ -304,7 +312,11 @@ class FasterRCNN(FasterRCNNBase):
                  box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=100,
                  box_fg_iou_thresh=0.5, box_bg_iou_thresh=0.5,   # fast rcnn计算误差时，采集正负样本设置的阈值 >0.5认为是正样本
                  box_batch_size_per_image=512, box_positive_fraction=0.25,  # fast rcnn计算误差时采样的样本数，以及正样本占所有样本的比例
-                 bbox_reg_weights=None):
+                 bbox_reg_weights=None,
+                 rpn_batched_filter=False,  # rpn中整个batch只进行一次nms
+                 matcher_memory_budget=None,  # 正负样本匹配时分块计算iou所用的内存上限(bytes)
+                 box_nms_method="nms",  # fast rcnn后处理使用的nms方法, "nms"或"matrix"
+                 box_batched_sampling=False):  # fast rcnn训练时整个batch一起匹配、采样正负样本
 
         #   backbone是否有out_channels,必须有
         if not hasattr(backbone, "out_channels"):
@@ -363,7 +375,9 @@ class FasterRCNN(FasterRCNNBase):
             rpn_fg_iou_thresh, rpn_bg_iou_thresh,
             rpn_batch_size_per_image, rpn_positive_fraction,
             rpn_pre_nms_top_n, rpn_post_nms_top_n, rpn_nms_thresh,
-            score_thresh=rpn_score_thresh)
+            score_thresh=rpn_score_thresh,
+            batched_filter=rpn_batched_filter,
+            matcher_memory_budget=matcher_memory_budget)
 
         #---------------------------------------------------#
         #   Multi-scale RoIAlign pooling ROIAlign比ROI更准确,调整为相同大小
@@ -407,7 +421,10 @@ class FasterRCNN(FasterRCNNBase):
             box_fg_iou_thresh, box_bg_iou_thresh,  # 0.5 0.5 正负样本临界值
             box_batch_size_per_image, box_positive_fraction,  # 512(每张图片中选取多少个proposal计算fasterrcnn损失)  0.25(正样本比例)
             bbox_reg_weights,   # 超参数
-            box_score_thresh, box_nms_thresh, box_detections_per_img)  # 0.05  0.5  100  移除低目标概率,fast rcnn中进行nms处理的阈值,对预测结果根据score排序取前100个目标
+            box_score_thresh, box_nms_thresh, box_detections_per_img,  # 0.05  0.5  100  移除低目标概率,fast rcnn中进行nms处理的阈值,对预测结果根据score排序取前100个目标
+            matcher_memory_budget=matcher_memory_budget,
+            nms_method=box_nms_method,
+            batched_sampling=box_batched_sampling)
 
         if image_mean is None:
             image_mean = [0.485, 0.456, 0.406]
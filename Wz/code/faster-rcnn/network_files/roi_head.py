@@ -84,7 +84,10 @@ class RoIHeads(torch.nn.Module):
                  # Faster R-CNN inference   移除低目标概率,fast rcnn中进行nms处理的阈值,对预测结果根据score排序取前100个目标
                  score_thresh,        # default: 0.05
                  nms_thresh,          # default: 0.5
-                 detection_per_img):  # default: 100
+                 detection_per_img,  # default: 100
+                 matcher_memory_budget=None,  # 不为None时分块计算proposal与gt的iou
+                 nms_method="nms",  # "nms": 贪心nms, "matrix": Matrix NMS
+                 batched_sampling=False):  # 训练时整个batch一起匹配、采样正负样本
         super(RoIHeads, self).__init__()
 
         #---------------------------------------------------#
@@ -96,10 +99,16 @@ class RoIHeads(torch.nn.Module):
         #   将proposal划分到正负样本中
         #   assign ground-truth boxes for each proposal
         #---------------------------------------------------#
-        self.proposal_matcher = det_utils.Matcher(
-            fg_iou_thresh,  # default: 0.5
-            bg_iou_thresh,  # default: 0.5
-            allow_low_quality_matches=False)
+        if matcher_memory_budget is None:
+            self.proposal_matcher = det_utils.Matcher(
+                fg_iou_thresh,  # default: 0.5
+                bg_iou_thresh,  # default: 0.5
+                allow_low_quality_matches=False)
+        else:
+            self.proposal_matcher = det_utils.ChunkedMatcher(
+                fg_iou_thresh, bg_iou_thresh,
+                allow_low_quality_matches=False,
+                memory_budget=matcher_memory_budget)
 
         #---------------------------------------------------#
         #   按照给定的batch_size_per_image, positive_fraction选择正负样本
@@ -112,6 +121,8 @@ class RoIHeads(torch.nn.Module):
             bbox_reg_weights = (10., 10., 5., 5.)
         self.box_coder = det_utils.BoxCoder(bbox_reg_weights)
 
+        self.batched_sampling = batched_sampling
+
         self.box_roi_pool = box_roi_pool    # ROIAlign,调整为相同大小
         self.box_head = box_head            # 展平和两个FC
         self.box_predictor = box_predictor  # 分类预测和框的预测
@@ -120,6 +131,17 @@ class RoIHeads(torch.nn.Module):
         self.nms_thresh = nms_thresh      # default: 0.5
         self.detection_per_img = detection_per_img  # default: 100
 
+        #---------------------------------------------------#
+        #   后处理使用的nms方法, matrix时根据与高分boxes的重叠程度衰减分数
+        #   衰减后的分数仍然用score_thresh过滤
+        #---------------------------------------------------#
+        if nms_method not in ("nms", "matrix"):
+            raise ValueError("nms_method should be 'nms' or 'matrix', got {}".format(nms_method))
+        self.nms_method = nms_method
+        self.matrix_nms_kernel = "gaussian"
+        self.matrix_nms_sigma = 2.0
+        self.matrix_nms_pre_top_n = 1000  # 每张图像最多对1000个boxes计算iou矩阵
+
     #----------------------------------------------------#
     # 为每个proposal匹配对应的gt_box，并划分到正负样本中
     #----------------------------------------------------#
@@ -149,17 +171,23 @@ class RoIHeads(torch.nn.Module):
                     (proposals_in_image.shape[0],), dtype=torch.int64, device=device
                 )
             else:
-                #----------------------------------------------------#
-                #   set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
-                #   计算proposal与每个gt_box的iou重合度
-                #----------------------------------------------------#
-                match_quality_matrix = box_ops.box_iou(gt_boxes_in_image, proposals_in_image)
-
-                #----------------------------------------------------#
-                #   计算proposal与每个gt_box匹配的iou最大值，并记录索引 这里这两个值都是0.5,所以小于的为-1,没有-2
-                #   iou < low_threshold索引值为 -1， low_threshold <= iou < high_threshold索引值为 -2
-                #----------------------------------------------------#
-                matched_idxs_in_image = self.proposal_matcher(match_quality_matrix)
+                if isinstance(self.proposal_matcher, det_utils.ChunkedMatcher):
+                    #----------------------------------------------------#
+                    #   分块计算iou并匹配, 不生成完整的iou矩阵
+                    #----------------------------------------------------#
+                    matched_idxs_in_image = self.proposal_matcher.match_boxes(gt_boxes_in_image, proposals_in_image)
+                else:
+                    #----------------------------------------------------#
+                    #   set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
+                    #   计算proposal与每个gt_box的iou重合度
+                    #----------------------------------------------------#
+                    match_quality_matrix = box_ops.box_iou(gt_boxes_in_image, proposals_in_image)
+
+                    #----------------------------------------------------#
+                    #   计算proposal与每个gt_box匹配的iou最大值，并记录索引 这里这两个值都是0.5,所以小于的为-1,没有-2
+                    #   iou < low_threshold索引值为 -1， low_threshold <= iou < high_threshold索引值为 -2
+                    #----------------------------------------------------#
+                    matched_idxs_in_image = self.proposal_matcher(match_quality_matrix)
 
                 #----------------------------------------------------#
                 #   clamp限制最小值，防止匹配标签时出现越界的情况
@@ -190,21 +218,57 @@ class RoIHeads(torch.nn.Module):
             labels.append(labels_in_image)
         return matched_idxs, labels
 
+    #----------------------------------------------------#
+    #   assign_targets_to_proposals的batch版本
+    #----------------------------------------------------#
+    def assign_targets_to_proposals_batched(self,
+                                            proposals,       # type: Tensor
+                                            proposal_valid,  # type: Tensor
+                                            gt_boxes,        # type: Tensor
+                                            gt_labels,       # type: Tensor
+                                            gt_valid         # type: Tensor
+                                            ):
+        # type: (...) -> Tuple[Tensor, Tensor]
+        """
+        对pad后的整个batch一次性计算iou并匹配, 每张图像的结果与assign_targets_to_proposals相同
+        Args:
+            proposals:      [B, P, 4] pad后的proposals
+            proposal_valid: [B, P] pad出来的proposal为False
+            gt_boxes:       [B, G, 4] pad后的gt_boxes
+            gt_labels:      [B, G]
+            gt_valid:       [B, G] pad出来的gt为False
+
+        Returns:
+            matched_idxs: [B, P] 每个proposal匹配到的gt索引(背景以及废弃样本为0)
+            labels:       [B, P] 正样本为gt类别, 背景为0, 废弃样本以及pad出来的proposal为-1
+        """
+        #----------------------------------------------------#
+        #   计算每张图像中proposal与每个gt_box的iou, [B, G, P]
+        #   没有gt的图像所有proposal都小于low_threshold, 即背景
+        #----------------------------------------------------#
+        match_quality_matrix = box_ops.batched_box_iou(gt_boxes, proposals)
+        matched_idxs = self.proposal_matcher.match_batched(match_quality_matrix, gt_valid)
+
+        clamped_matched_idxs = matched_idxs.clamp(min=0)
+        labels = torch.gather(gt_labels, 1, clamped_matched_idxs).to(dtype=torch.int64)
+
+        #----------------------------------------------------#
+        #   背景为0, 废弃样本以及pad出来的proposal为-1(采样时会被忽略)
+        #----------------------------------------------------#
+        labels.masked_fill_(matched_idxs == self.proposal_matcher.BELOW_LOW_THRESHOLD, 0)
+        labels.masked_fill_(matched_idxs == self.proposal_matcher.BETWEEN_THRESHOLDS, -1)
+        labels.masked_fill_(~proposal_valid, -1)
+        return clamped_matched_idxs, labels
+
     #----------------------------------------------------#
     #   按给定数量和比例采样正负样本
     #----------------------------------------------------#
     def subsample(self, labels):
         #---------------------------------------------------#
         #   按照给定的batch_size_per_image, positive_fraction选择正负样本
+        #   整个batch一起采样, 返回每张图片采集的所有样本索引（包括正样本和负样本）
         #---------------------------------------------------#
-        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
-        sampled_inds = []
-        # 遍历每张图片的正负样本索引
-        for img_idx, (pos_inds_img, neg_inds_img) in enumerate(zip(sampled_pos_inds, sampled_neg_inds)):
-            # 记录所有采集样本索引（包括正样本和负样本）
-            # img_sampled_inds = torch.nonzero(pos_inds_img | neg_inds_img).squeeze(1)
-            img_sampled_inds = torch.where(pos_inds_img | neg_inds_img)[0]
-            sampled_inds.append(img_sampled_inds)
+        sampled_inds = self.fg_bg_sampler.sample_indices_per_image(labels)
         return sampled_inds # 返回正负样本inde
 
     #----------------------------------------------------#
@@ -275,6 +339,15 @@ class RoIHeads(torch.nn.Module):
         #----------------------------------------------------#
         proposals = self.add_gt_proposals(proposals, gt_boxes)
 
+        if self.batched_sampling and not isinstance(self.proposal_matcher, det_utils.ChunkedMatcher):
+            #----------------------------------------------------#
+            #   整个batch一起匹配、采样并计算回归参数(batched_sampling, 默认关闭, 在cpu上比逐张图像慢)
+            #   分块计算iou的ChunkedMatcher只能逐张图像处理
+            #----------------------------------------------------#
+            proposals, matched_idxs, labels, regression_targets = self.select_training_samples_batched(
+                proposals, gt_boxes, gt_labels)
+            return proposals, labels, regression_targets
+
         #----------------------------------------------------#
         #   get matching gt indices for each proposal
         #   为每个proposal匹配对应的gt_box，并划分到正负样本中
@@ -312,6 +385,75 @@ class RoIHeads(torch.nn.Module):
         regression_targets = self.box_coder.encode(matched_gt_boxes, proposals)
         return proposals, labels, regression_targets
 
+    #----------------------------------------------------#
+    #   整个batch一起划分正负样本，统计对应gt的标签以及边界框回归信息
+    #----------------------------------------------------#
+    def select_training_samples_batched(self,
+                                        proposals,  # type: List[Tensor]
+                                        gt_boxes,   # type: List[Tensor]
+                                        gt_labels   # type: List[Tensor]
+                                        ):
+        # type: (...) -> Tuple[List[Tensor], List[Tensor], List[Tensor], List[Tensor]]
+        """
+        每张图像的proposals(已经拼接了gt_boxes)以及gt数量不同, pad到相同数量后通过valid mask区分,
+        iou、匹配、采样以及回归参数的计算都只执行一次, 不再逐张图像循环
+        采样方式与逐张图像处理时相同, 每张图像返回的样本按照在proposals中的索引升序排列
+        Args:
+            proposals: 拼接了gt_boxes的proposals
+            gt_boxes:  每张图像的gt_boxes
+            gt_labels: 每张图像的gt类别
+
+        Returns:
+            proposals, matched_idxs, labels, regression_targets: 每张图像采样得到的正负样本信息
+        """
+        num_images = len(proposals)
+        device = proposals[0].device
+
+        #----------------------------------------------------#
+        #   pad到相同数量, [B, P, 4], [B, G, 4], [B, G]
+        #----------------------------------------------------#
+        proposals_padded = torch.nn.utils.rnn.pad_sequence(proposals, batch_first=True)
+        gt_boxes_padded = torch.nn.utils.rnn.pad_sequence(gt_boxes, batch_first=True)
+        gt_labels_padded = torch.nn.utils.rnn.pad_sequence(gt_labels, batch_first=True)
+        if gt_boxes_padded.shape[1] == 0:
+            # 整个batch都没有gt, pad出一个无效的gt, 所有proposal都会被划分为背景
+            gt_boxes_padded = gt_boxes_padded.new_zeros((num_images, 1, 4))
+            gt_labels_padded = gt_labels_padded.new_zeros((num_images, 1))
+
+        num_proposals = torch.as_tensor([p.shape[0] for p in proposals], device=device)
+        num_gt = torch.as_tensor([g.shape[0] for g in gt_boxes], device=device)
+        width = proposals_padded.shape[1]
+        proposal_valid = torch.lt(torch.arange(width, device=device)[None, :], num_proposals[:, None])
+        gt_valid = torch.lt(torch.arange(gt_boxes_padded.shape[1], device=device)[None, :], num_gt[:, None])
+
+        matched_idxs, labels = self.assign_targets_to_proposals_batched(
+            proposals_padded, proposal_valid, gt_boxes_padded, gt_labels_padded, gt_valid)
+
+        #----------------------------------------------------#
+        #   按给定数量和比例采样正负样本, 按(图像, 索引)排序
+        #----------------------------------------------------#
+        pos_img, pos_idx, neg_img, neg_idx = self.fg_bg_sampler.sample_padded(labels)
+        img = torch.cat([pos_img, neg_img])
+        idx = torch.cat([pos_idx, neg_idx])
+        order = torch.argsort(img * width + idx)
+        img, idx = img[order], idx[order]
+
+        sampled_proposals = proposals_padded[img, idx]
+        sampled_labels = labels[img, idx]
+        sampled_matched_idxs = matched_idxs[img, idx]
+
+        #----------------------------------------------------#
+        #   一次计算所有样本的边框回归参数
+        #----------------------------------------------------#
+        matched_gt_boxes = gt_boxes_padded[img, sampled_matched_idxs]
+        regression_targets = self.box_coder.encode_single(matched_gt_boxes, sampled_proposals)
+
+        num_per_image = torch.bincount(img, minlength=num_images).tolist()
+        return (list(sampled_proposals.split(num_per_image)),
+                list(sampled_matched_idxs.split(num_per_image)),
+                list(sampled_labels.split(num_per_image)),
+                list(regression_targets.split(num_per_image)))
+
     #----------------------------------------------------#
     #   检测后,预测结果后处理,删除低概率目标,nms处理等
     #----------------------------------------------------#
@@ -324,11 +466,11 @@ class RoIHeads(torch.nn.Module):
         # type: (...) -> Tuple[List[Tensor], List[Tensor], List[Tensor]]
         """
         对网络的预测数据进行后处理，包括
-        （1）根据proposal以及预测的回归参数计算出最终bbox坐标
-        （2）对预测类别结果进行softmax处理
-        （3）裁剪预测的boxes信息，将越界的坐标调整到图片边界上
-        （4）移除所有背景信息
-        （5）移除低概率目标
+        （1）对预测类别结果进行softmax处理
+        （2）移除所有背景信息
+        （3）移除低概率目标
+        （4）只对剩下的(proposal, 类别)根据proposal以及预测的回归参数计算出最终bbox坐标
+        （5）裁剪预测的boxes信息，将越界的坐标调整到图片边界上
         （6）移除小尺寸目标
         （7）执行nms处理，并按scores进行排序
         （8）根据scores排序返回前topk个目标
@@ -341,7 +483,6 @@ class RoIHeads(torch.nn.Module):
         Returns:
 
         """
-        device = class_logits.device
         #----------------------------------------------------#
         #   预测目标类别数
         #----------------------------------------------------#
@@ -351,10 +492,6 @@ class RoIHeads(torch.nn.Module):
         #   获取每张图像的预测bbox proposal数量,每个图片生成1000个proposal
         #----------------------------------------------------#
         boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
-        #----------------------------------------------------#
-        #   根据proposal以及预测的回归参数计算出最终bbox坐标
-        #----------------------------------------------------#
-        pred_boxes = self.box_coder.decode(box_regression, proposals)
 
         #----------------------------------------------------#
         #   对预测类别结果进行softmax处理
@@ -362,46 +499,36 @@ class RoIHeads(torch.nn.Module):
         pred_scores = F.softmax(class_logits, -1)
 
         #----------------------------------------------------#
-        #   split boxes and scores per image
+        #   split scores and regression parameters per image
         #   根据每张图像的预测bbox数量分割结果
+        #   [N, num_classes * 4] -> [N, num_classes, 4]
         #----------------------------------------------------#
-        pred_boxes_list = pred_boxes.split(boxes_per_image, 0)
         pred_scores_list = pred_scores.split(boxes_per_image, 0)
+        box_regression_list = box_regression.reshape(-1, num_classes, 4).split(boxes_per_image, 0)
 
         all_boxes = []
         all_scores = []
         all_labels = []
         # 遍历每张图像预测信息
-        for boxes, scores, image_shape in zip(pred_boxes_list, pred_scores_list, image_shapes):
-            #----------------------------------------------------#
-            #   裁剪预测的boxes信息，将越界的坐标调整到图片边界上
-            #----------------------------------------------------#
-            boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
-
-            # 为每个预测创建标签
-            labels = torch.arange(num_classes, device=device)
-            labels = labels.view(1, -1).expand_as(scores)   # 添加新维度并扩充大小
-
+        for scores, rel_codes, proposals_in_image, image_shape in zip(pred_scores_list, box_regression_list,
+                                                                        proposals, image_shapes):
             #----------------------------------------------------#
             #   移除索引为0的所有信息（0代表背景）
-            #   0 1 2 ...
+            #   移除低概率目标，self.scores_thresh=0.05,概率大于0.05的(proposal, 类别)索引
+            #   按行优先的顺序返回, 与先展平成[N * (num_classes - 1)]再筛选的顺序相同
             #----------------------------------------------------#
-            boxes = boxes[:, 1:]
             scores = scores[:, 1:]
-            labels = labels[:, 1:]
-
-            # batch everything, by making every class prediction be a separate instance
-            boxes = boxes.reshape(-1, 4)
-            scores = scores.reshape(-1)
-            labels = labels.reshape(-1)
+            proposal_inds, class_inds = torch.where(torch.gt(scores, self.score_thresh))
+            scores = scores[proposal_inds, class_inds]
+            labels = class_inds + 1
 
             #----------------------------------------------------#
-            #   移除低概率目标，self.scores_thresh=0.05,概率大于0.05的索引
+            #   只对保留下来的(proposal, 类别)计算最终bbox坐标,
+            #   不需要对所有proposal的所有类别decode, 计算量和显存占用与类别数无关
+            #   裁剪预测的boxes信息，将越界的坐标调整到图片边界上
             #----------------------------------------------------#
-            # gt: Computes input > other element-wise.
-            # inds = torch.nonzero(torch.gt(scores, self.score_thresh)).squeeze(1)
-            inds = torch.where(torch.gt(scores, self.score_thresh))[0]
-            boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+            boxes = self.box_coder.decode_single(rel_codes[proposal_inds, labels], proposals_in_image[proposal_inds])
+            boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
 
             #----------------------------------------------------#
             # 移除小目标
@@ -409,15 +536,27 @@ class RoIHeads(torch.nn.Module):
             keep = box_ops.remove_small_boxes(boxes, min_size=1.)
             boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
 
-            #----------------------------------------------------#
-            # 执行nms处理，执行后的结果会按照scores从大到小进行排序返回
-            #----------------------------------------------------#
-            keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
+            if self.nms_method == "matrix":
+                #----------------------------------------------------#
+                # Matrix NMS, 返回衰减后的分数, 结果按照衰减后的scores从大到小排序
+                #----------------------------------------------------#
+                keep, scores = box_ops.matrix_nms(boxes, scores, labels,
+                                                  kernel=self.matrix_nms_kernel,
+                                                  sigma=self.matrix_nms_sigma,
+                                                  score_threshold=self.score_thresh,
+                                                  max_candidates=self.matrix_nms_pre_top_n)
+                keep, scores = keep[:self.detection_per_img], scores[:self.detection_per_img]
+                boxes, labels = boxes[keep], labels[keep]
+            else:
+                #----------------------------------------------------#
+                # 执行nms处理，执行后的结果会按照scores从大到小进行排序返回
+                #----------------------------------------------------#
+                keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
 
-            # keep only topk scoring predictions
-            # 获取scores排在前topk个预测目标
-            keep = keep[:self.detection_per_img]
-            boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+                # keep only topk scoring predictions
+                # 获取scores排在前topk个预测目标
+                keep = keep[:self.detection_per_img]
+                boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
 
             all_boxes.append(boxes)
             all_scores.append(scores)
@@ -0,0 +1,125 @@
+#---------------------------------------------#
+#   高分辨率图像的分块(tile)推理
+#---------------------------------------------#
+
+import math
+from typing import List, Tuple, Dict
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from . import boxes as box_ops
+
+
+def get_tile_starts(length, tile_size, overlap):
+    # type: (int, int, int) -> List[int]
+    """
+    计算一个方向上每个tile的起始坐标
+    tile均匀分布, 第一个和最后一个tile分别与图像两侧对齐, 相邻tile至少重叠overlap个像素
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    num_tiles = int(math.ceil((length - tile_size) / stride)) + 1
+    return [int(round(i * (length - tile_size) / (num_tiles - 1))) for i in range(num_tiles)]
+
+
+def get_tiles(height, width, tile_size, overlap):
+    # type: (int, int, Tuple[int, int], float) -> List[Tuple[int, int, int, int]]
+    """
+    Args:
+        height, width: 图像的高宽
+        tile_size: tile的(高, 宽)
+        overlap: 相邻tile重叠部分占tile边长的比例
+
+    Returns:
+        每个tile在原图中的位置(x1, y1, x2, y2)
+    """
+    tile_h, tile_w = tile_size
+    ys = get_tile_starts(height, tile_h, int(tile_h * overlap))
+    xs = get_tile_starts(width, tile_w, int(tile_w * overlap))
+    return [(x, y, min(x + tile_w, width), min(y + tile_h, height)) for y in ys for x in xs]
+
+
+#-----------------------------------------------------#
+#   将整张图像缩小到模型预处理时的尺寸
+#   在cpu上完成缩放, 不需要将原分辨率的图像拷贝到device上
+#-----------------------------------------------------#
+def _downscale_image(image, min_size, max_size):
+    # type: (Tensor, float, float) -> Tuple[Tensor, float]
+    height, width = image.shape[-2:]
+    scale = min(min_size / min(height, width), max_size / max(height, width))
+    if scale >= 1.:
+        return image, 1.
+    image = F.interpolate(image[None], scale_factor=scale, mode="bilinear",
+                          recompute_scale_factor=True, align_corners=False)[0]
+    # 使用实际缩放后的尺寸计算比例
+    return image, image.shape[-1] / width
+
+
+@torch.no_grad()
+def tiled_inference(model,
+                    image,                  # type: Tensor
+                    tile_size=(800, 800),   # type: Tuple[int, int]
+                    overlap=0.2,            # type: float
+                    batch_size=4,           # type: int
+                    iou_threshold=0.5,      # type: float
+                    full_image=True,        # type: bool
+                    detections_per_img=-1   # type: int
+                    ):
+    # type: (...) -> Dict[str, Tensor]
+    """
+    将高分辨率图像切分成相互重叠的tile, 以batch为单位送入模型预测,
+    再将每个tile的预测结果映射回原图坐标, 最后通过按类别的nms合并tile重叠处的重复目标
+    同一时刻只有batch_size个tile在device上, 显存占用与原图大小无关
+
+    Args:
+        model: eval模式下的FasterRCNN
+        image: [C, H, W] 没有标准化的图像, 可以放在cpu上, 每个tile会被单独拷贝到模型所在的device
+        tile_size: tile的(高, 宽), 建议与模型预处理的min_size相同, 这样tile不会被再次缩放
+        overlap: 相邻tile重叠部分占tile边长的比例, 应大于需要检测的目标的尺寸
+        batch_size: 每次送入模型的tile数量
+        iou_threshold: 合并时nms使用的iou阈值
+        full_image: 是否额外对缩小后的整张图像预测一次, 用于检测跨越多个tile的大目标
+        detections_per_img: 合并后最多保留的目标个数, 小于0表示不限制
+
+    Returns:
+        与FasterRCNN每张图像的输出相同: boxes(原图坐标), labels, scores
+    """
+    device = next(model.parameters()).device
+    height, width = image.shape[-2:]
+    tiles = get_tiles(height, width, tile_size, overlap)
+
+    all_boxes, all_scores, all_labels = [], [], []
+    for i in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[i:i + batch_size]
+        crops = [image[:, y1:y2, x1:x2].to(device) for x1, y1, x2, y2 in batch_tiles]
+        outputs = model(crops)
+        for (x1, y1, _, _), output in zip(batch_tiles, outputs):
+            # tile中的坐标加上tile左上角的坐标, 映射回原图
+            offset = torch.tensor([x1, y1, x1, y1], dtype=output["boxes"].dtype, device=device)
+            all_boxes.append(output["boxes"] + offset)
+            all_scores.append(output["scores"])
+            all_labels.append(output["labels"])
+
+    if full_image and len(tiles) > 1:
+        min_size = float(model.transform.min_size[-1])
+        max_size = float(model.transform.max_size)
+        small_image, scale = _downscale_image(image, min_size, max_size)
+        output = model([small_image.to(device)])[0]
+        all_boxes.append(output["boxes"] / scale)
+        all_scores.append(output["scores"])
+        all_labels.append(output["labels"])
+
+    boxes = torch.cat(all_boxes, dim=0)
+    scores = torch.cat(all_scores, dim=0)
+    labels = torch.cat(all_labels, dim=0)
+
+    #-----------------------------------------------------#
+    #   同一个目标可能在多个tile中被检测到, 按类别执行nms合并
+    #-----------------------------------------------------#
+    keep = box_ops.batched_nms(boxes, scores, labels, iou_threshold)
+    if detections_per_img >= 0:
+        keep = keep[:detections_per_img]
+    return {"boxes": boxes[keep], "labels": labels[keep], "scores": scores[keep]}
@@ -73,22 +73,49 @@ class GeneralizedRCNNTransform(nn.Module):
         self.max_size = max_size      # 指定图像的最大边长范围
         self.image_mean = image_mean  # 指定图像在标准化处理中的均值
         self.image_std = image_std    # 指定图像在标准化处理中的方差
+        # 缓存均值和方差, 不需要每次标准化时重新创建(不保存到state_dict中)
+        self.register_buffer("mean_tensor", torch.as_tensor(image_mean, dtype=torch.float32)[:, None, None],
+                             persistent=False)
+        self.register_buffer("std_tensor", torch.as_tensor(image_std, dtype=torch.float32)[:, None, None],
+                             persistent=False)
+        # 验证模式下重复使用的batch内存, 见_get_batch_buffer
+        self._batch_buffer = torch.jit.annotate(Optional[Tensor], None)
 
     #-----------------------------------------------------------------#
     #   标准化处理
     #-----------------------------------------------------------------#
     def normalize(self, image):
         """标准化处理"""
-        dtype, device = image.dtype, image.device
-        mean = torch.as_tensor(self.image_mean, dtype=dtype, device=device)
-        std = torch.as_tensor(self.image_std, dtype=dtype, device=device)
-
         #-----------------------------------------------------------------#
         #   减去均值除以方差
-        #   [:, None, None]: shape [3] -> [3, 1, 1] 转化为3维
+        #   mean, std: shape [3, 1, 1]
         #   image: [通道, 高度, 宽度]
         #-----------------------------------------------------------------#
-        return (image - mean[:, None, None]) / std[:, None, None]
+        mean, std = self._get_mean_std(image.dtype, image.device)
+        return (image - mean) / std
+
+    def _get_mean_std(self, dtype, device):
+        # type: (torch.dtype, torch.device) -> Tuple[Tensor, Tensor]
+        """返回缓存的均值和方差, dtype和device相同时to()不会产生拷贝"""
+        return self.mean_tensor.to(dtype=dtype, device=device), self.std_tensor.to(dtype=dtype, device=device)
+
+    def _get_batch_buffer(self, batch_shape, image):
+        # type: (List[int], Tensor) -> Tensor
+        """
+        获取batch_shape大小的tensor用于存放打包后的图像
+        验证模式下重复使用同一块内存(只有在需要更大的内存时才重新分配)
+        训练模式下反向传播还会用到网络的输入, 因此每次都重新分配
+        """
+        if self.training:
+            return image.new_empty(batch_shape)
+        numel = 1
+        for s in batch_shape:
+            numel *= s
+        buffer = self._batch_buffer
+        if buffer is None or buffer.numel() < numel or buffer.dtype != image.dtype or buffer.device != image.device:
+            buffer = image.new_empty([numel])
+            self._batch_buffer = buffer
+        return buffer[:numel].view(batch_shape)
 
     def torch_choice(self, k):
         # type: (List[int]) -> int
@@ -236,6 +263,47 @@ class GeneralizedRCNNTransform(nn.Module):
 
         return batched_imgs
 
+    #--------------------------------------------------------------------#
+    #   标准化并打包成一个batch
+    #--------------------------------------------------------------------#
+    def normalize_batch_images(self, images, size_divisible=32):
+        # type: (List[Tensor], int) -> Tensor
+        """
+        将resize后的一批图像标准化并打包成一个batch
+        标准化的结果直接写入padding后的batch中, 不需要先生成标准化后的图像再拷贝
+        Args:
+            images: resize后(还没有标准化)的一批图片
+            size_divisible: 将图像高和宽调整到该数的整数倍
+
+        Returns:
+            batched_imgs: 标准化并打包成一个batch后的tensor数据
+        """
+        if torchvision._is_tracing():
+            return self.batch_images([self.normalize(img) for img in images], size_divisible)
+
+        # 分别计算一个batch中所有图片中的最大channel, height, width
+        max_size = self.max_by_axis([list(img.shape) for img in images])
+
+        stride = float(size_divisible)
+        # 将height, width向上调整到stride的整数倍
+        max_size[1] = int(math.ceil(float(max_size[1]) / stride) * stride)
+        max_size[2] = int(math.ceil(float(max_size[2]) / stride) * stride)
+
+        # [batch, channel, height, width]
+        batch_shape = [len(images)] + max_size
+        batched_imgs = self._get_batch_buffer(batch_shape, images[0])
+        mean, std = self._get_mean_std(images[0].dtype, images[0].device)
+        for img, pad_img in zip(images, batched_imgs):
+            c, h, w = img.shape
+            # 对齐左上角写入标准化后的图像, 只将padding的部分置0(重复使用的内存中可能有上一个batch的数据)
+            valid = pad_img[:c, :h, :w]
+            torch.sub(img, mean, out=valid)
+            valid.div_(std)
+            pad_img[:, h:, :].zero_()
+            pad_img[:, :h, w:].zero_()
+
+        return batched_imgs
+
     #---------------------------------------#
     #   将预测结果映射到原图
     #---------------------------------------#
@@ -296,7 +364,7 @@ class GeneralizedRCNNTransform(nn.Module):
             if image.dim() != 3:
                 raise ValueError("images is expected to be a list of 3d tensors "
                                  "of shape [C, H, W], got {}".format(image.shape))
-            image = self.normalize(image)                           # 对图像进行标准化处理
+            # 先缩放再标准化(两者都是逐通道的线性变换, 结果相同), 标准化只需处理缩放后的图像
             image, target_index = self.resize(image, target_index)  # 对图像和对应的bboxes缩放到指定范围
             images[i] = image   # 替换图片
             if targets is not None and target_index is not None:
@@ -304,7 +372,7 @@ class GeneralizedRCNNTransform(nn.Module):
 
         # 记录resize后的图像尺寸
         image_sizes = [img.shape[-2:] for img in images]
-        images = self.batch_images(images)      # 将images打包成一个batch,图片大小一致
+        images = self.normalize_batch_images(images)  # 标准化并将images打包成一个batch,图片大小一致
 
         #---------------------------------------#
         #   创建ImageList 图片宽高 Tensor
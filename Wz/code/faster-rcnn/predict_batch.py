@@ -0,0 +1,192 @@
+"""
+该脚本用于对大量图像进行离线批量预测，结果以json lines格式保存(每行对应一张图像)
+图像的读取解码在后台线程池中进行(预取的数量有上限)，模型推理与结果写入相互重叠
+结束后打印images/s以及解码、推理、后处理、写入各部分的耗时
+python predict_batch.py --weights weights/fasterrcnn_voc2012.pth --inputs ./test_images --output results.jsonl
+--inputs可以是图像目录、glob表达式(需要加引号)或者每行一个图像路径的.txt文件，可以同时指定多个
+高分辨率图像可以通过--tile-size启用分块推理(每张图像的tile按--batch-size组成batch)
+"""
+import os
+import glob
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+from torchvision.transforms import functional as F
+
+from network_files import FasterRCNN
+from network_files.tiled_inference import tiled_inference
+from backbone import resnet50_fpn_backbone
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def create_model(num_classes, box_thresh):
+    # 注意，这里的norm_layer要和训练脚本中保持一致
+    backbone = resnet50_fpn_backbone(norm_layer=torch.nn.BatchNorm2d)
+    model = FasterRCNN(backbone=backbone, num_classes=num_classes, box_score_thresh=box_thresh)
+
+    return model
+
+
+def collect_images(inputs):
+    """
+    将输入的目录、glob表达式、.txt文件列表展开成图像路径列表
+    """
+    img_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            img_paths.extend(sorted(os.path.join(item, name) for name in os.listdir(item)
+                                    if name.lower().endswith(IMG_EXTENSIONS)))
+        elif item.endswith(".txt"):
+            with open(item) as f:
+                img_paths.extend(line.strip() for line in f if line.strip())
+        else:
+            img_paths.extend(sorted(glob.glob(item)))
+    return img_paths
+
+
+def load_image(img_path):
+    """在后台线程中执行: 读取解码图像并转为tensor, 返回解码耗时"""
+    t_start = time.time()
+    img = Image.open(img_path).convert('RGB')
+    img = F.to_tensor(img)
+    return img_path, img, time.time() - t_start
+
+
+def load_batches(img_paths, batch_size, num_workers, prefetch_batches, timer):
+    """
+    使用线程池预取图像并组成batch
+    同时处于读取中或已读取但还没被使用的图像最多为batch_size * prefetch_batches张，避免占用过多内存
+    读取失败的图像会被跳过
+    """
+    max_pending = batch_size * prefetch_batches
+    paths = iter(img_paths)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque(pool.submit(load_image, p) for _, p in zip(range(max_pending), paths))
+        batch = []
+        while len(pending) > 0:
+            t_start = time.time()
+            future = pending.popleft()
+            try:
+                img_path, img, decode_time = future.result()
+                batch.append((img_path, img))
+                timer["decode"] += decode_time
+            except Exception as e:
+                print("skip image: {}".format(e))
+            timer["wait_data"] += time.time() - t_start
+
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(pool.submit(load_image, next_path))
+
+            if len(batch) == batch_size or (len(pending) == 0 and len(batch) > 0):
+                yield batch
+                batch = []
+
+
+def write_results(f, records):
+    """在写入线程中执行"""
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    img_paths = collect_images(args.inputs)
+    assert len(img_paths) > 0, "no image found in {}".format(args.inputs)
+    print("{} images to predict.".format(len(img_paths)))
+
+    #---------------------------------------------------#
+    # create model
+    #---------------------------------------------------#
+    model = create_model(num_classes=args.num_classes + 1, box_thresh=args.box_thresh)
+    assert os.path.exists(args.weights), "{} file dose not exist.".format(args.weights)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu')["model"])
+    model.to(device)
+    model.eval()
+
+    timer = {"decode": 0., "wait_data": 0., "model": 0., "postprocess": 0., "wait_write": 0.}
+    num_images = 0
+    #---------------------------------------------------#
+    # 结果写入在单独的线程中进行，只保留有限个还未完成的写入任务
+    #---------------------------------------------------#
+    writes = deque()
+    with open(args.output, "w") as f, ThreadPoolExecutor(max_workers=1) as writer, torch.inference_mode():
+        t_begin = time_synchronized()
+        for batch in load_batches(img_paths, args.batch_size, args.num_workers, args.prefetch, timer):
+            batch_paths = [p for p, _ in batch]
+
+            t_start = time_synchronized()
+            if args.tile_size > 0:
+                # 原图保留在cpu上, 每个tile单独拷贝到device
+                outputs = [tiled_inference(model, img, tile_size=(args.tile_size, args.tile_size),
+                                           overlap=args.tile_overlap, batch_size=args.batch_size)
+                           for _, img in batch]
+            else:
+                images = [img.to(device, non_blocking=True) for _, img in batch]
+                outputs = model(images)
+            t_model = time_synchronized()
+
+            records = []
+            for img_path, output in zip(batch_paths, outputs):
+                output = {k: v.cpu() for k, v in output.items()}
+                records.append({"image": img_path,
+                                "boxes": output["boxes"].tolist(),
+                                "labels": output["labels"].tolist(),
+                                "scores": output["scores"].tolist()})
+            t_post = time.time()
+            timer["model"] += t_model - t_start
+            timer["postprocess"] += t_post - t_model
+
+            writes.append(writer.submit(write_results, f, records))
+            while len(writes) > args.prefetch:
+                writes.popleft().result()
+            timer["wait_write"] += time.time() - t_post
+            num_images += len(batch)
+
+        t_start = time.time()
+        for w in writes:
+            w.result()
+        timer["wait_write"] += time.time() - t_start
+        total_time = time_synchronized() - t_begin
+
+    print("{} images in {:.1f}s, {:.2f} images/s".format(num_images, total_time, num_images / total_time))
+    print("decode(sum of {} threads): {:.1f}s, wait for data: {:.1f}s, model: {:.1f}s, "
+          "postprocess: {:.1f}s, wait for write: {:.1f}s".format(
+           args.num_workers, timer["decode"], timer["wait_data"], timer["model"],
+           timer["postprocess"], timer["wait_write"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda:0', help='device')
+    parser.add_argument('--num-classes', default=20, type=int, help='number of classes(不包含背景)')
+    parser.add_argument('--weights', default='./weights/fasterrcnn_voc2012.pth', help='trained weights')
+    parser.add_argument('--inputs', nargs='+', required=True, help='image dirs, glob patterns or .txt image lists')
+    parser.add_argument('--output', default='predict_results.jsonl', help='json lines file to save results')
+    parser.add_argument('--batch-size', default=4, type=int, help='number of images per inference')
+    parser.add_argument('--num-workers', default=4, type=int, help='number of image decoding threads')
+    parser.add_argument('--prefetch', default=2, type=int, help='max number of batches being prefetched')
+    parser.add_argument('--box-thresh', default=0.5, type=float, help='min score of saved boxes')
+
+    parser.add_argument('--tile-size', default=0, type=int,
+                        help='tile size for sliced inference of high resolution images, 0 to disable')
+    parser.add_argument('--tile-overlap', default=0.2, type=float, help='overlap ratio between adjacent tiles')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -64,7 +64,9 @@ def main(args):
 
     # load train data set
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> train.txt
-    train_dataset = VOCDataSet(VOC_root, "2012", data_transform["train"], "train.txt")
+    # 指定--draft-decode时JPEG直接解码到接近模型输入的尺寸(与FasterRCNN默认的min_size, max_size一致)
+    draft_size = (800, 1333) if args.draft_decode else None
+    train_dataset = VOCDataSet(VOC_root, "2012", data_transform["train"], "train.txt", draft_size=draft_size)
 
     # load validation data set
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> val.txt
@@ -256,6 +258,8 @@ if __name__ == "__main__":
     parser.add_argument("--sync-bn", dest="sync_bn", help="Use sync batch norm", type=bool, default=False)
     # 是否使用混合精度训练(需要GPU支持混合精度)
     parser.add_argument("--amp", default=False, help="Use torch.cuda.amp for mixed precision training")
+    # 训练集的JPEG图像是否在解码时直接缩小(PIL draft)，大图可以大幅减少数据读取时间
+    parser.add_argument("--draft-decode", action="store_true", help="decode training JPEGs at reduced scale")
 
     args = parser.parse_args()
 
@@ -60,7 +60,9 @@ def main(args):
 
     # load train data set
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> train.txt
-    train_dataset = VOCDataSet(VOC_root, "2012", data_transform["train"], "train.txt")
+    # 指定--draft-decode时JPEG直接解码到接近模型输入的尺寸(与FasterRCNN默认的min_size, max_size一致)
+    draft_size = (800, 1333) if args.draft_decode else None
+    train_dataset = VOCDataSet(VOC_root, "2012", data_transform["train"], "train.txt", draft_size=draft_size)
     train_sampler = None
 
     # 是否按图片相似高宽比采样图片组成batch
@@ -219,6 +221,8 @@ if __name__ == "__main__":
     parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
     # 是否使用混合精度训练(需要GPU支持混合精度)
     parser.add_argument("--amp", default=False, help="Use torch.cuda.amp for mixed precision training")
+    # 训练集的JPEG图像是否在解码时直接缩小(PIL draft)，大图可以大幅减少数据读取时间
+    parser.add_argument("--draft-decode", action="store_true", help="decode training JPEGs at reduced scale")
 
     args = parser.parse_args()
     print(args)
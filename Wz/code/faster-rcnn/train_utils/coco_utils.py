@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torchvision
 import torch.utils.data
@@ -52,3 +54,23 @@ def get_coco_api_from_dataset(dataset):
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
     return convert_to_coco_api(dataset)
+
+
+def draft_jpeg(image, size):
+    """
+    通过PIL的draft在JPEG解码时直接在DCT域缩小到原图的1/2, 1/4或1/8，不需要先解码完整的图像再缩放
+    :param image: Image.open得到的还没有解码(load)的图像
+    :param size: 需要的最小(宽, 高)，缩小后的图像宽高都不会小于size
+    :return: 宽高方向实际的缩放比例，非JPEG图像或者不需要缩小时返回(1., 1.)
+    """
+    if image.format != "JPEG":
+        return 1., 1.
+    width, height = image.size
+    image.draft("RGB", size)
+    return image.size[0] / width, image.size[1] / height
+
+
+def get_draft_size(width, height, min_size, max_size):
+    """与GeneralizedRCNNTransform.resize相同的缩放比例，计算模型实际需要的图像尺寸"""
+    scale = min(min_size / min(width, height), max_size / max(width, height))
+    return int(math.ceil(width * scale)), int(math.ceil(height * scale))
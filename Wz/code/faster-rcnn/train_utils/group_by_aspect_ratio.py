@@ -33,8 +33,11 @@ class GroupedBatchSampler(BatchSampler):
             The group ids must be a continuous set of integers starting from
             0, i.e. they must be in the range [0, num_groups).
         batch_size (int): Size of mini-batch.
+        fill_incomplete (bool): 为True时, 每个组中剩余不足batch_size的样本会重复该组的样本补齐, 并且batch的数量
+            固定为len(sampler) // batch_size(部分样本可能不会被采样到), 用于训练;
+            为False时, 每个组中剩余的样本直接组成一个较小的batch, 每个样本恰好出现一次, 用于验证
     """
-    def __init__(self, sampler, group_ids, batch_size):
+    def __init__(self, sampler, group_ids, batch_size, fill_incomplete=True):
         if not isinstance(sampler, Sampler):
             raise ValueError(
                 "sampler should be an instance of "
@@ -43,6 +46,7 @@ class GroupedBatchSampler(BatchSampler):
         self.sampler = sampler
         self.group_ids = group_ids
         self.batch_size = batch_size
+        self.fill_incomplete = fill_incomplete
 
     def __iter__(self):
         buffer_per_group = defaultdict(list)
@@ -59,6 +63,13 @@ class GroupedBatchSampler(BatchSampler):
                 del buffer_per_group[group_id]
             assert len(buffer_per_group[group_id]) < self.batch_size
 
+        if not self.fill_incomplete:
+            # 每个组剩余的样本组成一个较小的batch
+            for group_id in sorted(buffer_per_group.keys()):
+                if len(buffer_per_group[group_id]) > 0:
+                    yield buffer_per_group[group_id]
+            return
+
         # now we have run out of elements that satisfy
         # the group criteria, let's return the remaining
         # elements so that the size of the sampler is
@@ -81,6 +92,11 @@ class GroupedBatchSampler(BatchSampler):
         assert num_remaining == 0
 
     def __len__(self):
+        if not self.fill_incomplete:
+            counts = defaultdict(int)
+            for idx in self.sampler:
+                counts[self.group_ids[idx]] += 1
+            return sum(math.ceil(c / self.batch_size) for c in counts.values())
         return len(self.sampler) // self.batch_size
 
 
@@ -5,6 +5,7 @@
 
 import os
 import json
+import time
 
 import torch
 from tqdm import tqdm
@@ -14,7 +15,7 @@ import transforms
 from network_files import FasterRCNN
 from backbone import resnet50_fpn_backbone
 from my_dataset import VOCDataSet
-from train_utils import get_coco_api_from_dataset, CocoEvaluator
+from train_utils import get_coco_api_from_dataset, CocoEvaluator, GroupedBatchSampler, create_aspect_ratio_groups
 
 
 def summarize(self, catId=None):
@@ -89,6 +90,28 @@ def summarize(self, catId=None):
     return stats, print_info
 
 
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def register_padding_hook(model):
+    """
+    统计GeneralizedRCNNTransform打包后的batch中有效像素(resize后图像)所占的比例
+    返回的字典会在每次前向传播时更新
+    """
+    padding_stats = {"valid": 0, "total": 0}
+
+    def hook(module, inputs, outputs):
+        image_list = outputs[0]
+        batch, _, height, width = image_list.tensors.shape
+        padding_stats["total"] += batch * height * width
+        padding_stats["valid"] += sum(h * w for h, w in image_list.image_sizes)
+
+    model.transform.register_forward_hook(hook)
+    return padding_stats
+
+
 def main(parser_data):
     device = torch.device(parser_data.device if torch.cuda.is_available() else "cpu")
     print("Using {} device training.".format(device.type))
@@ -117,17 +140,31 @@ def main(parser_data):
 
     # load validation data set
     val_dataset = VOCDataSet(VOC_root, "2012", data_transform["val"], "val.txt")
-    val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
-                                                     batch_size=1,
-                                                     shuffle=False,
-                                                     num_workers=nw,
-                                                     pin_memory=True,
-                                                     collate_fn=val_dataset.collate_fn)
+    # 按图片高宽比分组组成batch, 使一个batch中图片的尺寸接近, 减少padding
+    # 每张图片恰好被验证一次, COCO指标与batch_size=1时相同(padding带来的数值误差除外)
+    if batch_size > 1 and parser_data.aspect_ratio_group_factor >= 0:
+        val_sampler = torch.utils.data.SequentialSampler(val_dataset)
+        # 统计所有图像高宽比例在bins区间中的位置索引
+        group_ids = create_aspect_ratio_groups(val_dataset, k=parser_data.aspect_ratio_group_factor)
+        val_batch_sampler = GroupedBatchSampler(val_sampler, group_ids, batch_size, fill_incomplete=False)
+        val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
+                                                         batch_sampler=val_batch_sampler,
+                                                         num_workers=nw,
+                                                         pin_memory=True,
+                                                         collate_fn=val_dataset.collate_fn)
+    else:
+        val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
+                                                         batch_size=batch_size,
+                                                         shuffle=False,
+                                                         num_workers=nw,
+                                                         pin_memory=True,
+                                                         collate_fn=val_dataset.collate_fn)
 
     # create model num_classes equal background + 20 classes
     # 注意，这里的norm_layer要和训练脚本中保持一致
     backbone = resnet50_fpn_backbone(norm_layer=torch.nn.BatchNorm2d)
-    model = FasterRCNN(backbone=backbone, num_classes=parser_data.num_classes + 1)
+    model = FasterRCNN(backbone=backbone, num_classes=parser_data.num_classes + 1,
+                       box_nms_method=parser_data.nms_method)
 
     # 载入你自己训练好的模型权重
     weights_path = parser_data.weights_path
@@ -136,6 +173,7 @@ def main(parser_data):
     # print(model)
 
     model.to(device)
+    padding_stats = register_padding_hook(model)
 
     # evaluate on the test dataset
     coco = get_coco_api_from_dataset(val_dataset)
@@ -144,13 +182,17 @@ def main(parser_data):
     cpu_device = torch.device("cpu")
 
     model.eval()
+    infer_time, num_images = 0., 0
     with torch.inference_mode():
         for image, targets in tqdm(val_dataset_loader, desc="validation..."):
             # 将图片传入指定设备device
             image = list(img.to(device) for img in image)
 
-            # inference
+            # inference(包括后处理中的nms)
+            t_start = time_synchronized()
             outputs = model(image)
+            infer_time += time_synchronized() - t_start
+            num_images += len(image)
 
             outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
             res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
@@ -175,9 +217,20 @@ def main(parser_data):
     print_voc = "\n".join(voc_map_info_list)
     print(print_voc)
 
+    print_time = "nms method: {}, inference time(include postprocess): {:.1f}ms/image".format(
+        parser_data.nms_method, infer_time / max(num_images, 1) * 1000)
+    print(print_time)
+
+    print_padding = "batch size: {}, padding efficiency(valid pixels / batch pixels): {:.1%}".format(
+        batch_size, padding_stats["valid"] / max(padding_stats["total"], 1))
+    print(print_padding)
+
     # 将验证结果保存至txt文件中
     with open("record_mAP.txt", "w") as f:
-        record_lines = ["COCO results:",
+        record_lines = [print_time,
+                        print_padding,
+                        "",
+                        "COCO results:",
                         print_coco,
                         "",
                         "mAP(IoU=0.5) for each category:",
@@ -207,6 +260,12 @@ if __name__ == "__main__":
     parser.add_argument('--batch_size', default=1, type=int, metavar='N',
                         help='batch size when validation.')
 
+    # 后处理使用的nms方法: nms(贪心nms)或matrix(Matrix NMS), 分别验证后可以对比mAP和推理时间
+    parser.add_argument('--nms-method', default='nms', choices=['nms', 'matrix'], help='nms method')
+
+    # 验证时按图片高宽比分组组成batch(batch_size > 1时生效), 小于0表示不分组
+    parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
+
     args = parser.parse_args()
 
     main(args)
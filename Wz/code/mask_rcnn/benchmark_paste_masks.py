@@ -0,0 +1,89 @@
+"""
+该脚本用于比较后处理中逐个目标粘贴mask(原先的实现)与按chunk批量粘贴(paste_masks_in_image)的速度，
+并检查两者的结果是否一致，以及输出二值mask时结果占用的内存
+python benchmark_paste_masks.py --num-masks 10 50 100 --chunk-sizes 1 16 64
+"""
+
+import time
+import argparse
+
+import torch
+
+from network_files.transform import paste_masks_in_image, paste_mask_in_image, expand_masks, expand_boxes
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def loop_paste(masks, boxes, img_shape, padding=1):
+    """原先的实现: 逐个目标缩放mask并粘贴到原图大小的全零tensor中"""
+    masks, scale = expand_masks(masks, padding=padding)
+    boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
+    im_h, im_w = img_shape
+    res = [paste_mask_in_image(m[0], b, im_h, im_w) for m, b in zip(masks, boxes)]
+    if len(res) > 0:
+        return torch.stack(res, dim=0)[:, None]
+    return masks.new_empty((0, 1, im_h, im_w))
+
+
+def random_inputs(num_masks, image_size, device):
+    """随机生成mask分支输出的概率以及原图尺度上的boxes(部分boxes超出图像边界)"""
+    height, width = image_size
+    masks = torch.rand(num_masks, 1, 28, 28, device=device)
+    ctr = torch.rand(num_masks, 2, device=device) * torch.tensor([width, height], device=device)
+    wh = torch.rand(num_masks, 2, device=device) * 400 + 4
+    boxes = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1)
+    return masks, boxes
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    image_size = (args.image_size[0], args.image_size[1])
+
+    print("{:>9} | {:>10} | {:>10} | {:>12} | {:>8} | {:>10} | {:>14}".format(
+        "num_masks", "chunk_size", "loop(ms)", "batched(ms)", "speedup", "same", "bool masks(MB)"))
+    with torch.no_grad():
+        for num_masks in args.num_masks:
+            masks, boxes = random_inputs(num_masks, image_size, device)
+            ref = loop_paste(masks, boxes, image_size)
+            t_loop = benchmark(lambda: loop_paste(masks, boxes, image_size), args.repeats)
+            for chunk_size in args.chunk_sizes:
+                res = paste_masks_in_image(masks, boxes, image_size, chunk_size=chunk_size)
+                same = ref.shape == res.shape and torch.allclose(ref, res, atol=1e-5)
+                t_batched = benchmark(lambda: paste_masks_in_image(masks, boxes, image_size, chunk_size=chunk_size,
+                                                                   mask_thresh=args.mask_thresh),
+                                      args.repeats)
+                binary = paste_masks_in_image(masks, boxes, image_size, chunk_size=chunk_size,
+                                              mask_thresh=args.mask_thresh)
+                size_mb = binary.numel() * binary.element_size() / 1024 ** 2
+                print("{:>9} | {:>10} | {:>10.2f} | {:>12.2f} | {:>7.2f}x | {:>10} | {:>14.1f}".format(
+                    num_masks, chunk_size, t_loop * 1000, t_batched * 1000, t_loop / t_batched, same, size_mb))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--num-masks', default=[10, 50, 100], type=int, nargs='+', help='number of masks to test')
+    parser.add_argument('--chunk-sizes', default=[1, 16, 64], type=int, nargs='+', help='chunk sizes to test')
+    parser.add_argument('--image-size', default=[800, 1333], type=int, nargs=2, help='original image (h, w)')
+    parser.add_argument('--mask-thresh', default=0.5, type=float, help='threshold of the binary masks')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed runs per case')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,115 @@
+"""
+该脚本用于在COCO的多边形标注上比较mask损失的两种gt_mask生成方式:
+先生成原图大小的mask再roi_align(convert_coco_poly_mask + project_masks_on_boxes, 默认的实现)
+与直接在每个Proposal的MxM网格上对多边形采样(convert_coco_poly_to_tensors + project_polygons_on_boxes, --lazy-masks)，
+统计两者gt_mask的差异(平均/最大绝对误差, 以0.5二值化后的IoU)以及各自的耗时
+python benchmark_polygon_mask_targets.py --data-path /data/coco2017 --num-images 200
+"""
+
+import os
+import time
+import argparse
+
+import torch
+from pycocotools.coco import COCO
+
+from train_utils import convert_coco_poly_mask, convert_coco_poly_to_tensors
+from network_files.roi_head import project_masks_on_boxes, project_polygons_on_boxes
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def load_polygon_annotations(coco, img_id):
+    """读取一张图像中所有多边形格式(非crowd)的标注, 返回多边形、xyxy格式的boxes以及图像的宽高"""
+    img_info = coco.loadImgs(img_id)[0]
+    anns = coco.loadAnns(coco.getAnnIds(imgIds=img_id, iscrowd=False))
+    anns = [obj for obj in anns if isinstance(obj["segmentation"], list) and obj["bbox"][2] > 1 and obj["bbox"][3] > 1]
+    segmentations = [obj["segmentation"] for obj in anns]
+    boxes = torch.as_tensor([obj["bbox"] for obj in anns], dtype=torch.float32).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    return segmentations, boxes, img_info["height"], img_info["width"]
+
+
+def random_proposals(gt_boxes, num_per_gt):
+    """在每个gt box附近随机生成正样本proposals, 返回proposals以及匹配到的gt索引"""
+    matched_idxs = torch.arange(gt_boxes.shape[0], device=gt_boxes.device).repeat_interleave(num_per_gt)
+    boxes = gt_boxes[matched_idxs]
+    wh = (boxes[:, 2:] - boxes[:, :2]).repeat(1, 2)
+    boxes = boxes + torch.randn_like(boxes) * wh * 0.1
+    return boxes, matched_idxs
+
+
+def compare(dense, lazy):
+    """返回绝对误差之和、最大绝对误差、元素个数以及以0.5二值化后的交集与并集"""
+    diff = (dense - lazy).abs()
+    dense_bin, lazy_bin = dense >= 0.5, lazy >= 0.5
+    return (float(diff.sum()), float(diff.max()), diff.numel(),
+            int((dense_bin & lazy_bin).sum()), int((dense_bin | lazy_bin).sum()))
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    coco = COCO(os.path.join(args.data_path, "annotations", "instances_{}2017.json".format(args.dataset)))
+
+    t_dense, t_lazy = 0., 0.
+    diff_sum, diff_max, num_elements, inter, union = 0., 0., 0, 0, 0
+    num_images, num_rois = 0, 0
+    with torch.no_grad():
+        for img_id in sorted(coco.imgs.keys()):
+            segmentations, gt_boxes, height, width = load_polygon_annotations(coco, img_id)
+            if len(segmentations) == 0:
+                continue
+            proposals, matched_idxs = random_proposals(gt_boxes.to(device), args.num_rois_per_gt)
+
+            t_start = time_synchronized()
+            masks = convert_coco_poly_mask(segmentations, height, width).to(device)
+            dense = project_masks_on_boxes(masks, proposals, matched_idxs, args.mask_size)
+            t_mid = time_synchronized()
+            polygons, polygon_lengths, polygon_instances = \
+                [t.to(device) for t in convert_coco_poly_to_tensors(segmentations)]
+            lazy = project_polygons_on_boxes(polygons, polygon_lengths, polygon_instances,
+                                             proposals, matched_idxs, args.mask_size)
+            t_end = time_synchronized()
+            t_dense += t_mid - t_start
+            t_lazy += t_end - t_mid
+
+            s, m, n, i, u = compare(dense, lazy)
+            diff_sum += s
+            diff_max = max(diff_max, m)
+            num_elements += n
+            inter += i
+            union += u
+            num_images += 1
+            num_rois += proposals.shape[0]
+            if num_images == args.num_images:
+                break
+
+    print("{} images, {} rois, mask size {}".format(num_images, num_rois, args.mask_size))
+    print("{:>26} | {:>10}".format("", "value"))
+    print("{:>26} | {:>10.4f}".format("mean abs diff", diff_sum / max(num_elements, 1)))
+    print("{:>26} | {:>10.4f}".format("max abs diff", diff_max))
+    print("{:>26} | {:>10.4f}".format("IoU of binarized targets", inter / max(union, 1)))
+    print("{:>26} | {:>10.2f}".format("dense(ms/img)", t_dense / max(num_images, 1) * 1000))
+    print("{:>26} | {:>10.2f}".format("polygons(ms/img)", t_lazy / max(num_images, 1) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--data-path', default='/data/coco2017', help='dataset root')
+    parser.add_argument('--dataset', default='val', choices=['train', 'val'], help='which annotation file to use')
+    parser.add_argument('--num-images', default=200, type=int, help='number of images to compare')
+    parser.add_argument('--num-rois-per-gt', default=8, type=int, help='number of jittered proposals per gt')
+    parser.add_argument('--mask-size', default=28, type=int, help='size of the mask targets (M)')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
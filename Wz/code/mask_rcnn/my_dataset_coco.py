@@ -6,6 +6,7 @@ from PIL import Image
 import torch.utils.data as data
 from pycocotools.coco import COCO
 from train_utils import coco_remove_images_without_annotations, convert_coco_poly_mask
+from train_utils import draft_jpeg, get_draft_size, convert_coco_poly_to_tensors
 
 
 class CocoDetection(data.Dataset):
@@ -16,9 +17,16 @@ class CocoDetection(data.Dataset):
         annFile (string): Path to json annotation file.
         transforms (callable, optional): A function/transform that takes input sample and its target as entry
             and returns a transformed version.
+        draft_size (tuple, optional): (min_size, max_size)，与模型的GeneralizedRCNNTransform相同。
+            指定后JPEG图像解码时直接缩小到不小于模型输入尺寸的1/2^n，boxes和masks会同步缩放。
+            返回的图像与原图尺寸不同，因此只建议在训练集上使用
+        lazy_masks (bool): 为True时target中不包含原图大小的masks，而是以多边形的形式保存
+            (polygons, polygon_lengths, polygon_instances)，翻转和缩放时直接变换多边形的坐标，
+            计算损失时才在每个正样本的MxM网格上生成mask，大幅减少每个样本的内存占用以及DataLoader进程间传输的数据量。
+            图像中有RLE格式的标注时仍然使用masks
     """
 
-    def __init__(self, root, dataset="train", transforms=None, years="2017"):
+    def __init__(self, root, dataset="train", transforms=None, years="2017", draft_size=None, lazy_masks=False):
         super(CocoDetection, self).__init__()
         assert dataset in ["train", "val"], 'dataset must be in ["train", "val"]'
         anno_file = f"instances_{dataset}{years}.json"
@@ -30,6 +38,8 @@ class CocoDetection(data.Dataset):
 
         self.mode = dataset
         self.transforms = transforms
+        self.draft_size = draft_size
+        self.lazy_masks = lazy_masks
         self.coco = COCO(self.anno_path)
 
         # 获取coco数据索引与类别名称的关系
@@ -63,7 +73,11 @@ class CocoDetection(data.Dataset):
                       img_id: int,
                       coco_targets: list,
                       w: int = None,
-                      h: int = None):
+                      h: int = None,
+                      scale=(1., 1.)):
+        """
+        w, h为原图的宽高, scale为图像解码时宽高方向的缩放比例, 返回的target对应缩放后的图像
+        """
         assert w > 0
         assert h > 0
 
@@ -86,20 +100,33 @@ class CocoDetection(data.Dataset):
         iscrowd = torch.tensor([obj["iscrowd"] for obj in anno])
 
         segmentations = [obj["segmentation"] for obj in anno]
-        masks = convert_coco_poly_mask(segmentations, h, w)
+        scale_x, scale_y = scale
+        if scale_x != 1. or scale_y != 1.:
+            # 直接缩放多边形的坐标, 在缩小后的尺寸上生成mask
+            segmentations = [[[c * scale_x if i % 2 == 0 else c * scale_y for i, c in enumerate(poly)]
+                              for poly in polygons] for polygons in segmentations]
+            boxes *= torch.tensor([scale_x, scale_y, scale_x, scale_y])
+            area = area * (scale_x * scale_y)
+            w, h = int(round(w * scale_x)), int(round(h * scale_y))
 
         # 筛选出合法的目标，即x_max>x_min且y_max>y_min
         keep = (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
         boxes = boxes[keep]
         classes = classes[keep]
-        masks = masks[keep]
         area = area[keep]
         iscrowd = iscrowd[keep]
 
+        polygons = None
+        if self.lazy_masks:
+            polygons = convert_coco_poly_to_tensors([s for s, k in zip(segmentations, keep.tolist()) if k])
+
         target = {}
         target["boxes"] = boxes
         target["labels"] = classes
-        target["masks"] = masks
+        if polygons is not None:
+            target["polygons"], target["polygon_lengths"], target["polygon_instances"] = polygons
+        else:
+            target["masks"] = convert_coco_poly_mask(segmentations, h, w)[keep]
         target["image_id"] = torch.tensor([img_id])
 
         # for conversion to coco api
@@ -122,10 +149,15 @@ class CocoDetection(data.Dataset):
         coco_target = coco.loadAnns(ann_ids)
 
         path = coco.loadImgs(img_id)[0]['file_name']
-        img = Image.open(os.path.join(self.img_root, path)).convert('RGB')
+        img = Image.open(os.path.join(self.img_root, path))
 
         w, h = img.size
-        target = self.parse_targets(img_id, coco_target, w, h)
+        scale = (1., 1.)
+        if self.draft_size is not None:
+            scale = draft_jpeg(img, get_draft_size(w, h, *self.draft_size))
+        img = img.convert('RGB')
+
+        target = self.parse_targets(img_id, coco_target, w, h, scale)
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
@@ -6,11 +6,16 @@ import numpy as np
 from PIL import Image
 import torch
 from torch.utils.data import Dataset
-from train_utils import convert_to_coco_api
+from train_utils import convert_to_coco_api, draft_jpeg, get_draft_size
 
 
 class VOCInstances(Dataset):
-    def __init__(self, voc_root, year="2012", txt_name: str = "train.txt", transforms=None):
+    def __init__(self, voc_root, year="2012", txt_name: str = "train.txt", transforms=None, draft_size=None):
+        """
+        draft_size: (min_size, max_size)，与模型的GeneralizedRCNNTransform相同，默认为None即解码完整的图像
+                    指定后JPEG图像解码时直接缩小到不小于模型输入尺寸的1/2^n，boxes和masks会同步缩放
+                    返回的图像与原图尺寸不同，因此只建议在训练集上使用
+        """
         super().__init__()
         if isinstance(year, int):
             year = str(year)
@@ -81,10 +86,15 @@ class VOCInstances(Dataset):
             self.masks.append(instances_mask)
 
         self.transforms = transforms
+        self.draft_size = draft_size
         self.coco = convert_to_coco_api(self)
 
-    def parse_mask(self, idx: int):
+    def parse_mask(self, idx: int, size=None):
+        """size: 需要缩放到的(宽, 高)，默认为None即原图尺寸"""
         mask = self.masks[idx]
+        if size is not None and size != (mask.shape[1], mask.shape[0]):
+            # 实例索引不能插值，使用最近邻缩放
+            mask = np.array(Image.fromarray(mask).resize(size, Image.NEAREST))
         c = mask.max()  # 有几个目标最大索引就等于几
         masks = []
         # 对每个目标的mask单独使用一个channel存放
@@ -101,9 +111,17 @@ class VOCInstances(Dataset):
         Returns:
             tuple: (image, target) where target is the image segmentation.
         """
-        img = Image.open(self.images_path[idx]).convert('RGB')
+        img = Image.open(self.images_path[idx])
         target = self.objects_bboxes[idx]
-        masks = self.parse_mask(idx)
+        if self.draft_size is not None:
+            w, h = img.size
+            scale_x, scale_y = draft_jpeg(img, get_draft_size(w, h, *self.draft_size))
+            # objects_bboxes是缓存的信息，不能原地修改
+            target = dict(target)
+            target["boxes"] = target["boxes"] * torch.tensor([scale_x, scale_y, scale_x, scale_y])
+            target["area"] = target["area"] * (scale_x * scale_y)
+        img = img.convert('RGB')
+        masks = self.parse_mask(idx, img.size)
         target["masks"] = masks
 
         if self.transforms is not None:
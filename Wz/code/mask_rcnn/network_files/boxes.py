@@ -3,6 +3,24 @@ from typing import Tuple
 from torch import Tensor
 import torchvision
 
+# torchvision的nms算子是否可用(只安装了python部分或者编译失败时不可用)
+def _has_torchvision_nms():
+    # type: () -> bool
+    try:
+        torch.ops.torchvision.nms
+    except (RuntimeError, AttributeError):
+        return False
+    return True
+
+
+_USE_TORCHVISION_NMS = _has_torchvision_nms()
+
+# batched_nms选择逐类别nms的条件, 可以用benchmark_batched_nms.py得到的结果调整
+# boxes.numel()超过对应设备的阈值, 并且平均每个类别的boxes不少于_BATCHED_NMS_MIN_BOXES_PER_CLASS个时逐类别执行nms
+# 否则所有类别一起使用偏移量的方法执行一次nms
+_BATCHED_NMS_LOOP_NUMEL = {"cpu": 4000, "cuda": 20000}
+_BATCHED_NMS_MIN_BOXES_PER_CLASS = 8
+
 
 def nms(boxes, scores, iou_threshold):
     # type: (Tensor, Tensor, float) -> Tensor
@@ -32,7 +50,33 @@ def nms(boxes, scores, iou_threshold):
         of the elements that have been kept
         by NMS, sorted in decreasing order of scores
     """
-    return torch.ops.torchvision.nms(boxes, scores, iou_threshold)
+    if _USE_TORCHVISION_NMS:
+        return torch.ops.torchvision.nms(boxes, scores, iou_threshold)
+    return _nms_vectorized(boxes, scores, iou_threshold)
+
+
+def _nms_vectorized(boxes, scores, iou_threshold):
+    # type: (Tensor, Tensor, float) -> Tensor
+    """
+    纯PyTorch实现的nms, torchvision的nms算子不可用时使用, 结果与torchvision.ops.nms相同
+    需要N x N的iou矩阵, 适合boxes数量不太多的情况
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    order = torch.argsort(scores, descending=True)
+    boxes = boxes[order]
+    # suppress[i, j]: 分数更高的第i个box与第j个box的iou大于阈值
+    suppress = torch.triu(torch.gt(box_iou(boxes, boxes), iou_threshold), diagonal=1)
+    # 贪心nms的结果满足: 第j个box被保留 <=> 不存在被保留的i < j与它重叠
+    # 从全部保留开始迭代, 第k次迭代后前k个box的结果一定正确, 不再变化时即为贪心nms的结果
+    # 一般只需要很少的几次迭代
+    keep = torch.ones(boxes.shape[0], dtype=torch.bool, device=boxes.device)
+    while True:
+        new_keep = torch.logical_not(torch.logical_and(suppress, keep[:, None]).any(dim=0))
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return order[keep]
 
 
 def batched_nms(boxes, scores, idxs, iou_threshold):
@@ -66,6 +110,31 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
     if boxes.numel() == 0:
         return torch.empty((0,), dtype=torch.int64, device=boxes.device)
 
+    # boxes很多时, 一次nms的计算量与N^2成正比, 而且偏移后的坐标很大会损失float精度
+    # 此时逐类别执行nms更快, 但类别很多、每个类别boxes很少时循环的开销更大
+    loop_numel = _BATCHED_NMS_LOOP_NUMEL["cpu" if boxes.device.type == "cpu" else "cuda"]
+    if boxes.numel() > loop_numel and not torchvision._is_tracing():
+        classes = torch.unique(idxs)
+        if boxes.shape[0] >= classes.numel() * _BATCHED_NMS_MIN_BOXES_PER_CLASS:
+            return _batched_nms_per_class(boxes, scores, idxs, classes, iou_threshold)
+    return _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold)
+
+
+def _batched_nms_per_class(boxes, scores, idxs, classes, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, Tensor, float) -> Tensor
+    """逐类别执行nms, 返回的索引按score降序排列"""
+    keep_mask = torch.zeros_like(scores, dtype=torch.bool)
+    for class_id in classes:
+        curr_indices = torch.where(torch.eq(idxs, class_id))[0]
+        curr_keep_indices = nms(boxes[curr_indices], scores[curr_indices], iou_threshold)
+        keep_mask[curr_indices[curr_keep_indices]] = True
+    keep_indices = torch.where(keep_mask)[0]
+    return keep_indices[scores[keep_indices].sort(descending=True)[1]]
+
+
+def _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, float) -> Tensor
+    """所有类别的boxes加上不同的偏移量后一起执行一次nms"""
     # strategy: in order to perform NMS independently per class.
     # we add an offset to all the boxes. The offset is dependent
     # only on the class idx, and is large enough so that boxes
@@ -83,6 +152,55 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
     return keep
 
 
+def matrix_nms(boxes, scores, idxs, kernel="gaussian", sigma=2.0, score_threshold=0.0, max_candidates=-1):
+    # type: (Tensor, Tensor, Tensor, str, float, float, int) -> Tuple[Tensor, Tensor]
+    """
+    Matrix NMS(SOLOv2): 不再逐个删除与高分box重叠的boxes, 而是根据每个box与所有更高分box的iou
+    一次矩阵运算得到它的分数衰减系数, 只在相同类别(idxs相同)的boxes之间衰减
+
+    Arguments:
+        boxes (Tensor[N, 4]): boxes in (x1, y1, x2, y2) format
+        scores (Tensor[N]): scores for each one of the boxes
+        idxs (Tensor[N]): indices of the categories for each one of the boxes
+        kernel (str): "gaussian" or "linear"
+        sigma (float): gaussian kernel的参数
+        score_threshold (float): 衰减后分数低于该值的boxes会被移除
+        max_candidates (int): 只对分数最高的max_candidates个boxes计算(iou矩阵为N x N), <= 0表示全部
+
+    Returns:
+        keep (Tensor): int64 tensor with the indices of the elements that have been kept,
+            sorted in decreasing order of decayed scores
+        scores (Tensor): decayed scores of the kept elements
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device), scores.new_empty((0,))
+
+    scores, order = scores.sort(descending=True)
+    if max_candidates > 0 and order.numel() > max_candidates:
+        scores, order = scores[:max_candidates], order[:max_candidates]
+    boxes, idxs = boxes[order], idxs[order]
+
+    # iou[i, j]: 分数更高的第i个box与第j个box的iou, 不同类别之间为0
+    # compensate_iou[i]: 第i个box与所有更高分box的最大iou, 即它自己被抑制的程度
+    same_class = torch.eq(idxs[:, None], idxs[None, :])
+    iou = torch.triu(box_iou(boxes, boxes) * same_class, diagonal=1)
+    compensate_iou = iou.max(dim=0)[0][:, None]
+
+    # decay[j] = min_i f(iou[i, j]) / f(compensate_iou[i])
+    # 分数最高的box的compensate_iou为0, 所以decay <= 1
+    if kernel == "gaussian":
+        decay = torch.exp(-sigma * (iou ** 2 - compensate_iou ** 2))
+    elif kernel == "linear":
+        decay = (1 - iou) / (1 - compensate_iou).clamp(min=1e-6)
+    else:
+        raise ValueError("kernel should be 'gaussian' or 'linear', got {}".format(kernel))
+    scores = scores * decay.min(dim=0)[0]
+
+    keep = torch.where(torch.ge(scores, score_threshold))[0]
+    scores, sort_inds = scores[keep].sort(descending=True)
+    return order[keep[sort_inds]], scores
+
+
 def remove_small_boxes(boxes, min_size):
     # type: (Tensor, float) -> Tensor
     """
@@ -179,3 +297,26 @@ def box_iou(boxes1, boxes2):
     iou = inter / (area1[:, None] + area2 - inter)
     return iou
 
+
+# box_iou的batch版本, 每张图像的boxes单独计算iou
+def batched_box_iou(boxes1, boxes2):
+    # type: (Tensor, Tensor) -> Tensor
+    """
+    Arguments:
+        boxes1 (Tensor[B, N, 4])
+        boxes2 (Tensor[B, M, 4])
+
+    Returns:
+        iou (Tensor[B, N, M]): 第b张图像中boxes1与boxes2两两之间的iou
+    """
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])  # [B, N]
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])  # [B, M]
+
+    lt = torch.max(boxes1[:, :, None, :2], boxes2[:, None, :, :2])  # left-top [B,N,M,2]
+    rb = torch.min(boxes1[:, :, None, 2:], boxes2[:, None, :, 2:])  # right-bottom [B,N,M,2]
+
+    wh = (rb - lt).clamp(min=0)  # [B,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [B,N,M]
+
+    iou = inter / (area1[:, :, None] + area2[:, None, :] - inter)
+    return iou
@@ -1,8 +1,10 @@
 import torch
 import math
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 from torch import Tensor
 
+from . import boxes as box_ops
+
 
 class BalancedPositiveNegativeSampler(object):
     """
@@ -83,6 +85,88 @@ class BalancedPositiveNegativeSampler(object):
 
         return pos_idx, neg_idx
 
+    def _sample_padded(self, matched_idxs):
+        # type: (List[Tensor]) -> Tuple[Tensor, Tensor, Tensor, Tensor, int]
+        """
+        对整个batch一次性采样正负样本, 不再逐张图像randperm以及创建mask
+        Returns:
+            pos_img, pos_idx: 选中的正样本所在的图像以及在该图像中的索引
+            neg_img, neg_idx: 选中的负样本所在的图像以及在该图像中的索引
+            width: pad后每张图像的元素个数
+        """
+        # 每张图像的元素个数可能不同(roi_heads), 用-1(忽略)pad到相同长度
+        labels = torch.nn.utils.rnn.pad_sequence(matched_idxs, batch_first=True, padding_value=-1)
+        pos_img, pos_idx, neg_img, neg_idx = self.sample_padded(labels)
+        return pos_img, pos_idx, neg_img, neg_idx, labels.shape[1]
+
+    def sample_padded(self, labels):
+        # type: (Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]
+        """
+        对已经pad好的整个batch采样正负样本
+        Arguments:
+            labels (Tensor[B, N]): -1为忽略(包括pad的元素), 0为负样本, >= 1为正样本
+
+        Returns:
+            pos_img, pos_idx: 选中的正样本所在的图像以及在该图像中的索引
+            neg_img, neg_idx: 选中的负样本所在的图像以及在该图像中的索引
+        """
+        width = labels.shape[1]
+
+        positive = torch.ge(labels, 1)
+        negative = torch.eq(labels, 0)
+
+        # 每张图像正负样本的数量, 与__call__中的计算方式相同
+        max_pos = int(self.batch_size_per_image * self.positive_fraction)
+        num_pos = positive.sum(dim=1).clamp(max=max_pos)
+        num_neg = torch.min(negative.sum(dim=1), self.batch_size_per_image - num_pos)
+
+        # 为每个元素生成随机key, 非候选元素的key置为-1
+        # topk后每行的前num_pos(num_neg)个即为随机选中的正(负)样本, 等价于randperm后取前n个
+        keys = torch.rand(labels.shape, device=labels.device)
+        pos_img, pos_idx = self._select_by_keys(keys.masked_fill(~positive, -1.), num_pos, min(max_pos, width))
+        neg_img, neg_idx = self._select_by_keys(keys.masked_fill_(~negative, -1.), num_neg,
+                                                min(self.batch_size_per_image, width))
+        return pos_img, pos_idx, neg_img, neg_idx
+
+    @staticmethod
+    def _select_by_keys(keys, num, k):
+        # type: (Tensor, Tensor, int) -> Tuple[Tensor, Tensor]
+        idx = keys.topk(k, dim=1)[1]  # [num_images, k]
+        valid = torch.lt(torch.arange(k, device=keys.device)[None, :], num[:, None])
+        img = torch.arange(keys.shape[0], device=keys.device)[:, None].expand_as(idx)
+        return img[valid], idx[valid]
+
+    def sample_indices(self, matched_idxs):
+        # type: (List[Tensor]) -> Tuple[Tensor, Tensor]
+        """
+        与__call__的采样比例相同, 但整个batch一起采样并直接返回索引
+        Arguments:
+            matched idxs: list of tensors containing -1, 0 or positive values.
+                Each tensor corresponds to a specific image.
+
+        Returns:
+            pos_inds (Tensor): 选中的正样本在torch.cat(matched_idxs)中的索引
+            neg_inds (Tensor): 选中的负样本在torch.cat(matched_idxs)中的索引
+        """
+        pos_img, pos_idx, neg_img, neg_idx, _ = self._sample_padded(matched_idxs)
+        # 每张图像在拼接后的起始位置
+        num_per_image = torch.as_tensor([m.shape[0] for m in matched_idxs], device=pos_idx.device)
+        offsets = num_per_image.cumsum(dim=0) - num_per_image
+        return pos_idx + offsets[pos_img], neg_idx + offsets[neg_img]
+
+    def sample_indices_per_image(self, matched_idxs):
+        # type: (List[Tensor]) -> List[Tensor]
+        """
+        与sample_indices相同, 但返回每张图像中选中的正负样本索引(升序)
+        """
+        pos_img, pos_idx, neg_img, neg_idx, width = self._sample_padded(matched_idxs)
+        # 按(图像, 索引)排序, 与原先torch.where(pos_mask | neg_mask)得到的顺序相同
+        img = torch.cat([pos_img, neg_img])
+        idx = torch.cat([pos_idx, neg_idx])
+        idx = idx[torch.argsort(img * width + idx)]
+        num_per_image = torch.bincount(img, minlength=len(matched_idxs))
+        return list(idx.split(num_per_image.tolist()))
+
 
 @torch.jit._script_if_tracing
 def encode_boxes(reference_boxes, proposals, weights):
@@ -137,6 +221,88 @@ def encode_boxes(reference_boxes, proposals, weights):
     return targets
 
 
+# 融合版本的encode/decode
+# 直接在输出buffer上原地计算, 不再逐列切片、unsqueeze、cat/stack
+# 每一步的运算顺序与encode_boxes以及原先逐列计算的decode相同, 结果完全一致
+@torch.jit._script_if_tracing
+def encode_boxes_fused(reference_boxes, proposals, weights, out=None):
+    # type: (Tensor, Tensor, Tensor, Optional[Tensor]) -> Tensor
+    """
+    与encode_boxes结果相同, 但除了输出以外只需要两个[N, 2]的临时变量
+
+    Arguments:
+        reference_boxes (Tensor[N, 4]): reference boxes(gt)
+        proposals (Tensor[N, 4]): boxes to be encoded(anchors)
+        weights (Tensor[4]): wx, wy, ww, wh
+        out (Tensor[N, 4], optional): 连续存储的输出buffer, 为None时新建
+    """
+    if out is None:
+        out = torch.empty_like(reference_boxes)
+    targets_ctr = out[:, :2]  # dx, dy
+    targets_wh = out[:, 2:]   # dw, dh
+
+    # anchors的宽高以及中心坐标
+    ex_wh = proposals[:, 2:] - proposals[:, :2]
+    ex_ctr = torch.mul(ex_wh, 0.5).add_(proposals[:, :2])
+
+    # 先在输出buffer中计算gt的宽高, 再得到gt中心坐标与anchors中心坐标的偏移
+    targets_wh.copy_(reference_boxes[:, 2:]).sub_(reference_boxes[:, :2])
+    targets_ctr.copy_(targets_wh).mul_(0.5).add_(reference_boxes[:, :2])
+    targets_ctr.sub_(ex_ctr).mul_(weights[:2]).div_(ex_wh)
+    targets_wh.div_(ex_wh).log_().mul_(weights[2:])
+    return out
+
+
+@torch.jit._script_if_tracing
+def decode_boxes_fused(rel_codes, boxes, weights, bbox_xform_clip, out=None):
+    # type: (Tensor, Tensor, Tensor, float, Optional[Tensor]) -> Tensor
+    """
+    与逐列(rel_codes[:, 0::4]等)计算的decode结果相同, 但除了输出以外只需要一个与输出一半大小的临时变量
+
+    Arguments:
+        rel_codes (Tensor[N, K * 4]): encoded boxes (bbox regression parameters)
+        boxes (Tensor[N, 4]): reference boxes (anchors/proposals)
+        weights (Tensor[4]): wx, wy, ww, wh
+        bbox_xform_clip (float): dw, dh的上限
+        out (Tensor[N, K * 4], optional): 连续存储的输出buffer, 为None时新建
+            指定out时总是原地计算, 不能用于需要梯度的输入
+    """
+    num_boxes = rel_codes.shape[0]
+    num_codes = rel_codes.shape[1] // 4
+    boxes = boxes.to(rel_codes.dtype)
+
+    # anchors/proposals的宽高以及中心坐标, [N, 1, 2]
+    wh = (boxes[:, 2:] - boxes[:, :2])[:, None]
+    ctr = torch.mul(wh, 0.5).add_(boxes[:, None, :2])
+
+    # 回归参数除以weights, 同时对dw, dh做clamp, 然后一起调整中心坐标和宽高
+    codes = rel_codes.reshape(num_boxes, num_codes, 4)
+    if out is None and torch.is_grad_enabled() and (rel_codes.requires_grad or boxes.requires_grad):
+        # 需要梯度时不能使用下面的原地操作(exp_的输出会在反向传播中用到), 逐步新建tensor
+        pred = codes / weights
+        pred_wh = torch.exp(pred[:, :, 2:].clamp(max=bbox_xform_clip)) * wh
+        pred_ctr = pred[:, :, :2] * wh + ctr
+        half_wh = pred_wh * 0.5
+        return torch.cat([pred_ctr - half_wh, pred_ctr + half_wh], dim=2).reshape(rel_codes.shape)
+
+    if out is None:
+        pred = codes / weights
+    else:
+        pred = out.view(num_boxes, num_codes, 4)
+        torch.div(codes, weights, out=pred)
+    pred_ctr = pred[:, :, :2]
+    pred_wh = pred[:, :, 2:]
+    pred_wh.clamp_(max=bbox_xform_clip).exp_().mul_(wh)
+    pred_ctr.mul_(wh).add_(ctr)
+
+    # 中心宽高 -> 左上右下
+    half_wh = pred_wh.mul(0.5)
+    pred_wh.copy_(pred_ctr).add_(half_wh)
+    pred_ctr.sub_(half_wh)
+    return pred.reshape(rel_codes.shape)
+
+
+
 class BoxCoder(object):
     """
     This class encodes and decodes a set of bounding boxes into
@@ -174,7 +340,8 @@ class BoxCoder(object):
         targets = self.encode_single(reference_boxes, proposals)
         return targets.split(boxes_per_image, 0)
 
-    def encode_single(self, reference_boxes, proposals):
+    def encode_single(self, reference_boxes, proposals, out=None):
+        # type: (Tensor, Tensor, Optional[Tensor]) -> Tensor
         """
         Encode a set of proposals with respect to some
         reference boxes
@@ -182,11 +349,12 @@ class BoxCoder(object):
         Arguments:
             reference_boxes (Tensor): reference boxes
             proposals (Tensor): boxes to be encoded
+            out (Tensor, optional): 输出buffer, 为None时新建
         """
         dtype = reference_boxes.dtype
         device = reference_boxes.device
         weights = torch.as_tensor(self.weights, dtype=dtype, device=device)
-        targets = encode_boxes(reference_boxes, proposals, weights)
+        targets = encode_boxes_fused(reference_boxes, proposals, weights, out)
 
         return targets
 
@@ -221,7 +389,8 @@ class BoxCoder(object):
 
         return pred_boxes
 
-    def decode_single(self, rel_codes, boxes):
+    def decode_single(self, rel_codes, boxes, out=None):
+        # type: (Tensor, Tensor, Optional[Tensor]) -> Tensor
         """
         From a set of original boxes and encoded relative box offsets,
         get the decoded boxes.
@@ -229,42 +398,13 @@ class BoxCoder(object):
         Arguments:
             rel_codes (Tensor): encoded boxes (bbox regression parameters)
             boxes (Tensor): reference boxes (anchors/proposals)
+            out (Tensor, optional): 输出buffer, 为None时新建
         """
-        boxes = boxes.to(rel_codes.dtype)
-
-        # xmin, ymin, xmax, ymax
-        widths = boxes[:, 2] - boxes[:, 0]   # anchor/proposal宽度
-        heights = boxes[:, 3] - boxes[:, 1]  # anchor/proposal高度
-        ctr_x = boxes[:, 0] + 0.5 * widths   # anchor/proposal中心x坐标
-        ctr_y = boxes[:, 1] + 0.5 * heights  # anchor/proposal中心y坐标
-
-        wx, wy, ww, wh = self.weights  # RPN中为[1,1,1,1], fastrcnn中为[10,10,5,5]
-        dx = rel_codes[:, 0::4] / wx   # 预测anchors/proposals的中心坐标x回归参数
-        dy = rel_codes[:, 1::4] / wy   # 预测anchors/proposals的中心坐标y回归参数
-        dw = rel_codes[:, 2::4] / ww   # 预测anchors/proposals的宽度回归参数
-        dh = rel_codes[:, 3::4] / wh   # 预测anchors/proposals的高度回归参数
-
+        # RPN中为[1,1,1,1], fastrcnn中为[10,10,5,5]
+        weights = torch.as_tensor(self.weights, dtype=rel_codes.dtype, device=rel_codes.device)
         # limit max value, prevent sending too large values into torch.exp()
         # self.bbox_xform_clip=math.log(1000. / 16)   4.135
-        dw = torch.clamp(dw, max=self.bbox_xform_clip)
-        dh = torch.clamp(dh, max=self.bbox_xform_clip)
-
-        pred_ctr_x = dx * widths[:, None] + ctr_x[:, None]
-        pred_ctr_y = dy * heights[:, None] + ctr_y[:, None]
-        pred_w = torch.exp(dw) * widths[:, None]
-        pred_h = torch.exp(dh) * heights[:, None]
-
-        # xmin
-        pred_boxes1 = pred_ctr_x - torch.tensor(0.5, dtype=pred_ctr_x.dtype, device=pred_w.device) * pred_w
-        # ymin
-        pred_boxes2 = pred_ctr_y - torch.tensor(0.5, dtype=pred_ctr_y.dtype, device=pred_h.device) * pred_h
-        # xmax
-        pred_boxes3 = pred_ctr_x + torch.tensor(0.5, dtype=pred_ctr_x.dtype, device=pred_w.device) * pred_w
-        # ymax
-        pred_boxes4 = pred_ctr_y + torch.tensor(0.5, dtype=pred_ctr_y.dtype, device=pred_h.device) * pred_h
-
-        pred_boxes = torch.stack((pred_boxes1, pred_boxes2, pred_boxes3, pred_boxes4), dim=2).flatten(1)
-        return pred_boxes
+        return decode_boxes_fused(rel_codes, boxes, weights, self.bbox_xform_clip, out)
 
 
 class Matcher(object):
@@ -352,6 +492,41 @@ class Matcher(object):
 
         return matches
 
+    def match_batched(self, match_quality_matrix, gt_valid):
+        # type: (Tensor, Tensor) -> Tensor
+        """
+        对整个batch一次性匹配, 每张图像的结果与单独调用__call__相同
+        Args:
+            match_quality_matrix (Tensor[B, M, N]): 每张图像pad后的gt与预测框的iou
+            gt_valid (Tensor[B, M]): pad出来的gt为False
+
+        Returns:
+            matches (Tensor[B, N]): 没有gt的图像中所有预测框都为BELOW_LOW_THRESHOLD
+        """
+        # pad出来的gt的iou置为-1, 不会被任何预测框匹配到
+        quality = match_quality_matrix.masked_fill(~gt_valid[:, :, None], -1.)
+        matched_vals, matches = quality.max(dim=1)  # [B, N]
+        if self.allow_low_quality_matches:
+            all_matches = matches.clone()
+        else:
+            all_matches = None
+
+        below_low_threshold = matched_vals < self.low_threshold
+        between_thresholds = (matched_vals >= self.low_threshold) & (
+            matched_vals < self.high_threshold
+        )
+        matches[below_low_threshold] = self.BELOW_LOW_THRESHOLD  # -1
+        matches[between_thresholds] = self.BETWEEN_THRESHOLDS    # -2
+
+        if self.allow_low_quality_matches:
+            assert all_matches is not None
+            # 每个有效gt的最大iou(包括相同的值)对应的预测框保留原来的匹配
+            highest_quality_foreach_gt = quality.max(dim=2)[0]  # [B, M]
+            update = torch.eq(quality, highest_quality_foreach_gt[:, :, None]) & gt_valid[:, :, None]
+            matches = torch.where(update.any(dim=1), all_matches, matches)
+
+        return matches
+
     def set_low_quality_matches_(self, matches, all_matches, match_quality_matrix):
         """
         Produce additional matches for predictions that have only low-quality matches.
@@ -394,6 +569,99 @@ class Matcher(object):
         matches[pre_inds_to_update] = all_matches[pre_inds_to_update]
 
 
+class ChunkedMatcher(Matcher):
+    """
+    Matcher that never materializes the full M (gt) x N (predicted) quality matrix.
+    It streams over tiles of the predictions and gives the same matches as Matcher.
+    分块计算iou, 每次只计算一部分anchors与所有gt的iou, 显存占用由memory_budget控制
+    """
+
+    def __init__(self, high_threshold, low_threshold, allow_low_quality_matches=False,
+                 memory_budget=256 * 1024 * 1024):
+        # type: (float, float, bool, int) -> None
+        """
+        Args:
+            high_threshold, low_threshold, allow_low_quality_matches: 与Matcher相同
+            memory_budget (int): 每个tile计算iou时允许使用的最大字节数
+        """
+        super(ChunkedMatcher, self).__init__(high_threshold, low_threshold, allow_low_quality_matches)
+        self.memory_budget = memory_budget
+
+    def _chunk_size(self, num_gt, element_size):
+        # type: (int, int) -> int
+        # box_iou对每个(gt, anchor)对大约需要8个元素的临时变量
+        # lt, rb, wh各2个, inter和iou各1个
+        return max(1, self.memory_budget // (num_gt * element_size * 8))
+
+    def match_boxes(self, gt_boxes, boxes):
+        # type: (Tensor, Tensor) -> Tensor
+        """
+        分块计算iou并匹配，结果与 Matcher()(box_iou(gt_boxes, boxes)) 相同
+        Args:
+            gt_boxes (Tensor[M, 4]): ground-truth boxes
+            boxes (Tensor[N, 4]): anchors/proposals
+
+        Returns:
+            matches (Tensor[int64]): an N tensor where N[i] is a matched gt in
+            [0, M - 1] or a negative value indicating that prediction i could not
+            be matched.
+        """
+        if gt_boxes.shape[0] == 0:
+            raise ValueError(
+                "No ground-truth boxes available for one of the images "
+                "during training")
+        if boxes.shape[0] == 0:
+            raise ValueError(
+                "No proposal boxes available for one of the images "
+                "during training")
+
+        num_gt = gt_boxes.shape[0]
+        chunk_size = self._chunk_size(num_gt, gt_boxes.element_size())
+
+        matched_vals = []
+        matches = []
+        chunk_max = []  # 每个tile中每个gt的最大iou, 用于第二遍只重新计算需要的tile
+        # 第一遍: 每个anchor与所有gt的最大iou及索引, 以及每个gt在每个tile中的最大iou
+        for boxes_chunk in boxes.split(chunk_size):
+            iou = box_ops.box_iou(gt_boxes, boxes_chunk)
+            vals, idxs = iou.max(dim=0)
+            matched_vals.append(vals)
+            matches.append(idxs)
+            if self.allow_low_quality_matches:
+                chunk_max.append(iou.max(dim=1)[0])
+        matched_vals = torch.cat(matched_vals)
+        matches = torch.cat(matches)
+
+        if self.allow_low_quality_matches:
+            all_matches = matches.clone()
+        else:
+            all_matches = None
+
+        below_low_threshold = matched_vals < self.low_threshold
+        between_thresholds = (matched_vals >= self.low_threshold) & (
+            matched_vals < self.high_threshold
+        )
+        matches[below_low_threshold] = self.BELOW_LOW_THRESHOLD  # -1
+        matches[between_thresholds] = self.BETWEEN_THRESHOLDS    # -2
+
+        if self.allow_low_quality_matches:
+            assert all_matches is not None
+            # 第二遍: 每个gt的最大iou(包括相同的值)对应的anchors保留原来的匹配
+            # 只有包含某个gt最大iou的tile才需要重新计算
+            chunk_max = torch.stack(chunk_max)                          # [num_chunks, M]
+            highest_quality_foreach_gt = chunk_max.max(dim=0)[0]        # [M]
+            chunks_to_update = torch.where(
+                torch.eq(chunk_max, highest_quality_foreach_gt[None]).any(dim=1))[0].tolist()
+            for chunk_idx in chunks_to_update:
+                start = chunk_idx * chunk_size
+                iou = box_ops.box_iou(gt_boxes, boxes[start:start + chunk_size])
+                pre_inds_to_update = torch.where(
+                    torch.eq(iou, highest_quality_foreach_gt[:, None]).any(dim=0))[0] + start
+                matches[pre_inds_to_update] = all_matches[pre_inds_to_update]
+
+        return matches
+
+
 def smooth_l1_loss(input, target, beta: float = 1. / 9, size_average: bool = True):
     """
     very similar to the smooth_l1_loss from pytorch, but with
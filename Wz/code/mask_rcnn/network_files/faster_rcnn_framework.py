@@ -240,6 +240,12 @@ class FasterRCNN(FasterRCNNBase):
             of the classification head
         bbox_reg_weights (Tuple[float, float, float, float]): weights for the encoding/decoding of the
             bounding boxes
+        rpn_batched_filter (bool): filter the RPN proposals of the whole batch with a single batched NMS
+            instead of looping over the images
+        matcher_memory_budget (int): if not None, the RPN and RoIHeads match boxes to the ground-truth
+            in chunks, each using at most this many bytes, instead of building the full IoU matrix
+        box_nms_method (str): "nms" for greedy NMS or "matrix" for Matrix NMS when postprocessing
+            the predictions of the classification head
 
     """
 
@@ -261,7 +267,10 @@ class FasterRCNN(FasterRCNNBase):
                  box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=100,
                  box_fg_iou_thresh=0.5, box_bg_iou_thresh=0.5,   # fast rcnn计算误差时，采集正负样本设置的阈值
                  box_batch_size_per_image=512, box_positive_fraction=0.25,  # fast rcnn计算误差时采样的样本数，以及正样本占所有样本的比例
-                 bbox_reg_weights=None):
+                 bbox_reg_weights=None,
+                 rpn_batched_filter=False,  # rpn中整个batch只进行一次nms
+                 matcher_memory_budget=None,  # 正负样本匹配时分块计算iou所用的内存上限(bytes)
+                 box_nms_method="nms"):  # fast rcnn后处理使用的nms方法, "nms"或"matrix"
         if not hasattr(backbone, "out_channels"):
             raise ValueError(
                 "backbone should contain an attribute out_channels"
@@ -309,7 +318,9 @@ class FasterRCNN(FasterRCNNBase):
             rpn_fg_iou_thresh, rpn_bg_iou_thresh,
             rpn_batch_size_per_image, rpn_positive_fraction,
             rpn_pre_nms_top_n, rpn_post_nms_top_n, rpn_nms_thresh,
-            score_thresh=rpn_score_thresh)
+            score_thresh=rpn_score_thresh,
+            batched_filter=rpn_batched_filter,
+            matcher_memory_budget=matcher_memory_budget)
 
         #  Multi-scale RoIAlign pooling
         if box_roi_pool is None:
@@ -341,7 +352,9 @@ class FasterRCNN(FasterRCNNBase):
             box_fg_iou_thresh, box_bg_iou_thresh,  # 0.5  0.5
             box_batch_size_per_image, box_positive_fraction,  # 512  0.25
             bbox_reg_weights,
-            box_score_thresh, box_nms_thresh, box_detections_per_img)  # 0.05  0.5  100
+            box_score_thresh, box_nms_thresh, box_detections_per_img,  # 0.05  0.5  100
+            matcher_memory_budget=matcher_memory_budget,
+            nms_method=box_nms_method)
 
         if image_mean is None:
             image_mean = [0.485, 0.456, 0.406]
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 from torchvision.ops import MultiScaleRoIAlign
 
@@ -93,6 +94,23 @@ class MaskRCNN(FasterRCNN):
             mask_head (nn.Module): module that takes the cropped feature maps as input
             mask_predictor (nn.Module): module that takes the output of the mask_head and returns the
                 segmentation mask logits
+            rpn_batched_filter (bool): filter the RPN proposals of the whole batch with a single batched NMS
+                instead of looping over the images
+            matcher_memory_budget (int): if not None, the RPN and RoIHeads match boxes to the ground-truth
+                in chunks, each using at most this many bytes, instead of building the full IoU matrix
+            box_nms_method (str): "nms" for greedy NMS or "matrix" for Matrix NMS when postprocessing
+                the predictions of the classification head
+            box_batched_sampling (bool): match and sample the training proposals of the whole batch at once
+                instead of looping over the images (ignored when matcher_memory_budget is set)
+            mask_paste_chunk_size (int): number of masks pasted into the original image at once during
+                postprocessing. If None, 1 on cpu and as many as fit in 1GB on gpu
+            mask_paste_thresh (float): if not None, the pasted masks are thresholded and returned as
+                mask_paste_dtype instead of float probabilities
+            mask_paste_dtype (torch.dtype): torch.bool or torch.uint8, dtype of the thresholded masks
+            mask_rle_output (bool): if True, the masks are returned as COCO run-length encodings
+                ("masks_rle" with the concatenated uncompressed counts and "masks_rle_runs" with the
+                number of counts of each mask) computed from the predicted masks and the boxes, instead
+                of image-sized "masks". The masks are binarized with mask_paste_thresh (0.5 if None)
 
         """
 
@@ -142,6 +160,17 @@ class MaskRCNN(FasterRCNN):
             mask_roi_pool=None,
             mask_head=None,
             mask_predictor=None,
+            #------------------------------------------------------------#
+            # Efficiency options
+            #------------------------------------------------------------#
+            rpn_batched_filter=False,
+            matcher_memory_budget=None,
+            box_nms_method="nms",
+            box_batched_sampling=False,
+            mask_paste_chunk_size=None,
+            mask_paste_thresh=None,
+            mask_paste_dtype=torch.bool,
+            mask_rle_output=False,
     ):
 
         if not isinstance(mask_roi_pool, (MultiScaleRoIAlign, type(None))):
@@ -214,6 +243,10 @@ class MaskRCNN(FasterRCNN):
             box_batch_size_per_image,
             box_positive_fraction,
             bbox_reg_weights,
+            rpn_batched_filter=rpn_batched_filter,
+            matcher_memory_budget=matcher_memory_budget,
+            box_nms_method=box_nms_method,
+            box_batched_sampling=box_batched_sampling,
         )
 
         #--------------------------------#
@@ -223,6 +256,12 @@ class MaskRCNN(FasterRCNN):
         self.roi_heads.mask_head = mask_head
         self.roi_heads.mask_predictor = mask_predictor
 
+        # 后处理时将mask粘贴回原图的参数 transform.py
+        self.transform.mask_paste_chunk_size = mask_paste_chunk_size
+        self.transform.mask_paste_thresh = mask_paste_thresh
+        self.transform.mask_paste_dtype = mask_paste_dtype
+        self.transform.mask_rle_output = mask_rle_output
+
 
 #----------------------------------#
 #   Mask分支中四个卷积
@@ -115,17 +115,124 @@ def project_masks_on_boxes(gt_masks, boxes, matched_idxs, M):
     return roi_align(gt_masks, rois, (M, M), 1.0)[:, 0]
 
 
+#---------------------------------#
+# gt为多边形时, 直接在每个Proposal的MxM网格上生成gt_mask
+#---------------------------------#
+def project_polygons_on_boxes(polygons, polygon_lengths, polygon_instances, boxes, matched_idxs, M):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, int) -> Tensor
+    """
+    与project_masks_on_boxes作用相同, 但gt是多边形(CocoDetection的lazy_masks), 不需要原图大小的mask:
+    将每个Proposal匹配到的gt的多边形变换到Proposal的MxM网格坐标上, 在每个网格内取与roi_align(sampling_ratio=-1)
+    相同的ceil(roi_h / M) x ceil(roi_w / M)个采样点, 通过扫描线统计在多边形内的采样点比例作为gt_mask
+    与project_masks_on_boxes一样得到0-1之间的soft target, 区别在于:
+    roi_align在每个采样点对栅格化的mask做双线性插值, 这里直接判断采样点是否在多边形内,
+    所以只在目标边界附近的网格有差异; 一个目标由多个多边形组成时比例相加后截断到1, 多边形相互重叠时会略大于并集
+    两者的差异可以通过benchmark_polygon_mask_targets.py在COCO数据上比较
+    Args:
+        polygons: [K, 2] 所有多边形的顶点(x, y)
+        polygon_lengths: [P] 每个多边形的顶点个数
+        polygon_instances: [P] 每个多边形属于第几个gt
+        boxes: [N, 4] Proposals
+        matched_idxs: [N] 每个Proposal匹配到的gt索引
+        M: mask的大小
+
+    Returns:
+        mask_targets: [N, M, M] 0-1之间
+    """
+    device = boxes.device
+    num_rois = boxes.shape[0]
+    mask_targets = torch.zeros((num_rois, M, M), dtype=boxes.dtype, device=device)
+
+    # 每个Proposal与它匹配到的gt的每个多边形组成一对
+    roi_ids, poly_ids = torch.where(matched_idxs[:, None] == polygon_instances[None, :])
+    if roi_ids.numel() == 0:
+        return mask_targets
+
+    # 多边形的边: 顶点i -> 顶点i+1, 最后一个顶点连回第一个顶点, 按多边形补齐成[P, E, 4], 补齐的边为nan
+    num_polys = polygon_lengths.shape[0]
+    num_points = polygons.shape[0]
+    starts = torch.cumsum(polygon_lengths, dim=0) - polygon_lengths
+    point_polys = torch.repeat_interleave(torch.arange(num_polys, device=device), polygon_lengths)
+    next_points = torch.arange(1, num_points + 1, device=device)
+    next_points[starts + polygon_lengths - 1] = starts
+    point_inds = torch.arange(num_points, device=device) - starts[point_polys]
+    max_edges = int(polygon_lengths.max())
+    edges = polygons.new_full((num_polys, max_edges, 4), float("nan"))
+    edges[point_polys, point_inds] = torch.cat([polygons, polygons[next_points]], dim=1)
+
+    # 图像坐标 -> Proposal的网格坐标
+    # 多边形坐标中像素i覆盖[i, i + 1], mask中像素i的坐标为i, 所以先减去0.5再按roi_align的方式映射
+    boxes = boxes[roi_ids]
+    edges = edges[poly_ids].to(boxes.dtype)
+    bin_w = (boxes[:, 2] - boxes[:, 0]).clamp(min=1.) / M
+    bin_h = (boxes[:, 3] - boxes[:, 1]).clamp(min=1.) / M
+    ex1 = (edges[:, :, 0] - 0.5 - boxes[:, 0, None]) / bin_w[:, None]
+    ey1 = (edges[:, :, 1] - 0.5 - boxes[:, 1, None]) / bin_h[:, None]
+    ex2 = (edges[:, :, 2] - 0.5 - boxes[:, 0, None]) / bin_w[:, None]
+    ey2 = (edges[:, :, 3] - 0.5 - boxes[:, 1, None]) / bin_h[:, None]
+
+    # 每个网格内的采样点个数, 与roi_align(sampling_ratio=-1)相同: ceil(roi_h / M) x ceil(roi_w / M)
+    grid_h = torch.ceil(bin_h)
+    grid_w = torch.ceil(bin_w)
+
+    # 所有采样行(扫描线)在网格坐标中的位置 [I, R], 第j行位于(j + 0.5) / grid_h, 超过M * grid_h的行无效
+    num_rows = M * int(grid_h.max())
+    rows = torch.arange(num_rows, device=device, dtype=boxes.dtype)
+    py = (rows[None, :] + 0.5) / grid_h[:, None]
+    row_valid = rows[None, :] < M * grid_h[:, None]
+    row_bins = torch.div(rows[None, :], grid_h[:, None], rounding_mode="floor").clamp(max=M - 1).long()
+
+    # 每条扫描线与每条边的交点 [I, R, E], 不相交(以及补齐的边)设为inf
+    py = py[:, :, None]
+    ey1, ey2, ex1, ex2 = ey1[:, None], ey2[:, None], ex1[:, None], ex2[:, None]
+    crossing = (ey1 > py) != (ey2 > py)
+    x_inter = ex1 + (py - ey1) * (ex2 - ex1) / (ey2 - ey1)
+    x_inter = torch.where(crossing, x_inter, torch.full_like(x_inter, float("inf")))
+    # even-odd规则: 排序后第0-1, 2-3, ...个交点之间为多边形内部
+    # 闭合多边形与每条扫描线的交点个数都是偶数, 只保留有交点的部分
+    x_inter, _ = x_inter.sort(dim=-1)
+    x_inter = x_inter[..., :int(crossing.sum(dim=-1).max())]
+
+    # 交点 -> 该位置左侧的采样点个数, 第k个采样点位于(k + 0.5) / grid_w
+    # 第pw个网格内的采样点为[pw * grid_w, (pw + 1) * grid_w), 统计每一段内部区间与每个网格重叠的采样点个数
+    row_samples = (M * grid_w)[:, None, None]
+    n_inter = torch.min(torch.ceil(x_inter * grid_w[:, None, None] - 0.5).clamp(min=0), row_samples)
+    seg_start = n_inter[..., 0::2, None]
+    seg_end = n_inter[..., 1::2, None]
+    bin_edges = torch.arange(M + 1, device=device, dtype=boxes.dtype)[None, None, None, :] * grid_w[:, None, None, None]
+    overlap = torch.min(seg_end, bin_edges[..., 1:]) - torch.max(seg_start, bin_edges[..., :-1])
+    counts = overlap.clamp(min=0).sum(dim=2) * row_valid[:, :, None].to(boxes.dtype)  # [I, R, M]
+
+    # 同一个网格内的采样行相加, 再除以采样点个数得到比例
+    coverage = boxes.new_zeros((roi_ids.shape[0], M, M))
+    coverage.scatter_add_(1, row_bins[:, :, None].expand(-1, -1, M), counts)
+    coverage /= (grid_h * grid_w)[:, None, None]
+
+    # 同一个gt的多个多边形取并集
+    mask_targets.index_add_(0, roi_ids, coverage)
+    return mask_targets.clamp(max=1.)
+
+
+def project_target_masks_on_boxes(target, boxes, matched_idxs, M):
+    # type: (Dict[str, Tensor], Tensor, Tensor, int) -> Tensor
+    """根据target中gt mask的形式(masks或者多边形)得到每个Proposal对应的MxM gt_mask"""
+    if "polygons" in target:
+        return project_polygons_on_boxes(target["polygons"], target["polygon_lengths"],
+                                         target["polygon_instances"], boxes, matched_idxs, M)
+    return project_masks_on_boxes(target["masks"], boxes, matched_idxs, M)
+
+
 #---------------------------------#
 #   计算mask损失
 #---------------------------------#
-def maskrcnn_loss(mask_logits, proposals, gt_masks, gt_labels, mask_matched_idxs):
-    # type: (Tensor, List[Tensor], List[Tensor], List[Tensor], List[Tensor]) -> Tensor
+def maskrcnn_loss(mask_logits, proposals, targets, gt_labels, mask_matched_idxs):
+    # type: (Tensor, List[Tensor], List[Dict[str, Tensor]], List[Tensor], List[Tensor]) -> Tensor
     """
 
     Args:
         mask_logits:    最终预测的mask 28x28
         proposals:      mask_roi之前的框
-        gt_masks:       真实mask
+        targets:        真实mask(masks或者多边形polygons)所在的targets
         gt_labels:      全部真实label
         mask_matched_idxs: 真实框索引
 
@@ -144,7 +251,8 @@ def maskrcnn_loss(mask_logits, proposals, gt_masks, gt_labels, mask_matched_idxs
     # 根据Proposal信息在gt_masks上裁剪对应区域做为计算loss时的真正gt_mask
     #---------------------------------#
     mask_targets = [
-        project_masks_on_boxes(m, p, i, discretization_size) for m, p, i in zip(gt_masks, proposals, mask_matched_idxs)
+        project_target_masks_on_boxes(t, p, i, discretization_size)
+        for t, p, i in zip(targets, proposals, mask_matched_idxs)
     ]
 
     #---------------------------------#
@@ -194,15 +302,24 @@ class RoIHeads(torch.nn.Module):
                  mask_roi_pool=None,
                  mask_head=None,
                  mask_predictor=None,
+                 matcher_memory_budget=None,  # 不为None时分块计算proposal与gt的iou
+                 nms_method="nms",  # "nms": 贪心nms, "matrix": Matrix NMS
+                 batched_sampling=False,  # 训练时整个batch一起匹配、采样正负样本
                  ):
         super(RoIHeads, self).__init__()
 
         self.box_similarity = box_ops.box_iou
         # assign ground-truth boxes for each proposal
-        self.proposal_matcher = det_utils.Matcher(
-            fg_iou_thresh,  # default: 0.5
-            bg_iou_thresh,  # default: 0.5
-            allow_low_quality_matches=False)
+        if matcher_memory_budget is None:
+            self.proposal_matcher = det_utils.Matcher(
+                fg_iou_thresh,  # default: 0.5
+                bg_iou_thresh,  # default: 0.5
+                allow_low_quality_matches=False)
+        else:
+            self.proposal_matcher = det_utils.ChunkedMatcher(
+                fg_iou_thresh, bg_iou_thresh,
+                allow_low_quality_matches=False,
+                memory_budget=matcher_memory_budget)
 
         self.fg_bg_sampler = det_utils.BalancedPositiveNegativeSampler(
             batch_size_per_image,  # default: 512
@@ -212,6 +329,8 @@ class RoIHeads(torch.nn.Module):
             bbox_reg_weights = (10., 10., 5., 5.)
         self.box_coder = det_utils.BoxCoder(bbox_reg_weights)
 
+        self.batched_sampling = batched_sampling
+
         self.box_roi_pool = box_roi_pool    # Multi-scale RoIAlign pooling
         self.box_head = box_head            # TwoMLPHead
         self.box_predictor = box_predictor  # FastRCNNPredictor
@@ -220,6 +339,15 @@ class RoIHeads(torch.nn.Module):
         self.nms_thresh = nms_thresh      # default: 0.5
         self.detection_per_img = detection_per_img  # default: 100
 
+        # 后处理使用的nms方法, matrix时根据与高分boxes的重叠程度衰减分数
+        # 衰减后的分数仍然用score_thresh过滤
+        if nms_method not in ("nms", "matrix"):
+            raise ValueError("nms_method should be 'nms' or 'matrix', got {}".format(nms_method))
+        self.nms_method = nms_method
+        self.matrix_nms_kernel = "gaussian"
+        self.matrix_nms_sigma = 2.0
+        self.matrix_nms_pre_top_n = 1000  # 每张图像最多对1000个boxes计算iou矩阵
+
         #--------------------------------#
         # MaskRCNN添加在roi_heads中
         #--------------------------------#
@@ -262,13 +390,17 @@ class RoIHeads(torch.nn.Module):
                     (proposals_in_image.shape[0],), dtype=torch.int64, device=device
                 )
             else:
-                # set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
-                # 计算proposal与每个gt_box的iou重合度
-                match_quality_matrix = box_ops.box_iou(gt_boxes_in_image, proposals_in_image)
-
-                # 计算proposal与每个gt_box匹配的iou最大值，并记录索引，
-                # iou < low_threshold索引值为 -1， low_threshold <= iou < high_threshold索引值为 -2
-                matched_idxs_in_image = self.proposal_matcher(match_quality_matrix)
+                if isinstance(self.proposal_matcher, det_utils.ChunkedMatcher):
+                    # 分块计算iou并匹配, 不生成完整的iou矩阵
+                    matched_idxs_in_image = self.proposal_matcher.match_boxes(gt_boxes_in_image, proposals_in_image)
+                else:
+                    # set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
+                    # 计算proposal与每个gt_box的iou重合度
+                    match_quality_matrix = box_ops.box_iou(gt_boxes_in_image, proposals_in_image)
+
+                    # 计算proposal与每个gt_box匹配的iou最大值，并记录索引，
+                    # iou < low_threshold索引值为 -1， low_threshold <= iou < high_threshold索引值为 -2
+                    matched_idxs_in_image = self.proposal_matcher(match_quality_matrix)
 
                 # 限制最小值，防止匹配标签时出现越界的情况
                 # 注意-1, -2对应的gt索引会调整到0,获取的标签类别为第0个gt的类别（实际上并不是）,后续会进一步处理
@@ -291,17 +423,47 @@ class RoIHeads(torch.nn.Module):
             labels.append(labels_in_image)
         return matched_idxs, labels
 
+    # assign_targets_to_proposals的batch版本
+    def assign_targets_to_proposals_batched(self,
+                                            proposals,       # type: Tensor
+                                            proposal_valid,  # type: Tensor
+                                            gt_boxes,        # type: Tensor
+                                            gt_labels,       # type: Tensor
+                                            gt_valid         # type: Tensor
+                                            ):
+        # type: (...) -> Tuple[Tensor, Tensor]
+        """
+        对pad后的整个batch一次性计算iou并匹配, 每张图像的结果与assign_targets_to_proposals相同
+        Args:
+            proposals:      [B, P, 4] pad后的proposals
+            proposal_valid: [B, P] pad出来的proposal为False
+            gt_boxes:       [B, G, 4] pad后的gt_boxes
+            gt_labels:      [B, G]
+            gt_valid:       [B, G] pad出来的gt为False
+
+        Returns:
+            matched_idxs: [B, P] 每个proposal匹配到的gt索引(背景以及废弃样本为0)
+            labels:       [B, P] 正样本为gt类别, 背景为0, 废弃样本以及pad出来的proposal为-1
+        """
+        # 计算每张图像中proposal与每个gt_box的iou, [B, G, P]
+        # 没有gt的图像所有proposal都小于low_threshold, 即背景
+        match_quality_matrix = box_ops.batched_box_iou(gt_boxes, proposals)
+        matched_idxs = self.proposal_matcher.match_batched(match_quality_matrix, gt_valid)
+
+        clamped_matched_idxs = matched_idxs.clamp(min=0)
+        labels = torch.gather(gt_labels, 1, clamped_matched_idxs).to(dtype=torch.int64)
+
+        # 背景为0, 废弃样本以及pad出来的proposal为-1(采样时会被忽略)
+        labels.masked_fill_(matched_idxs == self.proposal_matcher.BELOW_LOW_THRESHOLD, 0)
+        labels.masked_fill_(matched_idxs == self.proposal_matcher.BETWEEN_THRESHOLDS, -1)
+        labels.masked_fill_(~proposal_valid, -1)
+        return clamped_matched_idxs, labels
+
     def subsample(self, labels):
         # type: (List[Tensor]) -> List[Tensor]
         # BalancedPositiveNegativeSampler
-        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
-        sampled_inds = []
-        # 遍历每张图片的正负样本索引
-        for img_idx, (pos_inds_img, neg_inds_img) in enumerate(zip(sampled_pos_inds, sampled_neg_inds)):
-            # 记录所有采集样本索引（包括正样本和负样本）
-            # img_sampled_inds = torch.nonzero(pos_inds_img | neg_inds_img).squeeze(1)
-            img_sampled_inds = torch.where(pos_inds_img | neg_inds_img)[0]
-            sampled_inds.append(img_sampled_inds)
+        # 整个batch一起采样, 返回每张图片采集的所有样本索引（包括正样本和负样本）
+        sampled_inds = self.fg_bg_sampler.sample_indices_per_image(labels)
         return sampled_inds
 
     def add_gt_proposals(self, proposals, gt_boxes):
@@ -359,6 +521,11 @@ class RoIHeads(torch.nn.Module):
         # 将gt_boxes拼接到proposal后面
         proposals = self.add_gt_proposals(proposals, gt_boxes)
 
+        if self.batched_sampling and not isinstance(self.proposal_matcher, det_utils.ChunkedMatcher):
+            # 整个batch一起匹配、采样并计算回归参数(batched_sampling, 默认关闭, 在cpu上比逐张图像慢)
+            # 分块计算iou的ChunkedMatcher只能逐张图像处理
+            return self.select_training_samples_batched(proposals, gt_boxes, gt_labels)
+
         # get matching gt indices for each proposal
         # 为每个proposal匹配对应的gt_box，并划分到正负样本中
         matched_idxs, labels = self.assign_targets_to_proposals(proposals, gt_boxes, gt_labels)
@@ -389,6 +556,67 @@ class RoIHeads(torch.nn.Module):
         regression_targets = self.box_coder.encode(matched_gt_boxes, proposals)
         return proposals, matched_idxs, labels, regression_targets
 
+    # 整个batch一起划分正负样本，统计对应gt的标签以及边界框回归信息
+    def select_training_samples_batched(self,
+                                        proposals,  # type: List[Tensor]
+                                        gt_boxes,   # type: List[Tensor]
+                                        gt_labels   # type: List[Tensor]
+                                        ):
+        # type: (...) -> Tuple[List[Tensor], List[Tensor], List[Tensor], List[Tensor]]
+        """
+        每张图像的proposals(已经拼接了gt_boxes)以及gt数量不同, pad到相同数量后通过valid mask区分,
+        iou、匹配、采样以及回归参数的计算都只执行一次, 不再逐张图像循环
+        采样方式与逐张图像处理时相同, 每张图像返回的样本按照在proposals中的索引升序排列
+        Args:
+            proposals: 拼接了gt_boxes的proposals
+            gt_boxes:  每张图像的gt_boxes
+            gt_labels: 每张图像的gt类别
+
+        Returns:
+            proposals, matched_idxs, labels, regression_targets: 每张图像采样得到的正负样本信息
+        """
+        num_images = len(proposals)
+        device = proposals[0].device
+
+        # pad到相同数量, [B, P, 4], [B, G, 4], [B, G]
+        proposals_padded = torch.nn.utils.rnn.pad_sequence(proposals, batch_first=True)
+        gt_boxes_padded = torch.nn.utils.rnn.pad_sequence(gt_boxes, batch_first=True)
+        gt_labels_padded = torch.nn.utils.rnn.pad_sequence(gt_labels, batch_first=True)
+        if gt_boxes_padded.shape[1] == 0:
+            # 整个batch都没有gt, pad出一个无效的gt, 所有proposal都会被划分为背景
+            gt_boxes_padded = gt_boxes_padded.new_zeros((num_images, 1, 4))
+            gt_labels_padded = gt_labels_padded.new_zeros((num_images, 1))
+
+        num_proposals = torch.as_tensor([p.shape[0] for p in proposals], device=device)
+        num_gt = torch.as_tensor([g.shape[0] for g in gt_boxes], device=device)
+        width = proposals_padded.shape[1]
+        proposal_valid = torch.lt(torch.arange(width, device=device)[None, :], num_proposals[:, None])
+        gt_valid = torch.lt(torch.arange(gt_boxes_padded.shape[1], device=device)[None, :], num_gt[:, None])
+
+        matched_idxs, labels = self.assign_targets_to_proposals_batched(
+            proposals_padded, proposal_valid, gt_boxes_padded, gt_labels_padded, gt_valid)
+
+        # 按给定数量和比例采样正负样本, 按(图像, 索引)排序
+        pos_img, pos_idx, neg_img, neg_idx = self.fg_bg_sampler.sample_padded(labels)
+        img = torch.cat([pos_img, neg_img])
+        idx = torch.cat([pos_idx, neg_idx])
+        order = torch.argsort(img * width + idx)
+        img, idx = img[order], idx[order]
+
+        sampled_proposals = proposals_padded[img, idx]
+        sampled_labels = labels[img, idx]
+        sampled_matched_idxs = matched_idxs[img, idx]
+
+        # 一次计算所有样本的边框回归参数
+        matched_gt_boxes = gt_boxes_padded[img, sampled_matched_idxs]
+        regression_targets = self.box_coder.encode_single(matched_gt_boxes, sampled_proposals)
+
+        num_per_image = torch.bincount(img, minlength=num_images).tolist()
+        return (list(sampled_proposals.split(num_per_image)),
+                list(sampled_matched_idxs.split(num_per_image)),
+                list(sampled_labels.split(num_per_image)),
+                list(regression_targets.split(num_per_image)))
+
     def postprocess_detections(self,
                                class_logits,    # type: Tensor
                                box_regression,  # type: Tensor
@@ -398,11 +626,11 @@ class RoIHeads(torch.nn.Module):
         # type: (...) -> Tuple[List[Tensor], List[Tensor], List[Tensor]]
         """
         对网络的预测数据进行后处理，包括
-        （1）根据proposal以及预测的回归参数计算出最终bbox坐标
-        （2）对预测类别结果进行softmax处理
-        （3）裁剪预测的boxes信息，将越界的坐标调整到图片边界上
-        （4）移除所有背景信息
-        （5）移除低概率目标
+        （1）对预测类别结果进行softmax处理
+        （2）移除所有背景信息
+        （3）移除低概率目标
+        （4）只对剩下的(proposal, 类别)根据proposal以及预测的回归参数计算出最终bbox坐标
+        （5）裁剪预测的boxes信息，将越界的坐标调整到图片边界上
         （6）移除小尺寸目标
         （7）执行nms处理，并按scores进行排序
         （8）根据scores排序返回前topk个目标
@@ -415,66 +643,62 @@ class RoIHeads(torch.nn.Module):
         Returns:
 
         """
-        device = class_logits.device
         # 预测目标类别数
         num_classes = class_logits.shape[-1]
 
         # 获取每张图像的预测bbox数量
         boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
-        # 根据proposal以及预测的回归参数计算出最终bbox坐标
-        pred_boxes = self.box_coder.decode(box_regression, proposals)
 
         # 对预测类别结果进行softmax处理
         pred_scores = F.softmax(class_logits, -1)
 
-        # split boxes and scores per image
-        # 根据每张图像的预测bbox数量分割结果
-        pred_boxes_list = pred_boxes.split(boxes_per_image, 0)
+        # split scores and regression parameters per image
+        # 根据每张图像的预测bbox数量分割结果, 回归参数[N, num_classes * 4] -> [N, num_classes, 4]
         pred_scores_list = pred_scores.split(boxes_per_image, 0)
+        box_regression_list = box_regression.reshape(-1, num_classes, 4).split(boxes_per_image, 0)
 
         all_boxes = []
         all_scores = []
         all_labels = []
         # 遍历每张图像预测信息
-        for boxes, scores, image_shape in zip(pred_boxes_list, pred_scores_list, image_shapes):
-            # 裁剪预测的boxes信息，将越界的坐标调整到图片边界上
-            boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
-
-            # create labels for each prediction
-            labels = torch.arange(num_classes, device=device)
-            labels = labels.view(1, -1).expand_as(scores)
-
-            # remove prediction with the background label
-            # 移除索引为0的所有信息（0代表背景）
-            boxes = boxes[:, 1:]
+        for scores, rel_codes, proposals_in_image, image_shape in zip(pred_scores_list, box_regression_list,
+                                                                        proposals, image_shapes):
+            # remove prediction with the background label and low scoring predictions
+            # 移除索引为0的所有信息（0代表背景）以及低概率目标，self.scores_thresh=0.05
+            # 按行优先的顺序返回(proposal, 类别)索引, 与先展平成[N * (num_classes - 1)]再筛选的顺序相同
             scores = scores[:, 1:]
-            labels = labels[:, 1:]
+            proposal_inds, class_inds = torch.where(torch.gt(scores, self.score_thresh))
+            scores = scores[proposal_inds, class_inds]
+            labels = class_inds + 1
 
-            # batch everything, by making every class prediction be a separate instance
-            boxes = boxes.reshape(-1, 4)
-            scores = scores.reshape(-1)
-            labels = labels.reshape(-1)
-
-            # remove low scoring boxes
-            # 移除低概率目标，self.scores_thresh=0.05
-            # gt: Computes input > other element-wise.
-            # inds = torch.nonzero(torch.gt(scores, self.score_thresh)).squeeze(1)
-            inds = torch.where(torch.gt(scores, self.score_thresh))[0]
-            boxes, scores, labels = boxes[inds], scores[inds], labels[inds]
+            # 只对保留下来的(proposal, 类别)计算最终bbox坐标, 计算量和显存占用与类别数无关
+            # 裁剪预测的boxes信息，将越界的坐标调整到图片边界上
+            boxes = self.box_coder.decode_single(rel_codes[proposal_inds, labels], proposals_in_image[proposal_inds])
+            boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
 
             # remove empty boxes
             # 移除小目标
             keep = box_ops.remove_small_boxes(boxes, min_size=1.)
             boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
 
-            # non-maximun suppression, independently done per class
-            # 执行nms处理，执行后的结果会按照scores从大到小进行排序返回
-            keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
+            if self.nms_method == "matrix":
+                # Matrix NMS, 返回衰减后的分数, 结果按照衰减后的scores从大到小排序
+                keep, scores = box_ops.matrix_nms(boxes, scores, labels,
+                                                  kernel=self.matrix_nms_kernel,
+                                                  sigma=self.matrix_nms_sigma,
+                                                  score_threshold=self.score_thresh,
+                                                  max_candidates=self.matrix_nms_pre_top_n)
+                keep, scores = keep[:self.detection_per_img], scores[:self.detection_per_img]
+                boxes, labels = boxes[keep], labels[keep]
+            else:
+                # non-maximun suppression, independently done per class
+                # 执行nms处理，执行后的结果会按照scores从大到小进行排序返回
+                keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
 
-            # keep only topk scoring predictions
-            # 获取scores排在前topk个预测目标
-            keep = keep[:self.detection_per_img]
-            boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+                # keep only topk scoring predictions
+                # 获取scores排在前topk个预测目标
+                keep = keep[:self.detection_per_img]
+                boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
 
             all_boxes.append(boxes)
             all_scores.append(scores)
@@ -585,12 +809,10 @@ class RoIHeads(torch.nn.Module):
                 if targets is None or pos_matched_idxs is None or mask_logits is None:
                     raise ValueError("targets, pos_matched_idxs, mask_logits cannot be None when training")
 
-                # 真实mask
-                gt_masks = [t["masks"] for t in targets]
                 # 真实label
                 gt_labels = [t["labels"] for t in targets]
                 # 计算损失                     最终预测的mask mask_roi之前的框 真实mask 全部真实label 真实框索引
-                rcnn_loss_mask = maskrcnn_loss(mask_logits, mask_proposals, gt_masks, gt_labels, pos_matched_idxs)
+                rcnn_loss_mask = maskrcnn_loss(mask_logits, mask_proposals, targets, gt_labels, pos_matched_idxs)
                 loss_mask = {"loss_mask": rcnn_loss_mask}
 
             #--------------------------------#
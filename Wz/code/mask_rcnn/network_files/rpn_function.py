@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from typing import List, Optional, Dict, Tuple
 
 import torch
@@ -25,7 +26,7 @@ def _onnx_get_num_anchors_and_pre_nms_top_n(ob, orig_pre_nms_top_n):
 class AnchorsGenerator(nn.Module):
     __annotations__ = {
         "cell_anchors": Optional[List[torch.Tensor]],
-        "_cache": Dict[str, List[torch.Tensor]]
+        "_cache": Dict[str, torch.Tensor]
     }
 
     """
@@ -46,9 +47,10 @@ class AnchorsGenerator(nn.Module):
     Arguments:
         sizes (Tuple[Tuple[int]]):
         aspect_ratios (Tuple[Tuple[float]]):
+        cache_size (int): 最多缓存多少种输入尺寸对应的anchors(LRU淘汰), 0表示不缓存
     """
 
-    def __init__(self, sizes=(128, 256, 512), aspect_ratios=(0.5, 1.0, 2.0)):
+    def __init__(self, sizes=(128, 256, 512), aspect_ratios=(0.5, 1.0, 2.0), cache_size=16):
         super(AnchorsGenerator, self).__init__()
 
         if not isinstance(sizes[0], (list, tuple)):
@@ -62,7 +64,10 @@ class AnchorsGenerator(nn.Module):
         self.sizes = sizes
         self.aspect_ratios = aspect_ratios
         self.cell_anchors = None
-        self._cache = {}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def generate_anchors(self, scales, aspect_ratios, dtype=torch.float32, device=torch.device("cpu")):
         # type: (List[int], List[float], torch.dtype, torch.device) -> Tensor
@@ -158,17 +163,51 @@ class AnchorsGenerator(nn.Module):
 
         return anchors  # List[Tensor(all_num_anchors, 4)]
 
-    def cached_grid_anchors(self, grid_sizes, strides):
-        # type: (List[List[int]], List[List[Tensor]]) -> List[Tensor]
-        """将计算得到的所有anchors信息进行缓存"""
-        key = str(grid_sizes) + str(strides)
-        # self._cache是字典类型
+    def cached_grid_anchors(self, grid_sizes, strides, dtype, device):
+        # type: (List[List[int]], List[List[int]], torch.dtype, torch.device) -> Tensor
+        """
+        将计算得到的所有anchors信息进行缓存
+        Args:
+            grid_sizes: 预测特征矩阵的height和width
+            strides: 预测特征矩阵上一步对应原始图像上的步距(int)
+            dtype: anchors的数据类型
+            device: anchors所在设备
+
+        Returns:
+            所有预测特征层的anchors拼接在一起的结果 [all_num_anchors, 4]
+        """
+        key = str(grid_sizes) + str(strides) + str(dtype) + str(device)
+        # self._cache是OrderedDict, 命中时移动到末尾, 表示最近使用过
         if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
             return self._cache[key]
-        anchors = self.grid_anchors(grid_sizes, strides)
-        self._cache[key] = anchors
+
+        self.cache_misses += 1
+        # 只有未命中时才需要在device上创建strides tensor
+        strides = [[torch.tensor(s[0], dtype=torch.int64, device=device),
+                    torch.tensor(s[1], dtype=torch.int64, device=device)] for s in strides]
+        anchors = torch.cat(self.grid_anchors(grid_sizes, strides))
+
+        if self.cache_size > 0:
+            self._cache[key] = anchors
+            # 超出容量时淘汰最久没有使用的anchors
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
         return anchors
 
+    def cache_info(self):
+        # type: () -> Dict[str, int]
+        """返回anchors缓存的命中/未命中次数以及当前大小"""
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self._cache), "max_size": self.cache_size}
+
+    def clear_cache(self):
+        # type: () -> None
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def forward(self, image_list, feature_maps):
         # type: (ImageList, List[Tensor]) -> List[Tensor]
         # 获取每个预测特征层的尺寸(height, width)
@@ -180,31 +219,26 @@ class AnchorsGenerator(nn.Module):
         # 获取变量类型和设备类型
         dtype, device = feature_maps[0].dtype, feature_maps[0].device
 
-        # one step in feature map equate n pixel stride in origin image
-        # 计算特征层上的一步等于原始图像上的步长
-        strides = [[torch.tensor(image_size[0] // g[0], dtype=torch.int64, device=device),
-                    torch.tensor(image_size[1] // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
-
         # 根据提供的sizes和aspect_ratios生成anchors模板
         self.set_cell_anchors(dtype, device)
 
+        # one step in feature map equate n pixel stride in origin image
+        # 计算特征层上的一步等于原始图像上的步长
         # 计算/读取所有anchors的坐标信息（这里的anchors信息是映射到原图上的所有anchors信息，不是anchors模板）
-        # 得到的是一个list列表，对应每张预测特征图映射回原图的anchors坐标信息
-        anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, strides)
-
-        anchors = torch.jit.annotate(List[List[torch.Tensor]], [])
-        # 遍历一个batch中的每张图像
-        for i, (image_height, image_width) in enumerate(image_list.image_sizes):
-            anchors_in_image = []
-            # 遍历每张预测特征图映射回原图的anchors坐标信息
-            for anchors_per_feature_map in anchors_over_all_feature_maps:
-                anchors_in_image.append(anchors_per_feature_map)
-            anchors.append(anchors_in_image)
-        # 将每一张图像的所有预测特征层的anchors坐标信息拼接在一起
-        # anchors是个list，每个元素为一张图像的所有anchors信息
-        anchors = [torch.cat(anchors_per_image) for anchors_per_image in anchors]
-        # Clear the cache in case that memory leaks.
-        self._cache.clear()
+        # 得到的是所有预测特征层的anchors拼接在一起的结果
+        if torchvision._is_tracing():
+            # tracing时尺寸是动态的, 不使用缓存
+            strides = [[torch.tensor(image_size[0] // g[0], dtype=torch.int64, device=device),
+                        torch.tensor(image_size[1] // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
+            anchors_over_all_feature_maps = torch.cat(self.grid_anchors(grid_sizes, strides))
+        else:
+            grid_sizes = [[int(g[0]), int(g[1])] for g in grid_sizes]
+            strides = [[int(image_size[0]) // g[0], int(image_size[1]) // g[1]] for g in grid_sizes]
+            anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, strides, dtype, device)
+
+        # 一个batch中的所有图像尺寸(padding后)相同, anchors也相同
+        # 每张图像共享同一个anchors tensor, 不再复制, 后续只能读取不能原地修改
+        anchors = [anchors_over_all_feature_maps for _ in image_list.image_sizes]
         return anchors
 
 
@@ -332,6 +366,9 @@ class RegionProposalNetwork(torch.nn.Module):
             contain two fields: training and testing, to allow for different values depending
             on training or evaluation
         nms_thresh (float): NMS threshold used for postprocessing the RPN proposals
+        batched_filter (bool): 是否使用filter_proposals_batched, 整个batch只进行一次batched_nms
+        matcher_memory_budget (int): 不为None时使用ChunkedMatcher分块计算anchors与gt的iou，
+            每块最多使用matcher_memory_budget字节, 不会生成完整的iou矩阵
 
     """
     __annotations__ = {
@@ -345,7 +382,8 @@ class RegionProposalNetwork(torch.nn.Module):
     def __init__(self, anchor_generator, head,
                  fg_iou_thresh, bg_iou_thresh,
                  batch_size_per_image, positive_fraction,
-                 pre_nms_top_n, post_nms_top_n, nms_thresh, score_thresh=0.0):
+                 pre_nms_top_n, post_nms_top_n, nms_thresh, score_thresh=0.0,
+                 batched_filter=False, matcher_memory_budget=None):
         super(RegionProposalNetwork, self).__init__()
         self.anchor_generator = anchor_generator
         self.head = head
@@ -355,11 +393,19 @@ class RegionProposalNetwork(torch.nn.Module):
         # 计算anchors与真实bbox的iou
         self.box_similarity = box_ops.box_iou
 
-        self.proposal_matcher = det_utils.Matcher(
-            fg_iou_thresh,  # 当iou大于fg_iou_thresh(0.7)时视为正样本
-            bg_iou_thresh,  # 当iou小于bg_iou_thresh(0.3)时视为负样本
-            allow_low_quality_matches=True
-        )
+        if matcher_memory_budget is None:
+            self.proposal_matcher = det_utils.Matcher(
+                fg_iou_thresh,  # 当iou大于fg_iou_thresh(0.7)时视为正样本
+                bg_iou_thresh,  # 当iou小于bg_iou_thresh(0.3)时视为负样本
+                allow_low_quality_matches=True
+            )
+        else:
+            # 分块计算iou, 避免gt很多时生成巨大的iou矩阵
+            self.proposal_matcher = det_utils.ChunkedMatcher(
+                fg_iou_thresh, bg_iou_thresh,
+                allow_low_quality_matches=True,
+                memory_budget=matcher_memory_budget
+            )
 
         self.fg_bg_sampler = det_utils.BalancedPositiveNegativeSampler(
             batch_size_per_image, positive_fraction  # 256, 0.5
@@ -371,6 +417,7 @@ class RegionProposalNetwork(torch.nn.Module):
         self.nms_thresh = nms_thresh
         self.score_thresh = score_thresh
         self.min_size = 1.
+        self.batched_filter = batched_filter
 
     def pre_nms_top_n(self):
         if self.training:
@@ -404,11 +451,15 @@ class RegionProposalNetwork(torch.nn.Module):
                 matched_gt_boxes_per_image = torch.zeros(anchors_per_image.shape, dtype=torch.float32, device=device)
                 labels_per_image = torch.zeros((anchors_per_image.shape[0],), dtype=torch.float32, device=device)
             else:
-                # 计算anchors与真实bbox的iou信息
-                # set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
-                match_quality_matrix = box_ops.box_iou(gt_boxes, anchors_per_image)
-                # 计算每个anchors与gt匹配iou最大的索引（如果iou<0.3索引置为-1，0.3<iou<0.7索引为-2）
-                matched_idxs = self.proposal_matcher(match_quality_matrix)
+                if isinstance(self.proposal_matcher, det_utils.ChunkedMatcher):
+                    # 分块计算iou并匹配, 不生成完整的iou矩阵
+                    matched_idxs = self.proposal_matcher.match_boxes(gt_boxes, anchors_per_image)
+                else:
+                    # 计算anchors与真实bbox的iou信息
+                    # set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
+                    match_quality_matrix = box_ops.box_iou(gt_boxes, anchors_per_image)
+                    # 计算每个anchors与gt匹配iou最大的索引（如果iou<0.3索引置为-1，0.3<iou<0.7索引为-2）
+                    matched_idxs = self.proposal_matcher(match_quality_matrix)
                 # get the targets corresponding GT for each proposal
                 # NB: need to clamp the indices because we can have a single
                 # GT in the image, and matched_idxs can be -2, which goes
@@ -456,32 +507,36 @@ class RegionProposalNetwork(torch.nn.Module):
             offset += num_anchors
         return torch.cat(r, dim=1)
 
-    def filter_proposals(self, proposals, objectness, image_shapes, num_anchors_per_level):
-        # type: (Tensor, Tensor, List[Tuple[int, int]], List[int]) -> Tuple[List[Tensor], List[Tensor]]
+    def _select_top_n(self, objectness, num_images, num_anchors_per_level):
+        # type: (Tensor, int, List[int]) -> Tuple[Tensor, Tensor, Tensor, Tensor]
         """
-        筛除小boxes框，nms处理，根据预测概率获取前post_nms_top_n个目标
+        获取每张预测特征图上预测概率排前pre_nms_top_n的anchors索引值，以及对应的概率和层索引
         Args:
-            proposals: 预测的bbox坐标
-            objectness: 预测的目标概率
-            image_shapes: batch中每张图片的size信息
+            objectness: 预测的目标概率(logits)
+            num_images: batch_size
             num_anchors_per_level: 每个预测特征层上预测anchors的数目
 
         Returns:
-
+            top_n_idx: [batch_size, K] 每张图像选中的anchors索引
+            batch_idx: [batch_size, 1] 图像索引, 用于配合top_n_idx取值
+            objectness_prob: [batch_size, K] 选中anchors的目标概率(sigmoid后)
+            levels: [batch_size, K] 选中anchors所在的预测特征层索引
         """
-        num_images = proposals.shape[0]
-        device = proposals.device
+        device = objectness.device
 
+        # 预测目标概率去掉梯度并变为二维
         # do not backprop throught objectness
         objectness = objectness.detach()
-        objectness = objectness.reshape(num_images, -1)
+        objectness = objectness.reshape(num_images, -1) # [b, -1]
 
         # Returns a tensor of size size filled with fill_value
         # levels负责记录分隔不同预测特征层上的anchors索引信息
+        # torch.full(形状, 填充数据) idx是 0 1 2... 用来区别多层数据
         levels = [torch.full((n, ), idx, dtype=torch.int64, device=device)
                   for idx, n in enumerate(num_anchors_per_level)]
         levels = torch.cat(levels, 0)
 
+        # 将mask形状变为和预测
         # Expand this tensor to the same size as objectness
         levels = levels.reshape(1, -1).expand_as(objectness)
 
@@ -495,11 +550,73 @@ class RegionProposalNetwork(torch.nn.Module):
         # 根据每个预测特征层预测概率排前pre_nms_top_n的anchors索引值获取相应概率信息
         objectness = objectness[batch_idx, top_n_idx]
         levels = levels[batch_idx, top_n_idx]
-        # 预测概率排前pre_nms_top_n的anchors索引值获取相应bbox坐标信息
-        proposals = proposals[batch_idx, top_n_idx]
 
         objectness_prob = torch.sigmoid(objectness)
+        return top_n_idx, batch_idx, objectness_prob, levels
 
+    def _decode_top_n(self, pred_bbox_deltas, anchors, top_n_idx, objectness_prob):
+        # type: (Tensor, List[Tensor], Tensor, Tensor) -> Tensor
+        """
+        先选择再解码: 只对每层预测概率排前pre_nms_top_n的anchors解码
+        训练时计算损失用的是原始的pred_bbox_deltas, 不受影响
+        Args:
+            pred_bbox_deltas: [batch_size * num_anchors, 4] 预测的bbox regression参数
+            anchors: List[Tensor] 每张图像的anchors
+            top_n_idx: [batch_size, K] _select_top_n选中的anchors索引
+            objectness_prob: [batch_size, K] 选中anchors的目标概率
+
+        Returns:
+            proposals: [batch_size, K, 4] 解码后的bbox坐标
+                       概率小于score_thresh的位置不解码(补0), 它们会在后面的筛选中被移除
+        """
+        num_images, num_selected = top_n_idx.shape
+
+        # note that we detach the deltas because Faster R-CNN do not backprop through
+        # the proposals
+        # 只取出选中anchors的回归参数以及anchors坐标
+        batch_idx = torch.arange(num_images, device=top_n_idx.device)[:, None]
+        rel_codes = pred_bbox_deltas.detach().reshape(num_images, -1, 4)[batch_idx, top_n_idx].reshape(-1, 4)
+        boxes = torch.stack([a[idx] for a, idx in zip(anchors, top_n_idx)]).reshape(-1, 4)
+
+        if self.score_thresh > 0 and not torchvision._is_tracing():
+            # 提前移除小概率boxes, 只解码概率>=score_thresh的anchors
+            keep = torch.where(torch.ge(objectness_prob.flatten(), self.score_thresh))[0]
+            proposals = rel_codes.new_zeros((num_images * num_selected, 4))
+            proposals[keep] = self.box_coder.decode_single(rel_codes[keep], boxes[keep])
+        else:
+            proposals = self.box_coder.decode_single(rel_codes, boxes)
+        return proposals.reshape(num_images, num_selected, 4)
+
+    def filter_proposals(self, proposals, objectness, image_shapes, num_anchors_per_level):
+        # type: (Tensor, Tensor, List[Tuple[int, int]], List[int]) -> Tuple[List[Tensor], List[Tensor]]
+        """
+        筛除小boxes框，nms处理，根据预测概率获取前post_nms_top_n个目标
+        Args:
+            proposals: 预测的bbox坐标
+            objectness: 预测的目标概率
+            image_shapes: batch中每张图片的size信息
+            num_anchors_per_level: 每个预测特征层上预测anchors的数目
+
+        Returns:
+
+        """
+        num_images = proposals.shape[0]
+        top_n_idx, batch_idx, objectness_prob, levels = self._select_top_n(objectness, num_images,
+                                                                           num_anchors_per_level)
+        # 预测概率排前pre_nms_top_n的anchors索引值获取相应bbox坐标信息
+        proposals = proposals[batch_idx, top_n_idx]
+        return self._filter_top_n_proposals(proposals, objectness_prob, levels, image_shapes)
+
+    def _filter_top_n_proposals(self, proposals, objectness_prob, levels, image_shapes):
+        # type: (Tensor, Tensor, Tensor, List[Tuple[int, int]]) -> Tuple[List[Tensor], List[Tensor]]
+        """
+        对已经选出的前pre_nms_top_n个proposals逐张图像进行筛选
+        Args:
+            proposals: [batch_size, K, 4] 选中的bbox坐标
+            objectness_prob: [batch_size, K] 选中的目标概率
+            levels: [batch_size, K] 选中的proposals所在的预测特征层索引
+            image_shapes: batch中每张图片的size信息
+        """
         final_boxes = []
         final_scores = []
         # 遍历每张图像的相关预测信息
@@ -516,9 +633,11 @@ class RegionProposalNetwork(torch.nn.Module):
             keep = torch.where(torch.ge(scores, self.score_thresh))[0]  # ge: >=
             boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
 
+            # 非极大值抑制
             # non-maximum suppression, independently done per level
             keep = box_ops.batched_nms(boxes, scores, lvl, self.nms_thresh)
 
+            # 只要前n个
             # keep only topk scoring predictions
             keep = keep[: self.post_nms_top_n()]
             boxes, scores = boxes[keep], scores[keep]
@@ -527,6 +646,80 @@ class RegionProposalNetwork(torch.nn.Module):
             final_scores.append(scores)
         return final_boxes, final_scores
 
+    def filter_proposals_batched(self, proposals, objectness, image_shapes, num_anchors_per_level):
+        # type: (Tensor, Tensor, List[Tuple[int, int]], List[int]) -> Tuple[Tensor, Tensor, Tensor]
+        """
+        filter_proposals的batch版本，结果与filter_proposals相同
+        将图像索引合并到nms的分组key中(图像索引 * 层数 + 层索引)，整个batch只进行一次batched_nms
+        Args:
+            proposals: 预测的bbox坐标
+            objectness: 预测的目标概率
+            image_shapes: batch中每张图片的size信息
+            num_anchors_per_level: 每个预测特征层上预测anchors的数目
+
+        Returns:
+            boxes: [batch_size, post_nms_top_n, 4] 每张图像保留的proposals, 不足的部分补0
+            scores: [batch_size, post_nms_top_n] 对应的概率, 不足的部分补0
+            num_per_image: [batch_size] 每张图像实际保留的proposals个数
+        """
+        num_images = proposals.shape[0]
+        top_n_idx, batch_idx, objectness_prob, levels = self._select_top_n(objectness, num_images,
+                                                                           num_anchors_per_level)
+        proposals = proposals[batch_idx, top_n_idx]
+        return self._filter_top_n_proposals_batched(proposals, objectness_prob, levels, image_shapes,
+                                                    len(num_anchors_per_level))
+
+    def _filter_top_n_proposals_batched(self, proposals, objectness_prob, levels, image_shapes, num_levels):
+        # type: (Tensor, Tensor, Tensor, List[Tuple[int, int]], int) -> Tuple[Tensor, Tensor, Tensor]
+        """
+        对已经选出的前pre_nms_top_n个proposals整个batch一起进行筛选
+        Args:
+            proposals: [batch_size, K, 4] 选中的bbox坐标
+            objectness_prob: [batch_size, K] 选中的目标概率
+            levels: [batch_size, K] 选中的proposals所在的预测特征层索引
+            image_shapes: batch中每张图片的size信息
+            num_levels: 预测特征层个数
+        """
+        num_images = proposals.shape[0]
+        device = proposals.device
+        image_idx = torch.arange(num_images, device=device)[:, None].expand_as(levels)
+
+        # 一次性将所有图像的越界坐标调整到各自的图片边界上
+        # image_shapes: [batch_size, 2] (height, width)
+        image_shapes_tensor = torch.as_tensor(image_shapes, dtype=proposals.dtype, device=device)
+        heights = image_shapes_tensor[:, 0].reshape(-1, 1, 1)
+        widths = image_shapes_tensor[:, 1].reshape(-1, 1, 1)
+        boxes_x = torch.min(proposals[..., 0::2].clamp(min=0), widths)   # x1, x2
+        boxes_y = torch.min(proposals[..., 1::2].clamp(min=0), heights)  # y1, y2
+        boxes = torch.stack((boxes_x, boxes_y), dim=3).reshape(proposals.shape)
+
+        # 移除小boxes以及小概率boxes
+        ws, hs = boxes[..., 2] - boxes[..., 0], boxes[..., 3] - boxes[..., 1]
+        valid = torch.ge(ws, self.min_size) & torch.ge(hs, self.min_size) & torch.ge(objectness_prob, self.score_thresh)
+        keep = torch.where(valid.flatten())[0]
+        boxes = boxes.reshape(-1, 4)[keep]
+        scores = objectness_prob.flatten()[keep]
+        lvl = levels.flatten()[keep]
+        img = image_idx.flatten()[keep]
+
+        # 非极大值抑制, 每张图像的每一层是一个独立的分组
+        # keep按照score降序排列
+        keep = box_ops.batched_nms(boxes, scores, img * num_levels + lvl, self.nms_thresh)
+        img = img[keep]
+
+        # 计算每个box在所属图像中的排名，只保留每张图像的前post_nms_top_n个
+        post_nms_top_n = self.post_nms_top_n()
+        rank = F.one_hot(img, num_images).cumsum(dim=0).gather(1, img[:, None]).squeeze(1) - 1
+        top = torch.lt(rank, post_nms_top_n)
+        keep, img, rank = keep[top], img[top], rank[top]
+
+        final_boxes = boxes.new_zeros((num_images, post_nms_top_n, 4))
+        final_scores = scores.new_zeros((num_images, post_nms_top_n))
+        final_boxes[img, rank] = boxes[keep]
+        final_scores[img, rank] = scores[keep]
+        num_per_image = torch.bincount(img, minlength=num_images)
+        return final_boxes, final_scores, num_per_image
+
     def compute_loss(self, objectness, pred_bbox_deltas, labels, regression_targets):
         # type: (Tensor, Tensor, List[Tensor], List[Tensor]) -> Tuple[Tensor, Tensor]
         """
@@ -542,12 +735,8 @@ class RegionProposalNetwork(torch.nn.Module):
             box_loss (Tensor)：边界框回归损失
         """
         # 按照给定的batch_size_per_image, positive_fraction选择正负样本
-        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
-        # 将一个batch中的所有正负样本List(Tensor)分别拼接在一起，并获取非零位置的索引
-        # sampled_pos_inds = torch.nonzero(torch.cat(sampled_pos_inds, dim=0)).squeeze(1)
-        sampled_pos_inds = torch.where(torch.cat(sampled_pos_inds, dim=0))[0]
-        # sampled_neg_inds = torch.nonzero(torch.cat(sampled_neg_inds, dim=0)).squeeze(1)
-        sampled_neg_inds = torch.where(torch.cat(sampled_neg_inds, dim=0))[0]
+        # 整个batch一起采样, 直接返回拼接后所有正负样本的索引
+        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler.sample_indices(labels)
 
         # 将所有正负样本索引拼接在一起
         sampled_inds = torch.cat([sampled_pos_inds, sampled_neg_inds], dim=0)
@@ -616,15 +805,23 @@ class RegionProposalNetwork(torch.nn.Module):
         objectness, pred_bbox_deltas = concat_box_prediction_layers(objectness,
                                                                     pred_bbox_deltas)
 
+        # 先根据预测概率选出每层前pre_nms_top_n个anchors
+        top_n_idx, _, objectness_prob, levels = self._select_top_n(objectness, num_images, num_anchors_per_level)
+
         # apply pred_bbox_deltas to anchors to obtain the decoded proposals
-        # note that we detach the deltas because Faster R-CNN do not backprop through
-        # the proposals
-        # 将预测的bbox regression参数应用到anchors上得到最终预测bbox坐标
-        proposals = self.box_coder.decode(pred_bbox_deltas.detach(), anchors)
-        proposals = proposals.view(num_images, -1, 4)
+        # 将预测的bbox regression参数应用到选中的anchors上得到最终预测bbox坐标, 其余anchors不需要解码
+        proposals = self._decode_top_n(pred_bbox_deltas, anchors, top_n_idx, objectness_prob)
 
         # 筛除小boxes框，nms处理，根据预测概率获取前post_nms_top_n个目标
-        boxes, scores = self.filter_proposals(proposals, objectness, images.image_sizes, num_anchors_per_level)
+        if self.batched_filter:
+            boxes, scores, num_per_image = self._filter_top_n_proposals_batched(
+                proposals, objectness_prob, levels, images.image_sizes, len(num_anchors_per_level))
+            # 去掉padding部分, 还原为每张图像一个Tensor
+            num_per_image = num_per_image.tolist()
+            boxes = [b[:n] for b, n in zip(boxes, num_per_image)]
+            scores = [s[:n] for s, n in zip(scores, num_per_image)]
+        else:
+            boxes, scores = self._filter_top_n_proposals(proposals, objectness_prob, levels, images.image_sizes)
 
         losses = {}
         if self.training:
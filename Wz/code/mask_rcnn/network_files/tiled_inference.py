@@ -0,0 +1,174 @@
+import math
+from typing import List, Tuple, Dict, Union
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from . import boxes as box_ops
+
+
+def get_tile_starts(length, tile_size, overlap):
+    # type: (int, int, int) -> List[int]
+    """
+    计算一个方向上每个tile的起始坐标
+    tile均匀分布, 第一个和最后一个tile分别与图像两侧对齐, 相邻tile至少重叠overlap个像素
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    num_tiles = int(math.ceil((length - tile_size) / stride)) + 1
+    return [int(round(i * (length - tile_size) / (num_tiles - 1))) for i in range(num_tiles)]
+
+
+def get_tiles(height, width, tile_size, overlap):
+    # type: (int, int, Tuple[int, int], float) -> List[Tuple[int, int, int, int]]
+    """
+    Args:
+        height, width: 图像的高宽
+        tile_size: tile的(高, 宽)
+        overlap: 相邻tile重叠部分占tile边长的比例
+
+    Returns:
+        每个tile在原图中的位置(x1, y1, x2, y2)
+    """
+    tile_h, tile_w = tile_size
+    ys = get_tile_starts(height, tile_h, int(tile_h * overlap))
+    xs = get_tile_starts(width, tile_w, int(tile_w * overlap))
+    return [(x, y, min(x + tile_w, width), min(y + tile_h, height)) for y in ys for x in xs]
+
+
+def _downscale_image(image, min_size, max_size):
+    # type: (Tensor, float, float) -> Tuple[Tensor, float]
+    """将整张图像缩小到模型预处理时的尺寸, 在cpu上完成缩放, 不需要将原分辨率的图像拷贝到device上"""
+    height, width = image.shape[-2:]
+    scale = min(min_size / min(height, width), max_size / max(height, width))
+    if scale >= 1.:
+        return image, 1.
+    image = F.interpolate(image[None], scale_factor=scale, mode="bilinear",
+                          recompute_scale_factor=True, align_corners=False)[0]
+    # 使用实际缩放后的尺寸计算比例
+    return image, image.shape[-1] / width
+
+
+def _crop_masks(masks, boxes, offset, scale, mask_thresh, height, width):
+    # type: (Tensor, Tensor, Tuple[int, int], float, float, int, int) -> Tuple[List[Tensor], Tensor]
+    """
+    只保留每个目标box范围内的mask(二值化后放到cpu上), 避免为每个目标保存原图大小的mask
+    Args:
+        masks: [N, 1, h, w] 模型输出的mask(tile或缩小后的整张图像中的坐标)
+        boxes: [N, 4] 原图坐标
+        offset: tile左上角在原图中的坐标(x, y)
+        scale: masks相对原图的缩放比例
+        height, width: 原图的高宽
+
+    Returns:
+        crops: 每个目标box范围内的mask, shape [y2 - y1, x2 - x1]
+        mask_boxes: [N, 4] 每个mask在原图中的位置(x1, y1, x2, y2), 整数
+    """
+    mask_boxes = torch.stack([boxes[:, 0].floor().clamp(0, width - 1),
+                              boxes[:, 1].floor().clamp(0, height - 1),
+                              boxes[:, 2].ceil().clamp(1, width),
+                              boxes[:, 3].ceil().clamp(1, height)], dim=1).to(torch.int64)
+    # 保证mask至少有一个像素
+    mask_boxes[:, 2:] = torch.max(mask_boxes[:, 2:], mask_boxes[:, :2] + 1)
+
+    mask_h, mask_w = masks.shape[-2:]
+    crops = []
+    for mask, (x1, y1, x2, y2) in zip(masks, mask_boxes.tolist()):
+        # 原图坐标 -> masks中的坐标
+        mx1 = min(max(int((x1 - offset[0]) * scale), 0), mask_w - 1)
+        my1 = min(max(int((y1 - offset[1]) * scale), 0), mask_h - 1)
+        mx2 = min(max(int(math.ceil((x2 - offset[0]) * scale)), mx1 + 1), mask_w)
+        my2 = min(max(int(math.ceil((y2 - offset[1]) * scale)), my1 + 1), mask_h)
+        crop = mask[:, my1:my2, mx1:mx2]
+        if crop.shape[-2:] != (y2 - y1, x2 - x1):
+            crop = F.interpolate(crop[None], size=(y2 - y1, x2 - x1), mode="bilinear", align_corners=False)[0]
+        crops.append(torch.gt(crop[0], mask_thresh).cpu())
+    return crops, mask_boxes.cpu()
+
+
+@torch.no_grad()
+def tiled_inference(model,
+                    image,                  # type: Tensor
+                    tile_size=(800, 800),   # type: Tuple[int, int]
+                    overlap=0.2,            # type: float
+                    batch_size=4,           # type: int
+                    iou_threshold=0.5,      # type: float
+                    full_image=True,        # type: bool
+                    detections_per_img=-1,  # type: int
+                    mask_thresh=0.5         # type: float
+                    ):
+    # type: (...) -> Dict[str, Union[Tensor, List[Tensor]]]
+    """
+    将高分辨率图像切分成相互重叠的tile, 以batch为单位送入模型预测,
+    再将每个tile的预测结果映射回原图坐标, 最后通过按类别的nms合并tile重叠处的重复目标
+    同一时刻只有batch_size个tile在device上, 显存占用与原图大小无关
+
+    Args:
+        model: eval模式下的MaskRCNN(或FasterRCNN)
+        image: [C, H, W] 没有标准化的图像, 可以放在cpu上, 每个tile会被单独拷贝到模型所在的device
+        tile_size: tile的(高, 宽), 建议与模型预处理的min_size相同, 这样tile不会被再次缩放
+        overlap: 相邻tile重叠部分占tile边长的比例, 应大于需要检测的目标的尺寸
+        batch_size: 每次送入模型的tile数量
+        iou_threshold: 合并时nms使用的iou阈值
+        full_image: 是否额外对缩小后的整张图像预测一次, 用于检测跨越多个tile的大目标
+        detections_per_img: 合并后最多保留的目标个数, 小于0表示不限制
+        mask_thresh: mask二值化的阈值
+
+    Returns:
+        boxes(原图坐标), labels, scores与模型每张图像的输出相同
+        MaskRCNN还会返回:
+            masks: List[Tensor], 每个目标box范围内的二值mask(bool, cpu), 而不是原图大小的mask
+            mask_boxes: [N, 4] 每个mask在原图中的位置(x1, y1, x2, y2)
+    """
+    device = next(model.parameters()).device
+    height, width = image.shape[-2:]
+    tiles = get_tiles(height, width, tile_size, overlap)
+
+    all_boxes, all_scores, all_labels = [], [], []
+    all_masks = []  # type: List[Tensor]
+    all_mask_boxes = []
+    for i in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[i:i + batch_size]
+        crops = [image[:, y1:y2, x1:x2].to(device) for x1, y1, x2, y2 in batch_tiles]
+        outputs = model(crops)
+        for (x1, y1, _, _), output in zip(batch_tiles, outputs):
+            # tile中的坐标加上tile左上角的坐标, 映射回原图
+            offset = torch.tensor([x1, y1, x1, y1], dtype=output["boxes"].dtype, device=device)
+            boxes = output["boxes"] + offset
+            all_boxes.append(boxes)
+            all_scores.append(output["scores"])
+            all_labels.append(output["labels"])
+            if "masks" in output:
+                crops, mask_boxes = _crop_masks(output["masks"], boxes, (x1, y1), 1., mask_thresh, height, width)
+                all_masks.extend(crops)
+                all_mask_boxes.append(mask_boxes)
+
+    if full_image and len(tiles) > 1:
+        min_size = float(model.transform.min_size[-1])
+        max_size = float(model.transform.max_size)
+        small_image, scale = _downscale_image(image, min_size, max_size)
+        output = model([small_image.to(device)])[0]
+        boxes = output["boxes"] / scale
+        all_boxes.append(boxes)
+        all_scores.append(output["scores"])
+        all_labels.append(output["labels"])
+        if "masks" in output:
+            crops, mask_boxes = _crop_masks(output["masks"], boxes, (0, 0), scale, mask_thresh, height, width)
+            all_masks.extend(crops)
+            all_mask_boxes.append(mask_boxes)
+
+    boxes = torch.cat(all_boxes, dim=0)
+    scores = torch.cat(all_scores, dim=0)
+    labels = torch.cat(all_labels, dim=0)
+
+    # 同一个目标可能在多个tile中被检测到, 按类别执行nms合并
+    keep = box_ops.batched_nms(boxes, scores, labels, iou_threshold)
+    if detections_per_img >= 0:
+        keep = keep[:detections_per_img]
+    result = {"boxes": boxes[keep], "labels": labels[keep], "scores": scores[keep]}
+    if len(all_mask_boxes) > 0:
+        result["masks"] = [all_masks[k] for k in keep.tolist()]
+        result["mask_boxes"] = torch.cat(all_mask_boxes, dim=0)[keep.cpu()]
+    return result
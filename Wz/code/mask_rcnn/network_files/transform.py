@@ -205,8 +205,56 @@ def paste_mask_in_image(mask, box, im_h, im_w):
     return im_mask
 
 
-def paste_masks_in_image(masks, boxes, img_shape, padding=1):
-    # type: (Tensor, Tensor, Tuple[int, int], int) -> Tensor
+# 在gpu上一次粘贴的masks占用的最大显存(字节), 用于自动计算chunk_size
+PASTE_MEMORY_LIMIT = 1024 ** 3
+
+
+def _paste_weights(start, end, M, region_start, region_end, dtype):
+    # type: (Tensor, Tensor, int, int, int, torch.dtype) -> Tensor
+    """
+    一个方向上的双线性插值权重, 与paste_mask_in_image中
+    F.interpolate(mode='bilinear', align_corners=False)把长度为M的mask缩放到box长度后粘贴的结果相同
+    Args:
+        start, end: [N] box在该方向上的起止坐标(整数, 包括end)
+        M: mask在该方向上的长度
+        region_start, region_end: 需要计算的图像坐标范围[region_start, region_end)
+
+    Returns:
+        weights: [N, region_end - region_start, M], box范围以外的像素权重为0
+    """
+    device = start.device
+    pos = torch.arange(region_start, region_end, device=device, dtype=dtype)
+    local = pos[None, :] - start[:, None].to(dtype)  # 像素在box内的坐标, [N, L]
+    extent = (end - start + 1).to(dtype)
+    # 与F.interpolate相同: 源坐标 = (目标坐标 + 0.5) * M / 输出长度 - 0.5, 超出边界的取边界值
+    scale = M / extent.clamp(min=1)
+    src = ((local + 0.5) * scale[:, None] - 0.5).clamp(min=0, max=M - 1)
+    # 三角核: 距离源坐标小于1的两个元素按距离线性加权
+    weights = (1 - (src[:, :, None] - torch.arange(M, device=device, dtype=dtype)).abs()).clamp(min=0)
+    inside = (local >= 0) & (local < extent[:, None])
+    return weights * inside[:, :, None].to(dtype)
+
+
+def paste_masks_in_image(masks, boxes, img_shape, padding=1, chunk_size=None, mask_thresh=None,
+                         mask_dtype=torch.bool):
+    # type: (Tensor, Tensor, Tuple[int, int], int, Optional[int], Optional[float], torch.dtype) -> Tensor
+    """
+    将每个目标的mask缩放后粘贴到原图尺寸上
+    结果与逐个调用paste_mask_in_image相同(浮点误差范围内), 但每次处理chunk_size个目标:
+    双线性插值拆成两个方向的插值权重, 通过两次bmm一次算出一组目标在它们的box并集范围内的mask,
+    直接写入预先分配好的输出中, 不会为每个目标单独创建原图大小的临时tensor
+    Args:
+        masks: [N, 1, M, M] mask分支预测的概率
+        boxes: [N, 4] 原图尺度上的boxes
+        img_shape: 原图的(高, 宽)
+        padding: mask四周填充的像素数
+        chunk_size: 每次粘贴的目标个数, None时cpu上为1(只计算box范围), gpu上根据PASTE_MEMORY_LIMIT计算
+        mask_thresh: 不为None时输出mask > mask_thresh的二值mask, 内存占用只有float的1/4
+        mask_dtype: 二值mask的类型, torch.bool或torch.uint8
+
+    Returns:
+        [N, 1, H, W]
+    """
     masks, scale = expand_masks(masks, padding=padding)
     boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
     im_h, im_w = img_shape
@@ -215,14 +263,109 @@ def paste_masks_in_image(masks, boxes, img_shape, padding=1):
         return _onnx_paste_mask_in_image_loop(
             masks, boxes, torch.scalar_tensor(im_h, dtype=torch.int64), torch.scalar_tensor(im_w, dtype=torch.int64)
         )[:, None]
-    res = [paste_mask_in_image(m[0], b, im_h, im_w) for m, b in zip(masks, boxes)]
-    if len(res) > 0:
-        ret = torch.stack(res, dim=0)[:, None]
-    else:
-        ret = masks.new_empty((0, 1, im_h, im_w))
+
+    num_masks = masks.shape[0]
+    out_dtype = masks.dtype if mask_thresh is None else mask_dtype
+    ret = torch.zeros((num_masks, 1, im_h, im_w), dtype=out_dtype, device=masks.device)
+    if num_masks == 0:
+        return ret
+
+    if chunk_size is None:
+        if masks.device.type == "cpu":
+            chunk_size = 1
+        else:
+            chunk_size = max(1, PASTE_MEMORY_LIMIT // (im_h * im_w * masks.element_size()))
+
+    M_h, M_w = masks.shape[-2:]
+    # 每个chunk只计算box并集与图像相交的范围, boxes一次性拷贝到cpu避免循环中同步
+    boxes_list = boxes.tolist()
+    for start in range(0, num_masks, chunk_size):
+        chunk_boxes = boxes[start:start + chunk_size]
+        chunk_list = boxes_list[start:start + chunk_size]
+        x0 = max(min(b[0] for b in chunk_list), 0)
+        y0 = max(min(b[1] for b in chunk_list), 0)
+        x1 = min(max(b[2] for b in chunk_list) + 1, im_w)
+        y1 = min(max(b[3] for b in chunk_list) + 1, im_h)
+        if x1 <= x0 or y1 <= y0:
+            continue
+
+        weights_x = _paste_weights(chunk_boxes[:, 0], chunk_boxes[:, 2], M_w, x0, x1, masks.dtype)  # [n, w, M]
+        weights_y = _paste_weights(chunk_boxes[:, 1], chunk_boxes[:, 3], M_h, y0, y1, masks.dtype)  # [n, h, M]
+        # [n, h, M] @ [n, M, M] @ [n, M, w] -> [n, h, w]
+        chunk_masks = torch.bmm(weights_y, torch.bmm(masks[start:start + chunk_size, 0], weights_x.transpose(1, 2)))
+        if mask_thresh is not None:
+            chunk_masks = torch.gt(chunk_masks, mask_thresh)
+        ret[start:start + chunk_size, 0, y0:y1, x0:x1] = chunk_masks
     return ret
 
 
+def _binary_mask_to_rle_counts(mask, top, left, im_h, im_w):
+    # type: (Tensor, int, int, int, int) -> Tensor
+    """
+    将原图中(top, left)处的二值mask编码成整张图像的COCO RLE counts(未压缩, 与iscrowd标注的格式相同)
+    RLE按列优先(fortran order)依次记录0和1的长度, 第一个长度对应0
+    mask以外的像素都为0, 所以只需要展开mask所在的列, 不需要创建原图大小的mask
+    """
+    h, w = mask.shape
+    # 每一列上下补0到图像高度后按列展开: [w, im_h] -> [w * im_h]
+    cols = F.pad(mask.t().to(torch.uint8), (top, im_h - top - h)).reshape(-1)
+    # 前后各补一个0, 相邻元素不同的位置就是每段的起始位置
+    zero = cols.new_zeros(1)
+    cols = torch.cat([zero, cols, zero])
+    changes = torch.where(cols[1:] != cols[:-1])[0] + left * im_h
+    total = torch.full((1,), im_h * im_w, dtype=changes.dtype, device=changes.device)
+    positions = torch.cat([changes.new_zeros(1), changes, total])
+    counts = positions[1:] - positions[:-1]
+    # mask在图像右下角结束时最后一段0的长度为0, 去掉(第一段即使为0也需要保留)
+    keep = counts > 0
+    keep[0] = True
+    return counts[keep]
+
+
+def masks_to_rle(masks, boxes, img_shape, mask_thresh=0.5, padding=1):
+    # type: (Tensor, Tensor, Tuple[int, int], float, int) -> Tuple[Tensor, Tensor]
+    """
+    直接由mask分支输出的[M, M]概率以及box得到每个目标在原图上的RLE, 不会创建原图大小的mask
+    每个目标只将mask缩放到box大小(与paste_mask_in_image相同)并二值化, 再编码成RLE
+    Args:
+        masks: [N, 1, M, M] mask分支预测的概率
+        boxes: [N, 4] 原图尺度上的boxes
+        img_shape: 原图的(高, 宽)
+        mask_thresh: 二值化的阈值
+        padding: mask四周填充的像素数
+
+    Returns:
+        counts: [sum(num_runs)] 所有目标的RLE counts拼接在一起
+        num_runs: [N] 每个目标RLE counts的长度, 用于将counts拆分开
+    """
+    masks, scale = expand_masks(masks, padding=padding)
+    boxes = expand_boxes(boxes, scale).to(dtype=torch.int64)
+    im_h, im_w = img_shape
+
+    all_counts = []
+    for mask, box in zip(masks, boxes.tolist()):
+        x0, y0, x1, y1 = box
+        w = max(x1 - x0 + 1, 1)
+        h = max(y1 - y0 + 1, 1)
+        # 与图像相交的范围
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        cx1, cy1 = min(x1 + 1, im_w), min(y1 + 1, im_h)
+        if cx1 <= cx0 or cy1 <= cy0:
+            # 整张图像都为0
+            all_counts.append(torch.full((1,), im_h * im_w, dtype=torch.int64, device=masks.device))
+            continue
+        mask = F.interpolate(mask[None], size=(h, w), mode='bilinear', align_corners=False)[0, 0]
+        mask = torch.gt(mask[(cy0 - y0):(cy1 - y0), (cx0 - x0):(cx1 - x0)], mask_thresh)
+        all_counts.append(_binary_mask_to_rle_counts(mask, cy0, cx0, im_h, im_w))
+
+    num_runs = torch.tensor([c.shape[0] for c in all_counts], dtype=torch.int64)
+    if len(all_counts) > 0:
+        counts = torch.cat(all_counts)
+    else:
+        counts = torch.zeros((0,), dtype=torch.int64, device=masks.device)
+    return counts, num_runs.to(masks.device)
+
+
 class GeneralizedRCNNTransform(nn.Module):
     """
     Performs input / target transformation before feeding the data to a GeneralizedRCNN
@@ -249,16 +392,50 @@ class GeneralizedRCNNTransform(nn.Module):
         self.max_size = max_size      # 指定图像的最大边长范围
         self.image_mean = image_mean  # 指定图像在标准化处理中的均值
         self.image_std = image_std    # 指定图像在标准化处理中的方差
+        # 缓存均值和方差, 不需要每次标准化时重新创建(不保存到state_dict中)
+        self.register_buffer("mean_tensor", torch.as_tensor(image_mean, dtype=torch.float32)[:, None, None],
+                             persistent=False)
+        self.register_buffer("std_tensor", torch.as_tensor(image_std, dtype=torch.float32)[:, None, None],
+                             persistent=False)
+        # 验证模式下重复使用的batch内存, 见_get_batch_buffer
+        self._batch_buffer = torch.jit.annotate(Optional[Tensor], None)
+        # 后处理时粘贴mask的参数, 见paste_masks_in_image
+        self.mask_paste_chunk_size = torch.jit.annotate(Optional[int], None)
+        self.mask_paste_thresh = torch.jit.annotate(Optional[float], None)
+        self.mask_paste_dtype = torch.bool
+        # 为True时后处理输出每个目标的RLE(masks_rle, masks_rle_runs), 而不是原图大小的masks, 见masks_to_rle
+        self.mask_rle_output = False
         self.size_divisible = size_divisible
         self.fixed_size = fixed_size
 
     def normalize(self, image):
         """标准化处理"""
-        dtype, device = image.dtype, image.device
-        mean = torch.as_tensor(self.image_mean, dtype=dtype, device=device)
-        std = torch.as_tensor(self.image_std, dtype=dtype, device=device)
-        # [:, None, None]: shape [3] -> [3, 1, 1]
-        return (image - mean[:, None, None]) / std[:, None, None]
+        # mean, std: shape [3, 1, 1]
+        mean, std = self._get_mean_std(image.dtype, image.device)
+        return (image - mean) / std
+
+    def _get_mean_std(self, dtype, device):
+        # type: (torch.dtype, torch.device) -> Tuple[Tensor, Tensor]
+        """返回缓存的均值和方差, dtype和device相同时to()不会产生拷贝"""
+        return self.mean_tensor.to(dtype=dtype, device=device), self.std_tensor.to(dtype=dtype, device=device)
+
+    def _get_batch_buffer(self, batch_shape, image):
+        # type: (List[int], Tensor) -> Tensor
+        """
+        获取batch_shape大小的tensor用于存放打包后的图像
+        验证模式下重复使用同一块内存(只有在需要更大的内存时才重新分配)
+        训练模式下反向传播还会用到网络的输入, 因此每次都重新分配
+        """
+        if self.training:
+            return image.new_empty(batch_shape)
+        numel = 1
+        for s in batch_shape:
+            numel *= s
+        buffer = self._batch_buffer
+        if buffer is None or buffer.numel() < numel or buffer.dtype != image.dtype or buffer.device != image.device:
+            buffer = image.new_empty([numel])
+            self._batch_buffer = buffer
+        return buffer[:numel].view(batch_shape)
 
     def torch_choice(self, k):
         # type: (List[int]) -> int
@@ -301,6 +478,10 @@ class GeneralizedRCNNTransform(nn.Module):
         bbox = resize_boxes(bbox, [h, w], image.shape[-2:])
         target["boxes"] = bbox
 
+        if "polygons" in target:
+            # 多边形形式的mask(CocoDetection的lazy_masks)直接缩放顶点坐标
+            target["polygons"] = resize_polygons(target["polygons"], [h, w], image.shape[-2:])
+
         return image, target
 
     # _onnx_batch_images() is an implementation of
@@ -376,6 +557,44 @@ class GeneralizedRCNNTransform(nn.Module):
 
         return batched_imgs
 
+    def normalize_batch_images(self, images, size_divisible=32):
+        # type: (List[Tensor], int) -> Tensor
+        """
+        将resize后的一批图像标准化并打包成一个batch
+        标准化的结果直接写入padding后的batch中, 不需要先生成标准化后的图像再拷贝
+        Args:
+            images: resize后(还没有标准化)的一批图片
+            size_divisible: 将图像高和宽调整到该数的整数倍
+
+        Returns:
+            batched_imgs: 标准化并打包成一个batch后的tensor数据
+        """
+        if torchvision._is_tracing():
+            return self.batch_images([self.normalize(img) for img in images], size_divisible)
+
+        # 分别计算一个batch中所有图片中的最大channel, height, width
+        max_size = self.max_by_axis([list(img.shape) for img in images])
+
+        stride = float(size_divisible)
+        # 将height, width向上调整到stride的整数倍
+        max_size[1] = int(math.ceil(float(max_size[1]) / stride) * stride)
+        max_size[2] = int(math.ceil(float(max_size[2]) / stride) * stride)
+
+        # [batch, channel, height, width]
+        batch_shape = [len(images)] + max_size
+        batched_imgs = self._get_batch_buffer(batch_shape, images[0])
+        mean, std = self._get_mean_std(images[0].dtype, images[0].device)
+        for img, pad_img in zip(images, batched_imgs):
+            c, h, w = img.shape
+            # 对齐左上角写入标准化后的图像, 只将padding的部分置0(重复使用的内存中可能有上一个batch的数据)
+            valid = pad_img[:c, :h, :w]
+            torch.sub(img, mean, out=valid)
+            valid.div_(std)
+            pad_img[:, h:, :].zero_()
+            pad_img[:, :h, w:].zero_()
+
+        return batched_imgs
+
     def postprocess(self,
                     result,                # type: List[Dict[str, Tensor]]
                     image_shapes,          # type: List[Tuple[int, int]]
@@ -400,9 +619,18 @@ class GeneralizedRCNNTransform(nn.Module):
             boxes = pred["boxes"]
             boxes = resize_boxes(boxes, im_s, o_im_s)  # 将bboxes缩放回原图像尺度上
             result[i]["boxes"] = boxes
-            if "masks" in pred:
+            if "masks" in pred and self.mask_rle_output:
+                mask_thresh = self.mask_paste_thresh if self.mask_paste_thresh is not None else 0.5
+                counts, num_runs = masks_to_rle(pred["masks"], boxes, o_im_s, mask_thresh=mask_thresh)
+                del result[i]["masks"]
+                result[i]["masks_rle"] = counts
+                result[i]["masks_rle_runs"] = num_runs
+            elif "masks" in pred:
                 masks = pred["masks"]
-                masks = paste_masks_in_image(masks, boxes, o_im_s)
+                masks = paste_masks_in_image(masks, boxes, o_im_s,
+                                             chunk_size=self.mask_paste_chunk_size,
+                                             mask_thresh=self.mask_paste_thresh,
+                                             mask_dtype=self.mask_paste_dtype)
                 result[i]["masks"] = masks
 
         return result
@@ -430,7 +658,7 @@ class GeneralizedRCNNTransform(nn.Module):
             if image.dim() != 3:
                 raise ValueError("images is expected to be a list of 3d tensors "
                                  "of shape [C, H, W], got {}".format(image.shape))
-            image = self.normalize(image)                # 对图像进行标准化处理
+            # 先缩放再标准化(两者都是逐通道的线性变换, 结果相同), 标准化只需处理缩放后的图像
             image, target_index = self.resize(image, target_index)   # 对图像和对应的bboxes缩放到指定范围
             images[i] = image
             if targets is not None and target_index is not None:
@@ -438,7 +666,7 @@ class GeneralizedRCNNTransform(nn.Module):
 
         # 记录resize后的图像尺寸
         image_sizes = [img.shape[-2:] for img in images]
-        images = self.batch_images(images, self.size_divisible)  # 将images打包成一个batch
+        images = self.normalize_batch_images(images, self.size_divisible)  # 标准化并将images打包成一个batch
         image_sizes_list = torch.jit.annotate(List[Tuple[int, int]], [])
 
         for image_size in image_sizes:
@@ -474,6 +702,17 @@ def resize_boxes(boxes, original_size, new_size):
     return torch.stack((xmin, ymin, xmax, ymax), dim=1)
 
 
+def resize_polygons(polygons, original_size, new_size):
+    # type: (Tensor, List[int], List[int]) -> Tensor
+    """
+    将多边形顶点[K, 2](x, y)根据图像的缩放情况进行相应缩放
+    """
+    ratios_height = float(new_size[0]) / float(original_size[0])
+    ratios_width = float(new_size[1]) / float(original_size[1])
+    ratios = torch.tensor([ratios_width, ratios_height], dtype=polygons.dtype, device=polygons.device)
+    return polygons * ratios
+
+
 
 
 
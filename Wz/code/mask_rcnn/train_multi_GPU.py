@@ -60,7 +60,11 @@ def main(args):
 
     # load train data set
     # coco2017 -> annotations -> instances_train2017.json
-    train_dataset = CocoDetection(COCO_root, "train", data_transform["train"])
+    # 指定--draft-decode时JPEG直接解码到接近模型输入的尺寸(与MaskRCNN默认的min_size, max_size一致)
+    draft_size = (800, 1333) if args.draft_decode else None
+    # 指定--lazy-masks时训练集的mask以多边形的形式保存, 计算损失时才生成正样本对应的28x28 mask
+    train_dataset = CocoDetection(COCO_root, "train", data_transform["train"], draft_size=draft_size,
+                                  lazy_masks=args.lazy_masks)
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> train.txt
     # train_dataset = VOCInstances(data_root, year="2012", txt_name="train.txt")
 
@@ -259,6 +263,10 @@ if __name__ == "__main__":
     parser.add_argument("--pretrain", type=bool, default=True, help="load COCO pretrain weights.")
     # 是否使用混合精度训练(需要GPU支持混合精度)
     parser.add_argument("--amp", default=False, help="Use torch.cuda.amp for mixed precision training")
+    # 训练集的mask是否以多边形的形式保存(不生成原图大小的mask)，减少内存占用以及DataLoader传输的数据量
+    parser.add_argument("--lazy-masks", action="store_true", help="keep coco training masks as polygons")
+    # 训练集的JPEG图像是否在解码时直接缩小(PIL draft)，大图可以大幅减少数据读取时间
+    parser.add_argument("--draft-decode", action="store_true", help="decode training JPEGs at reduced scale")
 
     args = parser.parse_args()
 
@@ -2,3 +2,4 @@ from .group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_grou
 from .distributed_utils import init_distributed_mode, save_on_master, mkdir
 from .coco_eval import EvalCOCOMetric
 from .coco_utils import coco_remove_images_without_annotations, convert_coco_poly_mask, convert_to_coco_api
+from .coco_utils import draft_jpeg, get_draft_size, convert_coco_poly_to_tensors
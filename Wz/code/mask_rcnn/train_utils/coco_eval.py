@@ -98,16 +98,25 @@ class EvalCOCOMetric:
                 continue
 
             self.img_ids.append(img_id)
-            per_image_masks = output["masks"]
             per_image_classes = output["labels"].tolist()
             per_image_scores = output["scores"].tolist()
 
-            masks = per_image_masks > 0.5
+            if "masks_rle" in output:
+                # 模型后处理时已经直接编码成RLE(MaskRCNN的mask_rle_output), 只需要压缩counts
+                img_info = self.coco.imgs[img_id]
+                h, w = img_info["height"], img_info["width"]
+                counts = output["masks_rle"].split(output["masks_rle_runs"].tolist())
+                rles = [{"size": [h, w], "counts": c.tolist()} for c in counts]
+                # frPyObjects不支持空列表
+                rles = mask_util.frPyObjects(rles, h, w) if len(rles) > 0 else []
+            else:
+                masks = output["masks"] > 0.5
+                rles = [mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0]
+                        for mask in masks]
 
             res_list = []
             # 遍历每个目标的信息
-            for mask, label, score in zip(masks, per_image_classes, per_image_scores):
-                rle = mask_util.encode(np.array(mask[0, :, :, np.newaxis], dtype=np.uint8, order="F"))[0]
+            for rle, label, score in zip(rles, per_image_classes, per_image_scores):
                 rle["counts"] = rle["counts"].decode("utf-8")
 
                 class_idx = int(label)
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.utils.data
 from pycocotools import mask as coco_mask
@@ -37,6 +39,26 @@ def coco_remove_images_without_annotations(dataset, ids):
     return valid_ids
 
 
+def draft_jpeg(image, size):
+    """
+    通过PIL的draft在JPEG解码时直接在DCT域缩小到原图的1/2, 1/4或1/8，不需要先解码完整的图像再缩放
+    :param image: Image.open得到的还没有解码(load)的图像
+    :param size: 需要的最小(宽, 高)，缩小后的图像宽高都不会小于size
+    :return: 宽高方向实际的缩放比例，非JPEG图像或者不需要缩小时返回(1., 1.)
+    """
+    if image.format != "JPEG":
+        return 1., 1.
+    width, height = image.size
+    image.draft("RGB", size)
+    return image.size[0] / width, image.size[1] / height
+
+
+def get_draft_size(width, height, min_size, max_size):
+    """与GeneralizedRCNNTransform.resize相同的缩放比例，计算模型实际需要的图像尺寸"""
+    scale = min(min_size / min(width, height), max_size / max(width, height))
+    return int(math.ceil(width * scale)), int(math.ceil(height * scale))
+
+
 def convert_coco_poly_mask(segmentations, height, width):
     masks = []
     for polygons in segmentations:
@@ -55,6 +77,33 @@ def convert_coco_poly_mask(segmentations, height, width):
     return masks
 
 
+def convert_coco_poly_to_tensors(segmentations):
+    """
+    将每个目标的多边形标注转换成紧凑的tensor表示, 不生成原图大小的mask
+    训练时在计算mask损失的地方直接在每个正样本proposal的MxM网格上生成mask(见roi_head.py project_polygons_on_boxes)
+    :param segmentations: 每个目标的多边形列表, [[x1, y1, x2, y2, ...], ...]
+    :return: polygons: [K, 2] 所有多边形的顶点(x, y)拼接在一起
+             polygon_lengths: [P] 每个多边形的顶点个数
+             polygon_instances: [P] 每个多边形属于第几个目标
+             有目标的标注不是多边形(RLE)时返回None
+    """
+    points, lengths, instances = [], [], []
+    for obj_idx, polygons in enumerate(segmentations):
+        if not isinstance(polygons, list):
+            return None
+        for poly in polygons:
+            # 少于3个顶点的多边形没有面积, pycocotools生成mask时也会忽略
+            if len(poly) < 6:
+                continue
+            points.extend(poly)
+            lengths.append(len(poly) // 2)
+            instances.append(obj_idx)
+    polygons = torch.as_tensor(points, dtype=torch.float32).reshape(-1, 2)
+    polygon_lengths = torch.as_tensor(lengths, dtype=torch.int64)
+    polygon_instances = torch.as_tensor(instances, dtype=torch.int64)
+    return polygons, polygon_lengths, polygon_instances
+
+
 def convert_to_coco_api(self):
     coco_ds = COCO()
     # annotation IDs need to start at 1, not 0, see torchvision issue #1530
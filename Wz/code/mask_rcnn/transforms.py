@@ -35,4 +35,9 @@ class RandomHorizontalFlip(object):
             target["boxes"] = bbox
             if "masks" in target:
                 target["masks"] = target["masks"].flip(-1)
+            if "polygons" in target:
+                # 多边形顶点的x坐标与bbox相同方式翻转
+                polygons = target["polygons"].clone()
+                polygons[:, 0] = width - polygons[:, 0]
+                target["polygons"] = polygons
         return image, target
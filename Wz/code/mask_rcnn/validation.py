@@ -5,6 +5,7 @@
 
 import os
 import json
+import time
 
 import torch
 from tqdm import tqdm
@@ -15,7 +16,7 @@ from backbone import resnet50_fpn_backbone
 from network_files import MaskRCNN
 from my_dataset_coco import CocoDetection
 from my_dataset_voc import VOCInstances
-from train_utils import EvalCOCOMetric
+from train_utils import EvalCOCOMetric, GroupedBatchSampler, create_aspect_ratio_groups
 
 
 def summarize(self, catId=None):
@@ -92,7 +93,8 @@ def summarize(self, catId=None):
 
 def save_info(coco_evaluator,
               category_index: dict,
-              save_name: str = "record_mAP.txt"):
+              save_name: str = "record_mAP.txt",
+              print_time: str = ""):
     iou_type = coco_evaluator.params.iouType
     print(f"IoU metric: {iou_type}")
     # calculate COCO info for all classes
@@ -110,7 +112,9 @@ def save_info(coco_evaluator,
 
     # 将验证结果保存至txt文件中
     with open(save_name, "w") as f:
-        record_lines = ["COCO results:",
+        record_lines = [print_time,
+                        "",
+                        "COCO results:",
                         print_coco,
                         "",
                         "mAP(IoU=0.5) for each category:",
@@ -118,6 +122,28 @@ def save_info(coco_evaluator,
         f.write("\n".join(record_lines))
 
 
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def register_padding_hook(model):
+    """
+    统计GeneralizedRCNNTransform打包后的batch中有效像素(resize后图像)所占的比例
+    返回的字典会在每次前向传播时更新
+    """
+    padding_stats = {"valid": 0, "total": 0}
+
+    def hook(module, inputs, outputs):
+        image_list = outputs[0]
+        batch, _, height, width = image_list.tensors.shape
+        padding_stats["total"] += batch * height * width
+        padding_stats["valid"] += sum(h * w for h, w in image_list.image_sizes)
+
+    model.transform.register_forward_hook(hook)
+    return padding_stats
+
+
 def main(parser_data):
     device = torch.device(parser_data.device if torch.cuda.is_available() else "cpu")
     print("Using {} device training.".format(device.type))
@@ -143,16 +169,31 @@ def main(parser_data):
     val_dataset = CocoDetection(data_root, "val", data_transform["val"])
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> val.txt
     # val_dataset = VOCInstances(data_root, year="2012", txt_name="val.txt", transforms=data_transform["val"])
-    val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
-                                                     batch_size=batch_size,
-                                                     shuffle=False,
-                                                     pin_memory=True,
-                                                     num_workers=nw,
-                                                     collate_fn=val_dataset.collate_fn)
+    # 按图片高宽比分组组成batch, 使一个batch中图片的尺寸接近, 减少padding
+    # 每张图片恰好被验证一次, COCO指标与batch_size=1时相同(padding带来的数值误差除外)
+    if batch_size > 1 and parser_data.aspect_ratio_group_factor >= 0:
+        val_sampler = torch.utils.data.SequentialSampler(val_dataset)
+        # 统计所有图像高宽比例在bins区间中的位置索引
+        group_ids = create_aspect_ratio_groups(val_dataset, k=parser_data.aspect_ratio_group_factor)
+        val_batch_sampler = GroupedBatchSampler(val_sampler, group_ids, batch_size, fill_incomplete=False)
+        val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
+                                                         batch_sampler=val_batch_sampler,
+                                                         num_workers=nw,
+                                                         pin_memory=True,
+                                                         collate_fn=val_dataset.collate_fn)
+    else:
+        val_dataset_loader = torch.utils.data.DataLoader(val_dataset,
+                                                         batch_size=batch_size,
+                                                         shuffle=False,
+                                                         pin_memory=True,
+                                                         num_workers=nw,
+                                                         collate_fn=val_dataset.collate_fn)
 
     # create model
     backbone = resnet50_fpn_backbone()
-    model = MaskRCNN(backbone, num_classes=args.num_classes + 1)
+    # mask_rle_output: 后处理直接输出每个目标的RLE, 不创建原图大小的masks, 验证时占用的内存和时间更少
+    model = MaskRCNN(backbone, num_classes=args.num_classes + 1, box_nms_method=args.nms_method,
+                     mask_rle_output=args.mask_rle)
 
     # 载入你自己训练好的模型权重
     weights_path = parser_data.weights_path
@@ -161,6 +202,7 @@ def main(parser_data):
     # print(model)
 
     model.to(device)
+    padding_stats = register_padding_hook(model)
 
     # evaluate on the val dataset
     cpu_device = torch.device("cpu")
@@ -168,13 +210,17 @@ def main(parser_data):
     det_metric = EvalCOCOMetric(val_dataset.coco, "bbox", "det_results.json")
     seg_metric = EvalCOCOMetric(val_dataset.coco, "segm", "seg_results.json")
     model.eval()
+    infer_time, num_images = 0., 0
     with torch.inference_mode():
         for image, targets in tqdm(val_dataset_loader, desc="validation..."):
             # 将图片传入指定设备device
             image = list(img.to(device) for img in image)
 
-            # inference
+            # inference(包括后处理中的nms)
+            t_start = time_synchronized()
             outputs = model(image)
+            infer_time += time_synchronized() - t_start
+            num_images += len(image)
 
             outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
             det_metric.update(targets, outputs)
@@ -185,8 +231,17 @@ def main(parser_data):
     det_metric.evaluate()
     seg_metric.evaluate()
 
-    save_info(det_metric.coco_evaluator, category_index, "det_record_mAP.txt")
-    save_info(seg_metric.coco_evaluator, category_index, "seg_record_mAP.txt")
+    print_time = "nms method: {}, inference time(include postprocess): {:.1f}ms/image".format(
+        parser_data.nms_method, infer_time / max(num_images, 1) * 1000)
+    print(print_time)
+
+    print_padding = "batch size: {}, padding efficiency(valid pixels / batch pixels): {:.1%}".format(
+        batch_size, padding_stats["valid"] / max(padding_stats["total"], 1))
+    print(print_padding)
+    print_time = "\n".join([print_time, print_padding])
+
+    save_info(det_metric.coco_evaluator, category_index, "det_record_mAP.txt", print_time)
+    save_info(seg_metric.coco_evaluator, category_index, "seg_record_mAP.txt", print_time)
 
 
 if __name__ == "__main__":
@@ -207,12 +262,21 @@ if __name__ == "__main__":
     # 训练好的权重文件
     parser.add_argument('--weights-path', default='./save_weights/model_25.pth', type=str, help='training weights')
 
-    # batch size(set to 1, don't change)
+    # batch size, 大于1时建议同时按图片高宽比分组(--aspect-ratio-group-factor)
     parser.add_argument('--batch-size', default=1, type=int, metavar='N',
                         help='batch size when validation.')
     # 类别索引和类别名称对应关系
     parser.add_argument('--label-json-path', type=str, default="coco91_indices.json")
 
+    # 后处理使用的nms方法: nms(贪心nms)或matrix(Matrix NMS), 分别验证后可以对比mAP和推理时间
+    parser.add_argument('--nms-method', default='nms', choices=['nms', 'matrix'], help='nms method')
+
+    # 验证时按图片高宽比分组组成batch(batch_size > 1时生效), 小于0表示不分组
+    parser.add_argument('--aspect-ratio-group-factor', default=3, type=int)
+
+    # 模型后处理直接将mask编码成RLE用于验证, 而不是先粘贴成原图大小的mask
+    parser.add_argument('--mask-rle', action='store_true', help='evaluate segm with rle masks from the model')
+
     args = parser.parse_args()
 
     main(args)
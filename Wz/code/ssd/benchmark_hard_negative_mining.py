@@ -0,0 +1,127 @@
+"""
+该脚本用于比较SSD损失中hard negative mining的三种实现(sort: 两次完整排序, threshold: topk阈值, topk: 直接对topk求和)
+在不同batch size下的速度(包括整个Loss的前向和反向传播)，并检查选出的负样本以及损失是否与原先的实现一致
+有大量相同loss时threshold按索引顺序选取, 选中的负样本可能与sort(不稳定排序)不同, 但loss之和相同
+python benchmark_hard_negative_mining.py --batch-sizes 32 64 128
+"""
+
+import time
+import argparse
+
+import torch
+
+from src.utils import dboxes300_coco
+from src.ssd_model import Loss, hard_negative_mask_sort, hard_negative_mask_threshold, hard_negative_loss_topk
+
+MODES = ("sort", "threshold", "topk")
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def random_inputs(batch_size, num_classes, max_pos, device):
+    """随机生成网络输出以及匹配default box后的gt, 每张图像的正样本个数不同"""
+    dboxes = dboxes300_coco()(order="xywh").to(device)
+    num_dboxes = dboxes.shape[0]
+    ploc = torch.randn(batch_size, 4, num_dboxes, device=device, requires_grad=True)
+    plabel = torch.randn(batch_size, num_classes, num_dboxes, device=device, requires_grad=True)
+
+    glabel = torch.zeros(batch_size, num_dboxes, dtype=torch.int64, device=device)
+    for i in range(batch_size):
+        num_pos = int(torch.randint(1, max_pos + 1, (1,)))
+        pos = torch.randperm(num_dboxes, device=device)[:num_pos]
+        glabel[i, pos] = torch.randint(1, num_classes, (num_pos,), device=device)
+    # 正样本的gt box在default box附近
+    gloc = dboxes.t()[None].repeat(batch_size, 1, 1)
+    gloc[:, :2] += torch.randn(batch_size, 2, num_dboxes, device=device) * 0.01
+    gloc[:, 2:] *= torch.exp(torch.randn(batch_size, 2, num_dboxes, device=device) * 0.1)
+    return ploc, plabel, gloc, glabel
+
+
+def stable_reference_mask(con_neg, neg_num):
+    """稳定排序(相同loss索引小的在前)得到的负样本, con_neg的值需要是1/1024的整数倍"""
+    idx = torch.arange(con_neg.shape[1], device=con_neg.device, dtype=torch.float64)
+    key = (con_neg.double() * 1024).round() * con_neg.shape[1] - idx
+    _, order = key.sort(dim=1, descending=True)
+    _, rank = order.sort(dim=1)
+    return torch.lt(rank, neg_num)
+
+
+def check_same(con_neg, neg_num):
+    """
+    随机的loss没有相同值时三种实现必须一致
+    人为构造大量相同值时: 返回threshold选中的负样本是否与sort(原先的实现)相同, 以及loss之和是否相同,
+    threshold必须与稳定排序一致
+    """
+    mask_sort = hard_negative_mask_sort(con_neg, neg_num)
+    mask_threshold = hard_negative_mask_threshold(con_neg, neg_num)
+    loss_mask = (con_neg * mask_threshold.float()).sum(dim=1)
+    loss_topk = hard_negative_loss_topk(con_neg, neg_num)
+    same = torch.equal(mask_sort, mask_threshold) and torch.allclose(loss_mask, loss_topk, rtol=1e-4)
+
+    ties = torch.randint(0, 8, con_neg.shape, device=con_neg.device).float() / 4
+    ties_sort = hard_negative_mask_sort(ties, neg_num)
+    ties_threshold = hard_negative_mask_threshold(ties, neg_num)
+    assert torch.equal(stable_reference_mask(ties, neg_num), ties_threshold)
+    same_ties_mask = torch.equal(ties_sort, ties_threshold)
+    same_ties_loss = torch.allclose((ties * ties_sort.float()).sum(dim=1), (ties * ties_threshold.float()).sum(dim=1))
+    return same, same_ties_mask, same_ties_loss
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time_synchronized()
+    for _ in range(repeats):
+        fn()
+    return (time_synchronized() - t_start) / repeats
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    torch.manual_seed(0)
+    dboxes = dboxes300_coco()
+    losses = {mode: Loss(dboxes, neg_mining=mode).to(device) for mode in MODES}
+
+    # same: 没有相同loss时三种实现的结果以及Loss是否一致
+    # ties mask: 有相同loss时threshold与sort选中的负样本是否相同(不保证相同), ties loss: 此时loss之和是否相同
+    print("{:>10} | {:>13} | {:>18} | {:>13} | {:>15} | {:>20} | {:>15} | {:>5} | {:>10} | {}".format(
+        "batch_size", "sort mask(ms)", "threshold mask(ms)", "topk loss(ms)",
+        "sort fwd+bwd(ms)", "threshold fwd+bwd(ms)", "topk fwd+bwd(ms)", "same", "ties mask", "ties loss"))
+    for batch_size in args.batch_sizes:
+        ploc, plabel, gloc, glabel = random_inputs(batch_size, args.num_classes, args.max_pos, device)
+        pos_num = torch.gt(glabel, 0).sum(dim=1)
+        neg_num = torch.clamp(3 * pos_num, max=glabel.shape[1]).unsqueeze(-1)
+        con_neg = torch.rand(batch_size, glabel.shape[1], device=device)
+        con_neg[torch.gt(glabel, 0)] = 0.
+
+        same, same_ties_mask, same_ties_loss = check_same(con_neg, neg_num)
+        with torch.no_grad():
+            total = [losses[mode](ploc, plabel, gloc, glabel) for mode in MODES]
+        same = same and all(torch.allclose(total[0], t, rtol=1e-4) for t in total[1:])
+
+        t_masks = [benchmark(lambda: hard_negative_mask_sort(con_neg, neg_num), args.repeats),
+                   benchmark(lambda: hard_negative_mask_threshold(con_neg, neg_num), args.repeats),
+                   benchmark(lambda: hard_negative_loss_topk(con_neg, neg_num), args.repeats)]
+        t_losses = [benchmark(lambda: losses[mode](ploc, plabel, gloc, glabel).backward(), args.repeats)
+                    for mode in MODES]
+        print("{:>10} | {:>13.2f} | {:>18.2f} | {:>13.2f} | {:>15.2f} | {:>20.2f} | {:>15.2f} | {:>5} | {:>10} | {}".format(
+            batch_size, *[t * 1000 for t in t_masks + t_losses], same, same_ties_mask, same_ties_loss))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda', help='device')
+    parser.add_argument('--batch-sizes', default=[32, 64, 128], type=int, nargs='+', help='batch sizes to test')
+    parser.add_argument('--num-classes', default=21, type=int, help='number of classes(包含背景)')
+    parser.add_argument('--max-pos', default=60, type=int, help='max number of positive default boxes per image')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed runs per batch size')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
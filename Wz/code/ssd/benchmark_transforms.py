@@ -0,0 +1,124 @@
+"""
+该脚本用于比较训练集在PIL图像上的数据增强(SSDCropping、Resize、ColorJitter、ToTensor、RandomHorizontalFlip、Normalization)
+与uint8 Tensor上的向量化数据增强(PILToUint8Tensor、SSDCropResizeFlip、ColorJitterUint8、NormalizationUint8)处理每张图像的耗时，
+并检查一次完成的裁剪缩放翻转与PIL上的crop + Resize + 翻转的差异(缩小时都有抗锯齿, 与验证集的Resize一致)，
+棋盘格图像缩小后的标准差(没有抗锯齿时会出现明显的摩尔纹, 标准差远大于PIL)，以及标准化是否与ToTensor + Normalization一致
+与DataLoader的worker相同，只使用一个线程
+python benchmark_transforms.py --image-sizes 375 500 768 1024
+"""
+
+import time
+import copy
+import argparse
+
+import torch
+import torchvision.transforms as t
+from torchvision.transforms import functional as F
+
+import transforms
+
+
+def create_transforms():
+    pil_trans = transforms.Compose([transforms.SSDCropping(),
+                                    transforms.Resize(),
+                                    transforms.ColorJitter(),
+                                    transforms.ToTensor(),
+                                    transforms.RandomHorizontalFlip(),
+                                    transforms.Normalization()])
+    uint8_trans = transforms.Compose([transforms.PILToUint8Tensor(),
+                                      transforms.SSDCropResizeFlip(),
+                                      transforms.ColorJitterUint8(),
+                                      transforms.NormalizationUint8()])
+    return pil_trans, uint8_trans
+
+
+def random_inputs(height, width, max_gt):
+    """随机生成图像以及0-1之间的gt boxes"""
+    image = F.to_pil_image(torch.randint(0, 256, (3, height, width), dtype=torch.uint8))
+    num_gt = int(torch.randint(1, max_gt + 1, (1,)))
+    ctr = torch.rand(num_gt, 2) * 0.8 + 0.1
+    wh = torch.rand(num_gt, 2) * 0.4 + 0.05
+    boxes = torch.cat([ctr - wh / 2, ctr + wh / 2], dim=1).clamp(0, 1)
+    target = {"boxes": boxes,
+              "labels": torch.randint(1, 21, (num_gt,)),
+              "height_width": torch.as_tensor([height, width])}
+    return image, target
+
+
+def pil_crop_resize_flip(image, crop, size):
+    """PIL上的实现: 裁剪(与SSDCropping相同的像素坐标)、Resize、水平翻转"""
+    wtot, htot = image.size
+    left, top, right, bottom = crop
+    image = image.crop((int(left * wtot), int(top * htot), int(right * wtot), int(bottom * htot)))
+    return F.pil_to_tensor(t.Resize(size)(image)).flip(-1)
+
+
+def check_same(image, crop_resize_flip):
+    """
+    返回裁剪缩放翻转与PIL实现的平均/最大绝对误差(PIL的两次一维插值之间会取整, 所以会有1-2的差异),
+    以及NormalizationUint8是否与ToTensor + Normalization一致
+    """
+    crop = [0.1, 0.2, 0.7, 0.9]
+    ref = pil_crop_resize_flip(image, crop, crop_resize_flip.size)
+    res = crop_resize_flip.crop_resize_flip(F.pil_to_tensor(image), crop, flip=True)
+    diff = (ref.int() - res.int()).abs()
+
+    ref_norm, _ = transforms.Normalization()(F.to_tensor(F.to_pil_image(res)), None)
+    res_norm, _ = transforms.NormalizationUint8()(res, None)
+    return float(diff.float().mean()), int(diff.max()), torch.allclose(ref_norm, res_norm, atol=1e-5)
+
+
+def checkerboard_std(height, width, crop_resize_flip):
+    """1像素的黑白棋盘格缩小到size后的像素标准差, 有抗锯齿时接近0"""
+    ys, xs = torch.meshgrid(torch.arange(height), torch.arange(width))
+    board = (((ys + xs) % 2) * 255).to(torch.uint8)[None].repeat(3, 1, 1)
+    crop = [0., 0., 1., 1.]
+    ref = pil_crop_resize_flip(F.to_pil_image(board), crop, crop_resize_flip.size)
+    res = crop_resize_flip.crop_resize_flip(board, crop, flip=True)
+    return float(ref.float().std()), float(res.float().std())
+
+
+def benchmark(fn, inputs, repeats):
+    fn(*copy.deepcopy(inputs))  # warm up
+    elapsed = 0.
+    for _ in range(repeats):
+        # 变换会修改target, 每次都使用新的拷贝(不计入耗时)
+        image, target = copy.deepcopy(inputs)
+        t_start = time.time()
+        fn(image, target)
+        elapsed += time.time() - t_start
+    return elapsed / repeats
+
+
+def main(args):
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    pil_trans, uint8_trans = create_transforms()
+
+    print("{:>10} | {:>13} | {:>15} | {:>8} | {:>16} | {:>15} | {:>21} | {}".format(
+        "image_size", "PIL(ms/img)", "uint8(ms/img)", "speedup", "mean diff vs PIL", "max diff vs PIL",
+        "checker std PIL/uint8", "same norm"))
+    for size in args.image_sizes:
+        height, width = size, size * 4 // 3
+        inputs = random_inputs(height, width, args.max_gt)
+        mean_diff, max_diff, same_norm = check_same(inputs[0], uint8_trans.transforms[1])
+        std_pil, std_uint8 = checkerboard_std(height, width, uint8_trans.transforms[1])
+        t_pil = benchmark(pil_trans, inputs, args.repeats)
+        t_uint8 = benchmark(uint8_trans, inputs, args.repeats)
+        print("{:>10} | {:>13.2f} | {:>15.2f} | {:>7.2f}x | {:>16.3f} | {:>15} | {:>21} | {}".format(
+            "{}x{}".format(height, width), t_pil * 1000, t_uint8 * 1000, t_pil / t_uint8,
+            mean_diff, max_diff, "{:.1f}/{:.1f}".format(std_pil, std_uint8), same_norm))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--image-sizes', default=[375, 500, 768, 1024], type=int, nargs='+',
+                        help='image heights to test(width = height * 4 / 3)')
+    parser.add_argument('--max-gt', default=10, type=int, help='max number of gt boxes per image')
+    parser.add_argument('--repeats', default=100, type=int, help='number of timed runs per image size')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -5,11 +5,18 @@ import json
 from PIL import Image
 from lxml import etree
 
+from train_utils import draft_jpeg
+
 
 class VOCDataSet(Dataset):
     """读取解析PASCAL VOC2007/2012数据集"""
 
-    def __init__(self, voc_root, year="2012", transforms=None, train_set='train.txt'):
+    def __init__(self, voc_root, year="2012", transforms=None, train_set='train.txt', draft_size=None):
+        """
+        draft_size: (宽, 高)，指定后JPEG图像解码时直接缩小到不小于该尺寸的1/2^n，默认为None即解码完整的图像
+                    boxes是相对坐标，原图的height_width也取自xml，所以target不需要任何修改，训练集和验证集都可以使用
+                    训练时SSDCropping会在缩小后的图像上裁剪，可以设置得比网络输入尺寸(300)大一些以保留细节
+        """
         assert year in ["2007", "2012"], "year must be in ['2007', '2012']"
         # 增加容错能力
         if "VOCdevkit" in voc_root:
@@ -32,6 +39,7 @@ class VOCDataSet(Dataset):
             self.class_dict = json.load(f)
 
         self.transforms = transforms
+        self.draft_size = draft_size
 
     def __len__(self):
         return len(self.xml_list)
@@ -50,6 +58,9 @@ class VOCDataSet(Dataset):
         image = Image.open(img_path)
         if image.format != "JPEG":
             raise ValueError("Image '{}' format not JPEG".format(img_path))
+        if self.draft_size is not None:
+            # boxes是相对坐标，不需要随图像缩放
+            draft_jpeg(image, self.draft_size)
 
         assert "object" in data, "{} lack of object information.".format(xml_path)
         boxes = []
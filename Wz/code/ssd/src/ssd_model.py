@@ -39,7 +39,8 @@ class Backbone(nn.Module):
 #   
 #----------------------------------------#
 class SSD300(nn.Module):
-    def __init__(self, backbone=None, num_classes=21):
+    def __init__(self, backbone=None, num_classes=21, nms_method="nms", batched_postprocess=False,
+                 pre_nms_top_n=200, neg_mining="sort"):
         super(SSD300, self).__init__()
         #----------------------------------------#
         #   必须有backbone且必须有out_channels属性
@@ -86,9 +87,10 @@ class SSD300(nn.Module):
         #    默认框
         #----------------------------------------#
         default_box         = dboxes300_coco()          # [8732, 4] 4: x1y1x2y2
-        self.compute_loss   = Loss(default_box)
+        self.compute_loss   = Loss(default_box, neg_mining)  # neg_mining: "sort", "threshold"或"topk"
         self.encoder        = Encoder(default_box)
-        self.postprocess    = PostProcess(default_box)
+        # nms_method: "nms"或"matrix", batched_postprocess: 整个batch一起解码(每个类别先保留pre_nms_top_n个box)
+        self.postprocess    = PostProcess(default_box, nms_method, batched_postprocess, pre_nms_top_n)
 
     #----------------------------------------#
     #   构建额外的添加层 5层
@@ -221,6 +223,70 @@ class SSD300(nn.Module):
         return results
 
 
+#----------------------------------------#
+#   hard negative mining: 选出每张图像中confidence loss最大的neg_num个负样本
+#   sort: 原先的实现(默认), 两次完整排序得到每个box的名次, 相同loss选中哪一个取决于sort(不稳定)的实现
+#   threshold: 用topk得到第neg_num大的loss作为阈值, 大于阈值的全部选中, 等于阈值的按索引从小到大补足,
+#              相当于稳定排序, 不需要排序; 没有相同loss时与sort完全相同, 有相同loss时选中的负样本可能不同
+#   topk: 省内存的方式, 直接对topk得到的前neg_num个loss求和, 不会创建[N, 8732]的名次或mask
+#   三种方式得到的loss数值相同(相同的loss选中哪一个不影响求和), 有相同loss时梯度会落在不同的负样本上
+#----------------------------------------#
+def hard_negative_mask_sort(con_neg, neg_num):
+    # type: (Tensor, Tensor) -> Tensor
+    """
+    con_neg: [N, 8732] 正样本位置为0的confidence loss
+    neg_num: [N, 1] 每张图像需要的负样本个数
+    return: [N, 8732] 选中的负样本
+    """
+    _, con_idx = con_neg.sort(dim=1, descending=True)
+    _, con_rank = con_idx.sort(dim=1)
+    return torch.lt(con_rank, neg_num)
+
+
+def hard_negative_mask_threshold(con_neg, neg_num):
+    # type: (Tensor, Tensor) -> Tensor
+    """
+    不需要排序的hard negative mining, 与阈值相同的loss按索引从小到大选取(相当于稳定排序)
+    没有相同loss时与hard_negative_mask_sort的结果相同, 有相同loss时sort的选择取决于不稳定排序的实现, 两者可能不同
+    con_neg: [N, 8732] 正样本位置为0的confidence loss
+    neg_num: [N, 1] 每张图像需要的负样本个数
+    return: [N, 8732] 选中的负样本
+    """
+    max_num = int(neg_num.max())
+    if max_num == 0:
+        return torch.zeros_like(con_neg, dtype=torch.bool)
+    #----------------------------------------#
+    #   每张图像中第neg_num大的loss作为阈值, neg_num为0的图像阈值为inf
+    #----------------------------------------#
+    top_values, _ = con_neg.topk(max_num, dim=1)
+    kth_value = top_values.gather(1, (neg_num - 1).clamp(min=0))
+    kth_value = torch.where(torch.gt(neg_num, 0), kth_value, torch.full_like(kth_value, float("inf")))
+    greater = torch.gt(con_neg, kth_value)
+    equal = torch.eq(con_neg, kth_value)
+    #----------------------------------------#
+    #   等于阈值的loss按索引从小到大补足neg_num个
+    #----------------------------------------#
+    equal_needed = neg_num - greater.sum(dim=1, keepdim=True)
+    equal_rank = equal.to(torch.int32).cumsum(dim=1)
+    return greater | (equal & torch.le(equal_rank, equal_needed))
+
+
+def hard_negative_loss_topk(con_neg, neg_num):
+    # type: (Tensor, Tensor) -> Tensor
+    """
+    直接返回每张图像中选中的负样本loss之和, 与按mask求和的结果相同(相同loss选中哪一个不影响求和结果)
+    con_neg: [N, 8732] 正样本位置为0的confidence loss
+    neg_num: [N, 1] 每张图像需要的负样本个数
+    return: [N]
+    """
+    max_num = int(neg_num.max())
+    if max_num == 0:
+        return con_neg.new_zeros(con_neg.shape[0])
+    top_values, _ = con_neg.topk(max_num, dim=1)
+    keep = torch.arange(max_num, device=con_neg.device)[None, :] < neg_num
+    return (top_values * keep.to(top_values.dtype)).sum(dim=1)
+
+
 #----------------------------------------#
 #   计算loss
 #----------------------------------------#
@@ -231,11 +297,16 @@ class Loss(nn.Module):
         2. Localization Loss: Only on positive labels
         Suppose input dboxes has the shape 8732x4
     """
-    def __init__(self, dboxes):
+    def __init__(self, dboxes, neg_mining="sort"):
         """
         dboxes: default boxes
+        neg_mining: hard negative mining的方式, "sort"(原先的实现), "threshold"(不排序, 相同loss按索引顺序选取)
+                    或者"topk"(省内存, 只计算loss之和)
         """
         super(Loss, self).__init__()
+        if neg_mining not in ("sort", "threshold", "topk"):
+            raise ValueError("neg_mining should be 'sort', 'threshold' or 'topk', got {}".format(neg_mining))
+        self.neg_mining = neg_mining
         #----------------------------------------#
         #   超参数,位置loss的缩放因子
         #   Two factor are from following links
@@ -340,13 +411,6 @@ class Loss(nn.Module):
         #----------------------------------------#
         con_neg = con.clone()
         con_neg[mask] = 0.0     # 将正样本的值设为0
-        #----------------------------------------#
-        #   按照confidence_loss降序排列 con_idx(Tensor: [N, 8732])
-        #   第一次降序排序内容,返回所有idx
-        #   第二次对获取的idx降序排序,返回idx
-        #----------------------------------------#
-        _, con_idx = con_neg.sort(dim=1, descending=True)
-        _, con_rank = con_idx.sort(dim=1)  # 这个步骤比较巧妙
 
         #----------------------------------------#
         #   number of negative three times positive
@@ -354,16 +418,27 @@ class Loss(nn.Module):
         #   但不能超过总样本数8732
         #----------------------------------------#
         neg_num = torch.clamp(3 * pos_num, max=mask.size(1)).unsqueeze(-1)
-        #----------------------------------------#
-        #   比较得到True False， 需要的为True，含义是损失最大的值，用True，False对第一行的*confidence_loss*进行取值
-        #----------------------------------------#
-        neg_mask = torch.lt(con_rank, neg_num)  # (lt: <) Tensor [N, 8732]
 
-        #----------------------------------------#
-        #   confidence最终loss使用选取的正样本loss+选取的负样本loss
-        #   正负样本mask相加，mask选择的为True,否则为False
-        #----------------------------------------#
-        con_loss = (con * (mask.float() + neg_mask.float())).sum(dim=1)  # Tensor [N]
+        if self.neg_mining == "topk":
+            #----------------------------------------#
+            #   直接对loss最大的neg_num个负样本求和
+            #   confidence最终loss使用选取的正样本loss+选取的负样本loss
+            #----------------------------------------#
+            con_loss = (con * mask.float()).sum(dim=1) + hard_negative_loss_topk(con_neg, neg_num)  # Tensor [N]
+        else:
+            #----------------------------------------#
+            #   选出loss最大的neg_num个负样本, True为选中  Tensor [N, 8732]
+            #----------------------------------------#
+            if self.neg_mining == "sort":
+                neg_mask = hard_negative_mask_sort(con_neg.detach(), neg_num)
+            else:
+                neg_mask = hard_negative_mask_threshold(con_neg.detach(), neg_num)
+
+            #----------------------------------------#
+            #   confidence最终loss使用选取的正样本loss+选取的负样本loss
+            #   正负样本mask相加，mask选择的为True,否则为False
+            #----------------------------------------#
+            con_loss = (con * (mask.float() + neg_mask.float())).sum(dim=1)  # Tensor [N]
 
         #----------------------------------------#
         #   定位损失和分类损失相加
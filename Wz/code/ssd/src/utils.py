@@ -1,5 +1,5 @@
 from math import sqrt
-import itertools
+from functools import lru_cache
 
 import torch
 import torch.nn.functional as F
@@ -189,6 +189,61 @@ class Encoder(object):
         bboxes_out[:, 3] = h
         return bboxes_out, labels_out
 
+    #----------------------------------------#
+    #   对一个batch的标注标签一起编码
+    #----------------------------------------#
+    def encode_batch(self, bboxes_in, labels_in, num_boxes, criteria=0.5):
+        """
+        与对每张图像分别调用encode的结果相同, 但整个batch只需要一次iou计算, 可以在gpu上进行
+            input  : bboxes_in (Tensor B x G x 4), labels_in (Tensor B x G)   补齐到相同个数G的真实框和标签
+                     num_boxes (Tensor B)   每张图像实际的真实框个数
+            output : bboxes_out (Tensor B x 8732 x 4), labels_out (Tensor B x 8732)
+            criteria : IoU threshold of bboexes
+        """
+        device = bboxes_in.device
+        dboxes = self.dboxes.to(device)
+        batch_size, num_gt = labels_in.shape
+        valid = torch.arange(num_gt, device=device)[None, :] < num_boxes[:, None]      # [B, G]
+
+        #----------------------------------------#
+        #   计算每个GT与default box的iou, 补齐的GT的iou设为-1, 不会被任何default box匹配
+        #   [B, G, 8732]
+        #----------------------------------------#
+        ious = calc_iou_tensor(bboxes_in.reshape(-1, 4), dboxes).reshape(batch_size, num_gt, self.nboxes)
+        ious = torch.where(valid[:, :, None], ious, torch.full_like(ious, -1.))
+
+        best_dbox_ious, best_dbox_idx = ious.max(dim=1)     # [B, 8732]
+        best_bbox_ious, best_bbox_idx = ious.max(dim=2)     # [B, G]
+
+        #----------------------------------------#
+        #   将每个GT匹配到的最佳default box设置为正样本
+        #   多个GT的最佳default box相同时, 与encode中按顺序赋值相同, 取索引最大的GT
+        #   先在[B, G, G]上找出被后面的GT覆盖的GT, 剩下的GT在每张图像中的位置互不相同,
+        #   直接写入[B, 8732]即可, 不需要[B, G, 8732]的中间变量, 结果也与写入顺序无关
+        #----------------------------------------#
+        gt_idx = torch.arange(num_gt, device=device)
+        overridden = (best_bbox_idx[:, :, None] == best_bbox_idx[:, None, :]) & valid[:, None, :] & \
+                     (gt_idx[None, None, :] > gt_idx[None, :, None])                    # [B, G, G]
+        img_ids, gt_ids = torch.where(valid & ~overridden.any(dim=2))
+        forced_idx = torch.full_like(best_dbox_idx, -1)                                 # [B, 8732]
+        forced_idx[img_ids, best_bbox_idx[img_ids, gt_ids]] = gt_ids
+        forced = forced_idx >= 0
+        best_dbox_ious = torch.where(forced, torch.full_like(best_dbox_ious, 2.0), best_dbox_ious)
+        best_dbox_idx = torch.where(forced, forced_idx, best_dbox_idx)
+
+        masks = best_dbox_ious > criteria                                                # [B, 8732]
+
+        labels_out = torch.gather(labels_in, 1, best_dbox_idx)
+        labels_out = torch.where(masks, labels_out, torch.zeros_like(labels_out))
+
+        bboxes_out = torch.gather(bboxes_in, 1, best_dbox_idx[:, :, None].expand(-1, -1, 4))
+        bboxes_out = torch.where(masks[:, :, None], bboxes_out, dboxes[None])
+
+        # Transform format to xywh format
+        bboxes_out = torch.cat([0.5 * (bboxes_out[:, :, :2] + bboxes_out[:, :, 2:]),
+                                bboxes_out[:, :, 2:] - bboxes_out[:, :, :2]], dim=2)
+        return bboxes_out, labels_out
+
     def scale_back_batch(self, bboxes_in, scores_in):
         """
             将box格式从xywh转换回ltrb, 将预测目标score通过softmax处理
@@ -402,11 +457,6 @@ class DefaultBoxes(object):
         #----------------------------------------#
         self.scales = scales
 
-        #----------------------------------------#
-        #   计算每层特征层的feature map size,每个层的框的大小
-        #   300 / [8, 16, 32, 64, 100, 300]
-        #----------------------------------------#
-        fk = fig_size / np.array(steps)
         #----------------------------------------#
         #   每个预测特征层上预测的default box的 ratios宽高变化比例不包括1,因为默认就是
         #   [[2], [2, 3], [2, 3], [2, 3], [2], [2]]
@@ -414,57 +464,12 @@ class DefaultBoxes(object):
         self.aspect_ratios = aspect_ratios
 
         #----------------------------------------#
-        #   遍历每层特征层，计算default box
+        #   生成default box, 相同的配置只计算一次
+        #   缓存的tensor被所有相同配置的DefaultBoxes共享, 只在__call__中返回它们的拷贝
+        #   dboxes: [num_anchors, 4] (x, y, w, h)   dboxes_ltrb: [num_anchors, 4] (xmin, ymin, xmax, ymax)
         #----------------------------------------#
-        self.default_boxes = []
-        for idx, sfeat in enumerate(self.feat_size):
-            sk1 = scales[idx] / fig_size        # scale转为相对值[0-1]  scale/300 得到相对尺寸
-            sk2 = scales[idx + 1] / fig_size    # scale转为相对值[0-1]  计算下一层的尺度,因为会用到
-            sk3 = sqrt(sk1 * sk2)               # 两层相乘
-
-            #----------------------------------------#
-            #   先添加两个1:1比例的default box宽和高
-            #----------------------------------------#
-            all_sizes = [(sk1, sk1), (sk3, sk3)]
-
-            #----------------------------------------#
-            #   再将剩下不同比例的default box宽和高添加到all_sizes中
-            #----------------------------------------#
-            for alpha in aspect_ratios[idx]:
-                w, h = sk1 * sqrt(alpha), sk1 / sqrt(alpha) # 分别乘除 2,0.5  3,0.33
-                all_sizes.append((w, h))    # 2:1 等等
-                all_sizes.append((h, w))    # 1:2 等等
-
-            #----------------------------------------#
-            #   计算当前特征层对应原图上的所有default box
-            #----------------------------------------#
-            for w, h in all_sizes:      # 遍历每一个default box
-                for i, j in itertools.product(range(sfeat), repeat=2):  # i -> 行（y）， j -> 列（x）   # 对应的位置xy
-                    #----------------------------------------#
-                    #   计算每个default box的中心坐标（范围是在0-1之间）
-                    #   + 0.5 是将位置移到框的中心(每个框的相对宽高都为1)
-                    #----------------------------------------#
-                    cx, cy = (j + 0.5) / fk[idx], (i + 0.5) / fk[idx]   # 相对坐标,相对于每个特征层的框的大小
-                    self.default_boxes.append((cx, cy, w, h))           # 添加元组,变为二维列表
-
-        #----------------------------------------#
-        #   将default_boxes转为tensor格式  [num_anchors, 4] [8732, 4]
-        #----------------------------------------#
-        self.dboxes = torch.as_tensor(self.default_boxes, dtype=torch.float32)  # 这里不转类型会报错
-        self.dboxes.clamp_(min=0, max=1)  # 将坐标（x, y, w, h）都限制在0-1之间
-
-        #----------------------------------------#
-        #   For IoU calculation
-        #   ltrb is left top coordinate and right bottom coordinate
-        #   将(x, y, w, h)转换成(xmin, ymin, xmax, ymax)，方便后续计算IoU(匹配正负样本时)
-        #   [num_anchors, 4] [8732, 4]
-        #----------------------------------------#
-        self.dboxes_ltrb = self.dboxes.clone()
-        self.dboxes_ltrb[:, 0] = self.dboxes[:, 0] - 0.5 * self.dboxes[:, 2]   # xmin
-        self.dboxes_ltrb[:, 1] = self.dboxes[:, 1] - 0.5 * self.dboxes[:, 3]   # ymin
-        self.dboxes_ltrb[:, 2] = self.dboxes[:, 0] + 0.5 * self.dboxes[:, 2]   # xmax
-        self.dboxes_ltrb[:, 3] = self.dboxes[:, 1] + 0.5 * self.dboxes[:, 3]   # ymax
-
+        self.dboxes, self.dboxes_ltrb = generate_default_boxes(
+            fig_size, tuple(feat_size), tuple(steps), tuple(scales), tuple(tuple(a) for a in aspect_ratios))
 
     @property
     def scale_xy(self):
@@ -480,11 +485,80 @@ class DefaultBoxes(object):
     #----------------------------------------#
     def __call__(self, order='ltrb'):
         # 根据需求返回对应格式的default box
+        # 返回拷贝, 调用者(例如用来创建nn.Parameter后load_state_dict)原地修改时不会影响缓存的default box
         if order == 'ltrb':
-            return self.dboxes_ltrb
+            return self.dboxes_ltrb.clone()
 
         if order == 'xywh':
-            return self.dboxes
+            return self.dboxes.clone()
+
+#----------------------------------------#
+#   向量化生成所有预测特征层的default box
+#   每种配置只计算一次, 之后直接返回缓存的结果
+#----------------------------------------#
+@lru_cache(maxsize=None)
+def generate_default_boxes(fig_size, feat_size, steps, scales, aspect_ratios):
+    """
+    Args:
+        fig_size: 输入网络的图像大小 300
+        feat_size: 每个预测层的feature map尺寸 (38, 19, 10, 5, 3, 1)
+        steps: 每个特征层上的一个cell在原图上的跨度 (8, 16, 32, 64, 100, 300)
+        scales: 每个特征层上预测的default box的scale (21, 45, 99, 153, 207, 261, 315)
+        aspect_ratios: 每个预测特征层上除1以外的宽高比 ((2,), (2, 3), (2, 3), (2, 3), (2,), (2,))
+
+    Returns:
+        dboxes: [num_anchors, 4] (x, y, w, h)
+        dboxes_ltrb: [num_anchors, 4] (xmin, ymin, xmax, ymax)
+    """
+    #----------------------------------------#
+    #   计算每层特征层的feature map size,每个层的框的大小
+    #   300 / [8, 16, 32, 64, 100, 300]
+    #----------------------------------------#
+    fk = fig_size / np.array(steps)
+
+    default_boxes = []
+    for idx, sfeat in enumerate(feat_size):
+        sk1 = scales[idx] / fig_size        # scale转为相对值[0-1]  scale/300 得到相对尺寸
+        sk2 = scales[idx + 1] / fig_size    # scale转为相对值[0-1]  计算下一层的尺度,因为会用到
+        sk3 = sqrt(sk1 * sk2)               # 两层相乘
+
+        #----------------------------------------#
+        #   先是两个1:1比例的default box宽和高, 再是其他比例的宽和高(w:h和h:w)
+        #----------------------------------------#
+        all_sizes = [(sk1, sk1), (sk3, sk3)]
+        for alpha in aspect_ratios[idx]:
+            w, h = sk1 * sqrt(alpha), sk1 / sqrt(alpha)
+            all_sizes.append((w, h))
+            all_sizes.append((h, w))
+        all_sizes = np.array(all_sizes)                                     # [num_sizes, 2]
+
+        #----------------------------------------#
+        #   每个cell的中心坐标（范围是在0-1之间）, i -> 行（y）， j -> 列（x）
+        #   顺序与逐个遍历(w, h), 行, 列时相同
+        #----------------------------------------#
+        centers = (np.arange(sfeat) + 0.5) / fk[idx]
+        cy, cx = np.meshgrid(centers, centers, indexing="ij")
+        centers = np.stack([cx.reshape(-1), cy.reshape(-1)], axis=1)      # [sfeat * sfeat, 2]
+
+        num_sizes, num_cells = all_sizes.shape[0], centers.shape[0]
+        boxes = np.concatenate([np.tile(centers, (num_sizes, 1)),
+                                np.repeat(all_sizes, num_cells, axis=0)], axis=1)
+        default_boxes.append(boxes)
+
+    #----------------------------------------#
+    #   [num_anchors, 4] [8732, 4], 与逐个计算时相同, 先用float64计算再转为float32
+    #----------------------------------------#
+    dboxes = torch.as_tensor(np.concatenate(default_boxes, axis=0), dtype=torch.float32)
+    dboxes.clamp_(min=0, max=1)  # 将坐标（x, y, w, h）都限制在0-1之间
+
+    #----------------------------------------#
+    #   For IoU calculation
+    #   将(x, y, w, h)转换成(xmin, ymin, xmax, ymax)，方便后续计算IoU(匹配正负样本时)
+    #----------------------------------------#
+    dboxes_ltrb = torch.cat([dboxes[:, :2] - 0.5 * dboxes[:, 2:],
+                             dboxes[:, :2] + 0.5 * dboxes[:, 2:]], dim=1)
+    return dboxes, dboxes_ltrb
+
 
 #----------------------------------------#
 #   生成default box
@@ -501,6 +575,29 @@ def dboxes300_coco():
     return dboxes
 
 
+#----------------------------------------#
+#   torchvision的nms算子是否可用(只安装了python部分或者编译失败时不可用)
+#----------------------------------------#
+def _has_torchvision_nms():
+    # type: () -> bool
+    try:
+        torch.ops.torchvision.nms
+    except (RuntimeError, AttributeError):
+        return False
+    return True
+
+
+_USE_TORCHVISION_NMS = _has_torchvision_nms()
+
+#----------------------------------------#
+#   batched_nms选择逐类别nms的条件, 可以用benchmark_batched_nms.py得到的结果调整
+#   boxes.numel()超过对应设备的阈值, 并且平均每个类别的boxes不少于_BATCHED_NMS_MIN_BOXES_PER_CLASS个时逐类别执行nms
+#   否则所有类别一起使用偏移量的方法执行一次nms
+#----------------------------------------#
+_BATCHED_NMS_LOOP_NUMEL = {"cpu": 4000, "cuda": 20000}
+_BATCHED_NMS_MIN_BOXES_PER_CLASS = 8
+
+
 def nms(boxes, scores, iou_threshold):
     # type: (Tensor, Tensor, float) -> Tensor
     """
@@ -529,7 +626,35 @@ def nms(boxes, scores, iou_threshold):
         of the elements that have been kept
         by NMS, sorted in decreasing order of scores
     """
-    return torch.ops.torchvision.nms(boxes, scores, iou_threshold)
+    if _USE_TORCHVISION_NMS:
+        return torch.ops.torchvision.nms(boxes, scores, iou_threshold)
+    return _nms_vectorized(boxes, scores, iou_threshold)
+
+
+def _nms_vectorized(boxes, scores, iou_threshold):
+    # type: (Tensor, Tensor, float) -> Tensor
+    """
+    纯PyTorch实现的nms, torchvision的nms算子不可用时使用, 结果与torchvision.ops.nms相同
+    需要N x N的iou矩阵, 适合boxes数量不太多的情况
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    order = torch.argsort(scores, descending=True)
+    boxes = boxes[order]
+    # suppress[i, j]: 分数更高的第i个box与第j个box的iou大于阈值
+    suppress = torch.triu(torch.gt(calc_iou_tensor(boxes, boxes), iou_threshold), diagonal=1)
+    #----------------------------------------#
+    #   贪心nms的结果满足: 第j个box被保留 <=> 不存在被保留的i < j与它重叠
+    #   从全部保留开始迭代, 第k次迭代后前k个box的结果一定正确, 不再变化时即为贪心nms的结果
+    #   一般只需要很少的几次迭代
+    #----------------------------------------#
+    keep = torch.ones(boxes.shape[0], dtype=torch.bool, device=boxes.device)
+    while True:
+        new_keep = torch.logical_not(torch.logical_and(suppress, keep[:, None]).any(dim=0))
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return order[keep]
 
 
 #----------------------------------------#
@@ -568,6 +693,33 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
     if boxes.numel() == 0:
         return torch.empty((0,), dtype=torch.int64, device=boxes.device)
 
+    #----------------------------------------#
+    #   boxes很多时, 一次nms的计算量与N^2成正比, 而且偏移后的坐标很大会损失float精度
+    #   此时逐类别执行nms更快, 但类别很多、每个类别boxes很少时循环的开销更大
+    #----------------------------------------#
+    loop_numel = _BATCHED_NMS_LOOP_NUMEL["cpu" if boxes.device.type == "cpu" else "cuda"]
+    if boxes.numel() > loop_numel and not torch.jit.is_tracing():
+        classes = torch.unique(idxs)
+        if boxes.shape[0] >= classes.numel() * _BATCHED_NMS_MIN_BOXES_PER_CLASS:
+            return _batched_nms_per_class(boxes, scores, idxs, classes, iou_threshold)
+    return _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold)
+
+
+def _batched_nms_per_class(boxes, scores, idxs, classes, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, Tensor, float) -> Tensor
+    """逐类别执行nms, 返回的索引按score降序排列"""
+    keep_mask = torch.zeros_like(scores, dtype=torch.bool)
+    for class_id in classes:
+        curr_indices = torch.where(torch.eq(idxs, class_id))[0]
+        curr_keep_indices = nms(boxes[curr_indices], scores[curr_indices], iou_threshold)
+        keep_mask[curr_indices[curr_keep_indices]] = True
+    keep_indices = torch.where(keep_mask)[0]
+    return keep_indices[scores[keep_indices].sort(descending=True)[1]]
+
+
+def _batched_nms_coordinate_trick(boxes, scores, idxs, iou_threshold):
+    # type: (Tensor, Tensor, Tensor, float) -> Tensor
+    """所有类别的boxes加上不同的偏移量后一起执行一次nms"""
     #----------------------------------------#
     #   strategy: in order to perform NMS independently per class.
     #   we add an offset to all the boxes. The offset is dependent
@@ -591,13 +743,72 @@ def batched_nms(boxes, scores, idxs, iou_threshold):
     return keep
 
 
+#----------------------------------------#
+#   Matrix NMS, 并行地根据重叠程度衰减分数
+#----------------------------------------#
+def matrix_nms(boxes, scores, idxs, kernel="gaussian", sigma=2.0, score_threshold=0.0, max_candidates=-1):
+    # type: (Tensor, Tensor, Tensor, str, float, float, int) -> Tuple[Tensor, Tensor]
+    """
+    Matrix NMS(SOLOv2): 不再逐个删除与高分box重叠的boxes, 而是根据每个box与所有更高分box的iou
+    一次矩阵运算得到它的分数衰减系数, 只在相同类别(idxs相同)的boxes之间衰减
+
+    Arguments:
+        boxes (Tensor[N, 4]): boxes in (x1, y1, x2, y2) format
+        scores (Tensor[N]): scores for each one of the boxes
+        idxs (Tensor[N]): indices of the categories for each one of the boxes
+        kernel (str): "gaussian" or "linear"
+        sigma (float): gaussian kernel的参数
+        score_threshold (float): 衰减后分数低于该值的boxes会被移除
+        max_candidates (int): 只对分数最高的max_candidates个boxes计算(iou矩阵为N x N), <= 0表示全部
+
+    Returns:
+        keep (Tensor): int64 tensor with the indices of the elements that have been kept,
+            sorted in decreasing order of decayed scores
+        scores (Tensor): decayed scores of the kept elements
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device), scores.new_empty((0,))
+
+    scores, order = scores.sort(descending=True)
+    if max_candidates > 0 and order.numel() > max_candidates:
+        scores, order = scores[:max_candidates], order[:max_candidates]
+    boxes, idxs = boxes[order], idxs[order]
+
+    #----------------------------------------#
+    #   iou[i, j]: 分数更高的第i个box与第j个box的iou, 不同类别之间为0
+    #   compensate_iou[i]: 第i个box与所有更高分box的最大iou, 即它自己被抑制的程度
+    #----------------------------------------#
+    same_class = torch.eq(idxs[:, None], idxs[None, :])
+    iou = torch.triu(calc_iou_tensor(boxes, boxes) * same_class, diagonal=1)
+    compensate_iou = iou.max(dim=0)[0][:, None]
+
+    #----------------------------------------#
+    #   decay[j] = min_i f(iou[i, j]) / f(compensate_iou[i])
+    #   分数最高的box的compensate_iou为0, 所以decay <= 1
+    #----------------------------------------#
+    if kernel == "gaussian":
+        decay = torch.exp(-sigma * (iou ** 2 - compensate_iou ** 2))
+    elif kernel == "linear":
+        decay = (1 - iou) / (1 - compensate_iou).clamp(min=1e-6)
+    else:
+        raise ValueError("kernel should be 'gaussian' or 'linear', got {}".format(kernel))
+    scores = scores * decay.min(dim=0)[0]
+
+    keep = torch.where(torch.ge(scores, score_threshold))[0]
+    scores, sort_inds = scores[keep].sort(descending=True)
+    return order[keep[sort_inds]], scores
+
+
 #----------------------------------------#
 #   将预测回归参数叠加到default box上得到最终预测box，并执行非极大值抑制虑除重叠框
 #----------------------------------------#
 class PostProcess(nn.Module):
-    def __init__(self, dboxes):
+    def __init__(self, dboxes, nms_method="nms", batched=False, pre_nms_top_n=200):
         """
         dboxes: default boxes
+        nms_method: "nms"使用贪心nms, "matrix"使用Matrix NMS
+        batched: 为True时(只支持nms_method="nms")整个batch一起解码, 见decode_batch
+        pre_nms_top_n: batched时每张图像每个类别在nms之前最多保留的box个数
         """
         super(PostProcess, self).__init__()
         #----------------------------------------#
@@ -620,6 +831,23 @@ class PostProcess(nn.Module):
         #----------------------------------------#
         self.max_output = 100
 
+        #----------------------------------------#
+        #   nms方法, matrix时根据与高分boxes的重叠程度衰减分数, 衰减后的分数仍然用0.05过滤
+        #----------------------------------------#
+        if nms_method not in ("nms", "matrix"):
+            raise ValueError("nms_method should be 'nms' or 'matrix', got {}".format(nms_method))
+        self.nms_method = nms_method
+        self.matrix_nms_sigma = 2.0
+        self.matrix_nms_pre_top_n = 1000
+
+        #----------------------------------------#
+        #   整个batch一起解码, 每个类别先取分数最高的pre_nms_top_n个box, 再对整个batch执行一次nms
+        #----------------------------------------#
+        if batched and nms_method != "nms":
+            raise ValueError("batched postprocess only supports nms_method='nms'")
+        self.batched = batched
+        self.pre_nms_top_n = pre_nms_top_n
+
     #----------------------------------------#
     #   通过预测的boxes回归参数得到最终预测坐标, 将预测目标score通过softmax处理
     #----------------------------------------#
@@ -754,21 +982,105 @@ class PostProcess(nn.Module):
         keep = torch.where(keep)[0]
         bboxes_in, scores_in, labels = bboxes_in[keep], scores_in[keep], labels[keep]
 
+        if self.nms_method == "matrix":
+            #----------------------------------------#
+            #   Matrix NMS, 返回按衰减后分数排序的索引以及衰减后的分数
+            #----------------------------------------#
+            keep, scores_in = matrix_nms(bboxes_in, scores_in, labels,
+                                         sigma=self.matrix_nms_sigma,
+                                         score_threshold=0.05,
+                                         max_candidates=self.matrix_nms_pre_top_n)
+            keep, scores_out = keep[:num_output], scores_in[:num_output]
+        else:
+            #----------------------------------------#
+            #   non-maximum suppression
+            #----------------------------------------#
+            keep = batched_nms(bboxes_in, scores_in, labels, iou_threshold=criteria)
+
+            #----------------------------------------#
+            #   取前100个
+            #   keep only topk scoring predictions
+            #----------------------------------------#
+            keep = keep[:num_output]
+            scores_out = scores_in[keep]    # 类别概率
+        bboxes_out = bboxes_in[keep, :] # 目标边界框
+        labels_out = labels[keep]       # 类别
+
+        return bboxes_out, labels_out, scores_out
+
+    #----------------------------------------#
+    #   对整个batch一起进行box和分数解码
+    #----------------------------------------#
+    def decode_batch(self, bboxes_in, scores_in, criteria, num_output):
+        # type: (Tensor, Tensor, float, int) -> Tuple[Tensor, Tensor, Tensor, Tensor]
+        """
+        与对每张图像调用decode_single_new相同(每个类别只保留分数最高的pre_nms_top_n个box),
+        但不需要遍历batch, 也不需要将所有box复制num_classes次, 整个batch只执行一次nms, 可以导出onnx
+            input  : bboxes_in (Tensor B x 8732 x 4), scores_in (Tensor B x 8732 x num_classes) num_classes包括背景
+            output : bboxes_out (Tensor B x num_output x 4), labels_out (Tensor B x num_output),
+                     scores_out (Tensor B x num_output) 每张图像按分数排序, 不足num_output个的部分补0
+                     num_detections (Tensor B) 每张图像实际的目标个数
+        """
+        device = bboxes_in.device
+        batch_size, num_dboxes, num_classes = scores_in.shape
+
         #----------------------------------------#
-        #   non-maximum suppression
+        #   对越界的bbox进行裁剪,都是相对值,所以0~1之间
         #----------------------------------------#
-        keep = batched_nms(bboxes_in, scores_in, labels, iou_threshold=criteria)
+        bboxes_in = bboxes_in.clamp(min=0, max=1)
 
         #----------------------------------------#
-        #   取前100个
-        #   keep only topk scoring predictions
+        #   移除背景类别, 每张图像每个类别只保留分数最高的pre_nms_top_n个default box
+        #   [B, 8732, num_classes] -> [B, num_classes - 1, k]
         #----------------------------------------#
-        keep = keep[:num_output]
-        bboxes_out = bboxes_in[keep, :] # 目标边界框
-        scores_out = scores_in[keep]    # 类别概率
-        labels_out = labels[keep]       # 类别
+        scores = scores_in[:, :, 1:].transpose(1, 2)
+        scores, dbox_idx = scores.topk(min(self.pre_nms_top_n, num_dboxes), dim=2)
+        image_idx = torch.arange(batch_size, device=device).view(-1, 1, 1).expand_as(dbox_idx)
+        labels = torch.arange(1, num_classes, device=device).view(1, -1, 1).expand_as(dbox_idx)
+        bboxes = bboxes_in[image_idx, dbox_idx]     # [B, num_classes - 1, k, 4]
 
-        return bboxes_out, labels_out, scores_out
+        bboxes = bboxes.reshape(-1, 4)
+        scores = scores.reshape(-1)
+        labels = labels.reshape(-1)
+        image_idx = image_idx.reshape(-1)
+
+        #----------------------------------------#
+        #   移除低概率目标以及面积很小的box
+        #----------------------------------------#
+        ws, hs = bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1]
+        keep = torch.where(torch.gt(scores, 0.05) & (ws >= 1 / 300) & (hs >= 1 / 300))[0]
+        bboxes, scores, labels, image_idx = bboxes[keep], scores[keep], labels[keep], image_idx[keep]
+
+        #----------------------------------------#
+        #   整个batch执行一次nms, 以(图像, 类别)作为分组, 不同图像、不同类别的box之间互不影响
+        #   返回的索引按分数从大到小排序
+        #----------------------------------------#
+        keep = batched_nms(bboxes, scores, image_idx * num_classes + labels, iou_threshold=criteria)
+        bboxes, scores, labels, image_idx = bboxes[keep], scores[keep], labels[keep], image_idx[keep]
+
+        #----------------------------------------#
+        #   每个box在所属图像中按分数排序的名次, 每张图像只保留前num_output个
+        #   [num_keep, B]
+        #----------------------------------------#
+        same_image = (image_idx[:, None] == torch.arange(batch_size, device=device)[None, :]).to(torch.int64)
+        rank = (same_image.cumsum(dim=0) - 1).gather(1, image_idx[:, None])[:, 0]
+        keep = torch.where(torch.lt(rank, num_output))[0]
+        bboxes, scores, labels = bboxes[keep], scores[keep], labels[keep]
+        out_idx = image_idx[keep] * num_output + rank[keep]
+
+        #----------------------------------------#
+        #   放到补齐后的输出中
+        #----------------------------------------#
+        bboxes_out = bboxes_in.new_zeros((batch_size * num_output, 4))
+        scores_out = scores_in.new_zeros((batch_size * num_output,))
+        labels_out = torch.zeros((batch_size * num_output,), dtype=labels.dtype, device=device)
+        bboxes_out[out_idx] = bboxes
+        scores_out[out_idx] = scores
+        labels_out[out_idx] = labels
+        num_detections = same_image.sum(dim=0).clamp(max=num_output)
+
+        return (bboxes_out.reshape(batch_size, num_output, 4), labels_out.reshape(batch_size, num_output),
+                scores_out.reshape(batch_size, num_output), num_detections)
 
     def forward(self, bboxes_in, scores_in):
         """
@@ -784,6 +1096,17 @@ class PostProcess(nn.Module):
 
         outputs = torch.jit.annotate(List[Tuple[Tensor, Tensor, Tensor]], [])
 
+        if self.batched:
+            bboxes_out, labels_out, scores_out, num_detections = self.decode_batch(bboxes, probs, self.criteria,
+                                                                                   self.max_output)
+            #----------------------------------------#
+            #   与逐张图像解码的输出格式相同, 去掉补齐的部分(通过mask索引, 导出onnx时不会变成常量)
+            #----------------------------------------#
+            valid = torch.arange(self.max_output, device=bboxes.device)[None, :] < num_detections[:, None]
+            for i in range(bboxes_out.shape[0]):
+                outputs.append((bboxes_out[i][valid[i]], labels_out[i][valid[i]], scores_out[i][valid[i]]))
+            return outputs
+
         #----------------------------------------#
         #   遍历一个batch中的每张image数据
         #   bboxes: [batch, 8732, 4]
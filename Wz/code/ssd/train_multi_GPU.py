@@ -6,7 +6,7 @@ import torch
 
 import transforms
 from my_dataset import VOCDataSet
-from src import SSD300, Backbone
+from src import SSD300, Backbone, Encoder, dboxes300_coco
 import train_utils.train_eval_utils as utils
 from train_utils import GroupedBatchSampler, create_aspect_ratio_groups, init_distributed_mode, save_on_master, mkdir
 
@@ -48,14 +48,23 @@ def main(args):
     # Data loading code
     print("Loading data")
 
+    if args.uint8_transforms:
+        # 在uint8 Tensor上进行数据增强, 裁剪、缩放以及翻转通过一次插值完成
+        train_transforms = [transforms.PILToUint8Tensor(),
+                            transforms.SSDCropResizeFlip(),
+                            transforms.ColorJitterUint8(),
+                            transforms.NormalizationUint8()]
+    else:
+        train_transforms = [transforms.SSDCropping(),
+                            transforms.Resize(),
+                            transforms.ColorJitter(),
+                            transforms.ToTensor(),
+                            transforms.RandomHorizontalFlip(),
+                            transforms.Normalization()]
     data_transform = {
-        "train": transforms.Compose([transforms.SSDCropping(),
-                                     transforms.Resize(),
-                                     transforms.ColorJitter(),
-                                     transforms.ToTensor(),
-                                     transforms.RandomHorizontalFlip(),
-                                     transforms.Normalization(),
-                                     transforms.AssignGTtoDefaultBox()]),
+        # 指定--batched-encode时在train_one_epoch中对整个batch一起匹配default box
+        "train": transforms.Compose(train_transforms
+                                    + ([] if args.batched_encode else [transforms.AssignGTtoDefaultBox()])),
         "val": transforms.Compose([transforms.Resize(),
                                    transforms.ToTensor(),
                                    transforms.Normalization()])
@@ -68,11 +77,14 @@ def main(args):
 
     # load train data set
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> train.txt
-    train_data_set = VOCDataSet(VOC_root, "2012", data_transform["train"], train_set='train.txt')
+    # 指定--draft-size时JPEG图像在解码时直接缩小
+    draft_size = (args.draft_size, args.draft_size) if args.draft_size > 0 else None
+    train_data_set = VOCDataSet(VOC_root, "2012", data_transform["train"], train_set='train.txt',
+                                draft_size=draft_size)
 
     # load validation data set
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> val.txt
-    val_data_set = VOCDataSet(VOC_root, "2012", data_transform["val"], train_set='val.txt')
+    val_data_set = VOCDataSet(VOC_root, "2012", data_transform["val"], train_set='val.txt', draft_size=draft_size)
 
     print("Creating data loaders")
     if args.distributed:
@@ -103,6 +115,9 @@ def main(args):
     model = create_model(num_classes=args.num_classes+1)
     model.to(device)
 
+    # dataset只返回原始的boxes和labels时, 训练过程中使用的encoder
+    encoder = Encoder(dboxes300_coco()) if args.batched_encode else None
+
     model_without_ddp = model
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
@@ -140,7 +155,7 @@ def main(args):
             train_sampler.set_epoch(epoch)
 
         mean_loss, lr = utils.train_one_epoch(model, optimizer, data_loader, device,
-                                              epoch, args.print_freq, warmup=True)
+                                              epoch, args.print_freq, warmup=True, encoder=encoder)
         # only first process to save training info
         if args.rank in [-1, 0]:
             train_loss.append(mean_loss.item())
@@ -246,6 +261,12 @@ if __name__ == "__main__":
     parser.add_argument('--world-size', default=4, type=int,
                         help='number of distributed processes')
     parser.add_argument('--dist-url', default='env://', help='url used to set up distributed training')
+    # JPEG图像解码时直接缩小到不小于该尺寸(PIL draft)，0表示解码完整的图像
+    parser.add_argument('--draft-size', default=0, type=int, help='min decoded image size of JPEGs, 0 to disable')
+    # 不在DataLoader中匹配default box, 而是在训练时对整个batch一起在device上匹配
+    parser.add_argument('--batched-encode', action='store_true', help='match default boxes per batch on device')
+    # 训练集使用uint8 Tensor上的向量化数据增强(代替PIL上的SSDCropping、Resize、ColorJitter等)
+    parser.add_argument('--uint8-transforms', action='store_true', help='use the vectorized uint8 tensor augmentation')
 
     args = parser.parse_args()
 
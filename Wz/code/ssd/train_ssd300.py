@@ -5,7 +5,7 @@ import torch
 
 import transforms
 from my_dataset import VOCDataSet
-from src import SSD300, Backbone
+from src import SSD300, Backbone, Encoder, dboxes300_coco
 import train_utils.train_eval_utils as utils
 from train_utils import get_coco_api_from_dataset
 
@@ -48,14 +48,23 @@ def main(parser_data):
 
     results_file = "results{}.txt".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
 
+    if parser_data.uint8_transforms:
+        # 在uint8 Tensor上进行数据增强, 裁剪、缩放以及翻转通过一次插值完成
+        train_transforms = [transforms.PILToUint8Tensor(),
+                            transforms.SSDCropResizeFlip(),
+                            transforms.ColorJitterUint8(),
+                            transforms.NormalizationUint8()]
+    else:
+        train_transforms = [transforms.SSDCropping(),
+                            transforms.Resize(),
+                            transforms.ColorJitter(),
+                            transforms.ToTensor(),
+                            transforms.RandomHorizontalFlip(),
+                            transforms.Normalization()]
     data_transform = {
-        "train": transforms.Compose([transforms.SSDCropping(),
-                                     transforms.Resize(),
-                                     transforms.ColorJitter(),
-                                     transforms.ToTensor(),
-                                     transforms.RandomHorizontalFlip(),
-                                     transforms.Normalization(),
-                                     transforms.AssignGTtoDefaultBox()]),
+        # 指定--batched-encode时在train_one_epoch中对整个batch一起匹配default box
+        "train": transforms.Compose(train_transforms
+                                    + ([] if parser_data.batched_encode else [transforms.AssignGTtoDefaultBox()])),
         "val": transforms.Compose([transforms.Resize(),
                                    transforms.ToTensor(),
                                    transforms.Normalization()])
@@ -67,7 +76,10 @@ def main(parser_data):
         raise FileNotFoundError("VOCdevkit dose not in path:'{}'.".format(VOC_root))
 
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> train.txt
-    train_dataset = VOCDataSet(VOC_root, "2012", data_transform['train'], train_set='train.txt')
+    # 指定--draft-size时JPEG图像在解码时直接缩小
+    draft_size = (parser_data.draft_size, parser_data.draft_size) if parser_data.draft_size > 0 else None
+    train_dataset = VOCDataSet(VOC_root, "2012", data_transform['train'], train_set='train.txt',
+                               draft_size=draft_size)
     # 注意训练时，batch_size必须大于1
     batch_size = parser_data.batch_size
     assert batch_size > 1, "batch size must be greater than 1"
@@ -83,7 +95,7 @@ def main(parser_data):
                                                     drop_last=drop_last)
 
     # VOCdevkit -> VOC2012 -> ImageSets -> Main -> val.txt
-    val_dataset = VOCDataSet(VOC_root, "2012", data_transform['val'], train_set='val.txt')
+    val_dataset = VOCDataSet(VOC_root, "2012", data_transform['val'], train_set='val.txt', draft_size=draft_size)
     val_data_loader = torch.utils.data.DataLoader(val_dataset,
                                                   batch_size=batch_size,
                                                   shuffle=False,
@@ -93,6 +105,9 @@ def main(parser_data):
     model = create_model(num_classes=args.num_classes+1)
     model.to(device)
 
+    # dataset只返回原始的boxes和labels时, 训练过程中使用的encoder
+    encoder = Encoder(dboxes300_coco()) if parser_data.batched_encode else None
+
     # define optimizer
     params = [p for p in model.parameters() if p.requires_grad]
     optimizer = torch.optim.SGD(params, lr=0.0005,
@@ -121,7 +136,7 @@ def main(parser_data):
         mean_loss, lr = utils.train_one_epoch(model=model, optimizer=optimizer,
                                               data_loader=train_data_loader,
                                               device=device, epoch=epoch,
-                                              print_freq=50)
+                                              print_freq=50, encoder=encoder)
         train_loss.append(mean_loss.item())
         learning_rate.append(lr)
 
@@ -187,6 +202,12 @@ if __name__ == '__main__':
     # 训练的batch size
     parser.add_argument('--batch_size', default=4, type=int, metavar='N',
                         help='batch size when training.')
+    # JPEG图像解码时直接缩小到不小于该尺寸(PIL draft)，0表示解码完整的图像
+    parser.add_argument('--draft-size', default=0, type=int, help='min decoded image size of JPEGs, 0 to disable')
+    # 不在DataLoader中匹配default box, 而是在训练时对整个batch一起在device上匹配
+    parser.add_argument('--batched-encode', action='store_true', help='match default boxes per batch on device')
+    # 训练集使用uint8 Tensor上的向量化数据增强(代替PIL上的SSDCropping、Resize、ColorJitter等)
+    parser.add_argument('--uint8-transforms', action='store_true', help='use the vectorized uint8 tensor augmentation')
 
     args = parser.parse_args()
     print(args)
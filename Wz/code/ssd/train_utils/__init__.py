@@ -1,4 +1,4 @@
-from .coco_utils import get_coco_api_from_dataset
+from .coco_utils import get_coco_api_from_dataset, draft_jpeg
 from .coco_eval import CocoEvaluator
 from .distributed_utils import init_distributed_mode, save_on_master, mkdir
 from .group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_groups
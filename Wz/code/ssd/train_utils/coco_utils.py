@@ -64,3 +64,17 @@ def get_coco_api_from_dataset(dataset):
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
     return convert_to_coco_api(dataset)
+
+
+def draft_jpeg(image, size):
+    """
+    通过PIL的draft在JPEG解码时直接在DCT域缩小到原图的1/2, 1/4或1/8，不需要先解码完整的图像再缩放
+    :param image: Image.open得到的还没有解码(load)的图像
+    :param size: 需要的最小(宽, 高)，缩小后的图像宽高都不会小于size
+    :return: 宽高方向实际的缩放比例，非JPEG图像或者不需要缩小时返回(1., 1.)
+    """
+    if image.format != "JPEG":
+        return 1., 1.
+    width, height = image.size
+    image.draft("RGB", size)
+    return image.size[0] / width, image.size[1] / height
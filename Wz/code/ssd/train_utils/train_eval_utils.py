@@ -9,7 +9,11 @@ import train_utils.distributed_utils as utils
 
 
 def train_one_epoch(model, optimizer, data_loader, device, epoch,
-                    print_freq=50, warmup=False):
+                    print_freq=50, warmup=False, encoder=None):
+    """
+    encoder: 不为None时data_loader返回的是原始的boxes和labels(没有使用AssignGTtoDefaultBox),
+             在device上通过encoder.encode_batch对整个batch一起匹配default box
+    """
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
@@ -34,9 +38,19 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch,
             boxes.append(t['boxes'])
             labels.append(t['labels'])
             img_id.append(t["image_id"])
-        targets = {"boxes": torch.stack(boxes, dim=0),
-                   "labels": torch.stack(labels, dim=0),
-                   "image_id": torch.as_tensor(img_id)}
+        if encoder is not None:
+            # 每张图像的GT个数不同, 补齐后拷贝到device上再编码
+            num_boxes = torch.as_tensor([b.shape[0] for b in boxes], device=device)
+            gt_boxes = torch.nn.utils.rnn.pad_sequence(boxes, batch_first=True).to(device)
+            gt_labels = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True).to(device)
+            bboxes_out, labels_out = encoder.encode_batch(gt_boxes, gt_labels, num_boxes)
+            targets = {"boxes": bboxes_out,
+                       "labels": labels_out,
+                       "image_id": torch.as_tensor(img_id)}
+        else:
+            targets = {"boxes": torch.stack(boxes, dim=0),
+                       "labels": torch.stack(labels, dim=0),
+                       "image_id": torch.as_tensor(img_id)}
 
         images = images.to(device)
 
@@ -184,6 +184,187 @@ class Normalization(object):
         return image, target
 
 
+class PILToUint8Tensor(object):
+    """将PIL图像转为uint8的Tensor[3, H, W](不缩放到0-1),uint8版本的数据增强都应放在该方法后"""
+    def __call__(self, image, target):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image = F.pil_to_tensor(image)
+        return image, target
+
+
+def resize_weights(in_size, out_size):
+    """
+    与PIL的bilinear resize(Resize的默认方式)相同的插值权重 [out_size, in_size]
+    缩小时三角滤波器的宽度随缩放比例变大(抗锯齿), 每个输出像素是附近所有输入像素的加权平均, 放大时即普通的双线性插值
+    """
+    scale = in_size / out_size
+    support = max(scale, 1.0)
+    centers = (torch.arange(out_size, dtype=torch.float32) + 0.5) * scale
+    coords = torch.arange(in_size, dtype=torch.float32) + 0.5
+    weights = (1 - ((coords[None, :] - centers[:, None]) / support).abs()).clamp_(min=0)
+    return weights / weights.sum(dim=1, keepdim=True)
+
+
+class SSDCropResizeFlip(object):
+    """
+    uint8 Tensor版本的SSDCropping + Resize + RandomHorizontalFlip,该方法应放在PILToUint8Tensor后
+    SSDCropping每次随机选择一个sample option,逐个尝试最多5个随机patch,都不满足条件时重新选择
+    这里一次生成num_rounds轮(每轮一个随机sample option以及5个候选patch)并一起计算IoU,
+    取第一个满足条件的轮次中第一个满足条件的patch,得到的patch与SSDCropping的分布相同
+    裁剪、缩放以及翻转通过两次矩阵乘法(高和宽方向的插值权重, 翻转即宽方向的权重倒序)完成,只有patch区域会被转为float
+    插值与PIL的Resize相同(缩小时有抗锯齿), 与验证集使用的Resize一致
+    patch的像素坐标根据图像实际的尺寸计算,JPEG draft缩小后的图像也能正确裁剪
+    """
+    def __init__(self, size=(300, 300), flip_prob=0.5, num_rounds=16):
+        self.size = size
+        self.flip_prob = flip_prob
+        self.num_rounds = num_rounds
+        self.num_trials = 5
+        # 与SSDCropping的sample_options相同, nan表示不裁剪, -inf表示没有IoU要求(max IoU都没有要求)
+        self.min_ious = torch.tensor([float('nan'), 0.1, 0.3, 0.5, 0.7, 0.9, float('-inf')])
+
+    def sample_crop(self, bboxes):
+        """
+        返回满足条件的patch(left, top, right, bottom)以及patch中保留的gt box的mask, 不裁剪时返回None, None
+        bboxes: Tensor[G, 4], 0-1之间的相对坐标
+        """
+        rounds, trials = self.num_rounds, self.num_trials
+        xc = 0.5 * (bboxes[:, 0] + bboxes[:, 2])
+        yc = 0.5 * (bboxes[:, 1] + bboxes[:, 3])
+        while True:
+            min_ious = self.min_ious[torch.randint(len(self.min_ious), (rounds,))]
+            # 0.3*0.3 approx. 0.1
+            w = torch.empty(rounds, trials).uniform_(0.3, 1.0)
+            h = torch.empty(rounds, trials).uniform_(0.3, 1.0)
+            # left 0 ~ 1 - w, top 0 ~ 1 - h
+            left = torch.rand(rounds, trials) * (1.0 - w)
+            top = torch.rand(rounds, trials) * (1.0 - h)
+            crops = torch.stack([left, top, left + w, top + h], dim=-1).view(-1, 4)
+
+            # 保证宽高比例在0.5-2之间
+            valid = (w / h >= 0.5) & (w / h <= 2)
+            # 所有gt box与patch的IoU都要大于min IoU: [G, rounds * trials]
+            ious = calc_iou_tensor(bboxes, crops).view(bboxes.shape[0], rounds, trials)
+            valid &= (ious > min_ious[None, :, None]).all(dim=0)
+            # 至少有一个gt box的中心点在patch中
+            masks = (xc[:, None] > crops[:, 0]) & (xc[:, None] < crops[:, 2]) & \
+                    (yc[:, None] > crops[:, 1]) & (yc[:, None] < crops[:, 3])
+            valid &= masks.any(dim=0).view(rounds, trials)
+
+            # 选中不裁剪的轮次直接返回原图
+            no_crop = torch.isnan(min_ious)
+            found = torch.nonzero(no_crop | valid.any(dim=1), as_tuple=False)
+            if found.numel() == 0:
+                continue
+            r = int(found[0])
+            if no_crop[r]:
+                return None, None
+            k = r * trials + int(torch.nonzero(valid[r], as_tuple=False)[0])
+            return crops[k].tolist(), masks[:, k]
+
+    def crop_resize_flip(self, image, crop, flip):
+        """
+        image: uint8 Tensor[3, H, W], crop: 0-1之间的(left, top, right, bottom), None表示整张图像
+        返回缩放到size并根据flip水平翻转后的uint8 Tensor, 插值与PIL的Resize(bilinear)相同
+        """
+        if crop is not None:
+            htot, wtot = image.shape[-2:]
+            left, top, right, bottom = crop
+            image = image[:, int(top * htot):int(bottom * htot), int(left * wtot):int(right * wtot)]
+        out_h, out_w = self.size
+        weights_h = resize_weights(image.shape[1], out_h)      # [out_h, h]
+        weights_w = resize_weights(image.shape[2], out_w)      # [out_w, w]
+        if flip:
+            weights_w = weights_w.flip(0)
+        out = torch.matmul(torch.matmul(weights_h, image.float()), weights_w.t())   # [3, out_h, out_w]
+        return out.round_().clamp_(0, 255).to(torch.uint8)
+
+    def __call__(self, image, target):
+        bboxes = target["boxes"]
+        crop, masks = self.sample_crop(bboxes)
+        if crop is not None:
+            left, top, right, bottom = crop
+            # 修改采样patch中的所有gt box的坐标（防止出现越界的情况）, 并虑除中心点不在patch中的gt box
+            bboxes = bboxes[masks, :]
+            bboxes[:, 0::2] = (bboxes[:, 0::2].clamp(min=left, max=right) - left) / (right - left)
+            bboxes[:, 1::2] = (bboxes[:, 1::2].clamp(min=top, max=bottom) - top) / (bottom - top)
+            target["labels"] = target["labels"][masks]
+
+        flip = random.random() < self.flip_prob
+        if flip:
+            bboxes[:, [0, 2]] = 1.0 - bboxes[:, [2, 0]]  # 翻转对应bbox坐标信息
+        target["boxes"] = bboxes
+        image = self.crop_resize_flip(image, crop, flip)
+        return image, target
+
+
+class ColorJitterUint8(object):
+    """
+    uint8 Tensor版本的ColorJitter,参数、随机范围以及各项调整的随机顺序与torchvision的ColorJitter相同
+    brightness和contrast是对像素值的逐点映射,通过256项的查找表完成;saturation用定点整数与灰度图混合;
+    hue需要转换到HSV空间,直接使用torchvision对Tensor的实现
+    """
+    def __init__(self, brightness=0.125, contrast=0.5, saturation=0.5, hue=0.05):
+        self.brightness = (1 - brightness, 1 + brightness)
+        self.contrast = (1 - contrast, 1 + contrast)
+        self.saturation = (1 - saturation, 1 + saturation)
+        self.hue = (-hue, hue)
+        self.values = torch.arange(256, dtype=torch.float32)
+
+    @staticmethod
+    def grayscale(image):
+        # 与rgb_to_grayscale相同的系数(0.299, 0.587, 0.114), 8位定点数
+        r, g, b = image.to(torch.int32).unbind(0)
+        return (r * 77 + g * 150 + b * 29 + 128) >> 8
+
+    def apply_lut(self, image, lut):
+        lut = lut.round_().clamp_(0, 255).to(torch.uint8)
+        return lut[image.long()]
+
+    def adjust_brightness(self, image, factor):
+        return self.apply_lut(image, self.values * factor)
+
+    def adjust_contrast(self, image, factor):
+        mean = float(self.grayscale(image).float().mean())
+        return self.apply_lut(image, self.values * factor + mean * (1 - factor))
+
+    def adjust_saturation(self, image, factor):
+        ratio = int(round(factor * 256))
+        out = (image.to(torch.int32) * ratio + self.grayscale(image)[None] * (256 - ratio) + 128) >> 8
+        return out.clamp_(0, 255).to(torch.uint8)
+
+    def __call__(self, image, target):
+        for fn_id in torch.randperm(4).tolist():
+            if fn_id == 0:
+                image = self.adjust_brightness(image, random.uniform(*self.brightness))
+            elif fn_id == 1:
+                image = self.adjust_contrast(image, random.uniform(*self.contrast))
+            elif fn_id == 2:
+                image = self.adjust_saturation(image, random.uniform(*self.saturation))
+            else:
+                image = F.adjust_hue(image, random.uniform(*self.hue))
+        return image, target
+
+
+class NormalizationUint8(object):
+    """将uint8的Tensor转为float并标准化,相当于ToTensor + Normalization,应放在uint8数据增强的最后"""
+    def __init__(self, mean=None, std=None):
+        if mean is None:
+            mean = [0.485, 0.456, 0.406]
+        if std is None:
+            std = [0.229, 0.224, 0.225]
+        mean = torch.as_tensor(mean).view(-1, 1, 1)
+        std = torch.as_tensor(std).view(-1, 1, 1)
+        # (x / 255 - mean) / std = x * scale + shift
+        self.scale = 1. / (255. * std)
+        self.shift = -mean / std
+
+    def __call__(self, image, target):
+        image = torch.addcmul(self.shift, image.float(), self.scale)
+        return image, target
+
+
 class AssignGTtoDefaultBox(object):
     """将DefaultBox与GT进行匹配"""
     def __init__(self):
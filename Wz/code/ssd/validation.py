@@ -5,6 +5,7 @@
 
 import os
 import json
+import time
 
 import torch
 from tqdm import tqdm
@@ -88,6 +89,11 @@ def summarize(self, catId=None):
     return stats, print_info
 
 
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
 def main(parser_data):
     device = torch.device(parser_data.device if torch.cuda.is_available() else "cpu")
     print("Using {} device training.".format(device.type))
@@ -128,7 +134,10 @@ def main(parser_data):
 
     # create model num_classes equal background + 20 classes
     backbone = Backbone()
-    model = SSD300(backbone=backbone, num_classes=parser_data.num_classes + 1)
+    model = SSD300(backbone=backbone, num_classes=parser_data.num_classes + 1,
+                   nms_method=parser_data.nms_method,
+                   batched_postprocess=parser_data.batched_postprocess,
+                   pre_nms_top_n=parser_data.pre_nms_top_n)
 
     # 载入你自己训练好的模型权重
     weights_path = parser_data.weights
@@ -145,13 +154,17 @@ def main(parser_data):
     cpu_device = torch.device("cpu")
 
     model.eval()
+    infer_time, num_images = 0., 0
     with torch.inference_mode():
         for images, targets in tqdm(val_dataset_loader, desc="validation..."):
             # 将图片传入指定设备device
             images = torch.stack(images, dim=0).to(device)
 
-            # inference
+            # inference(包括后处理中的nms)
+            t_start = time_synchronized()
             results = model(images)
+            infer_time += time_synchronized() - t_start
+            num_images += images.shape[0]
 
             outputs = []
             for index, (bboxes_out, labels_out, scores_out) in enumerate(results):
@@ -188,9 +201,15 @@ def main(parser_data):
     print_voc = "\n".join(voc_map_info_list)
     print(print_voc)
 
+    print_time = "nms method: {}, inference time(include postprocess): {:.1f}ms/image".format(
+        parser_data.nms_method, infer_time / max(num_images, 1) * 1000)
+    print(print_time)
+
     # 将验证结果保存至txt文件中
     with open("record_mAP.txt", "w") as f:
-        record_lines = ["COCO results:",
+        record_lines = [print_time,
+                        "",
+                        "COCO results:",
                         print_coco,
                         "",
                         "mAP(IoU=0.5) for each category:",
@@ -220,6 +239,13 @@ if __name__ == "__main__":
     parser.add_argument('--batch_size', default=1, type=int, metavar='N',
                         help='batch size when validation.')
 
+    # 后处理使用的nms方法: nms(贪心nms)或matrix(Matrix NMS), 分别验证后可以对比mAP和推理时间
+    parser.add_argument('--nms-method', default='nms', choices=['nms', 'matrix'], help='nms method')
+
+    # 后处理时整个batch一起解码并执行一次nms, 每个类别先只保留分数最高的pre-nms-top-n个box(只支持nms)
+    parser.add_argument('--batched-postprocess', action='store_true', help='decode the whole batch at once')
+    parser.add_argument('--pre-nms-top-n', default=200, type=int, help='max boxes per class before nms')
+
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,105 @@
+"""
+该脚本用于比较build_utils/np_nms.py中numpy实现的nms与原先load_onnx_test.py中逐个删除box的nms，
+以及torchvision.ops.nms(CPU)的速度，并检查结果是否与torchvision.ops.nms一致
+没有安装pytorch时只比较两个numpy实现
+python benchmark_np_nms.py --num-boxes 100 500 1000 2000 5000 --num-classes 1 20 80
+"""
+import time
+import argparse
+
+import numpy as np
+
+from build_utils import np_nms
+
+try:
+    import torch
+    import torchvision
+except ImportError:
+    torch = None
+
+
+def reference_nms(bboxes: np.ndarray, iou_threshold=0.5) -> np.ndarray:
+    """原先load_onnx_test.py中的nms实现(索引改为np.int64)，作为速度的对照"""
+    bboxes = np.concatenate([bboxes, np.arange(bboxes.shape[0]).reshape(-1, 1)], axis=1)
+
+    best_bboxes_index = []
+    while len(bboxes) > 0:
+        max_ind = np.argmax(bboxes[:, 4])
+        best_bbox = bboxes[max_ind]
+        best_bboxes_index.append(best_bbox[5])
+        bboxes = np.concatenate([bboxes[:max_ind], bboxes[max_ind + 1:]])
+        ious = np_nms.box_iou(best_bbox[np.newaxis, :4], bboxes[:, :4])[0]
+        bboxes = bboxes[np.less(ious, iou_threshold)]
+
+    return np.array(best_bboxes_index, dtype=np.int64)
+
+
+def random_inputs(rng, num_boxes, num_classes, image_size=(512, 512)):
+    height, width = image_size
+    ctr = rng.random((num_boxes, 2)) * np.array([width, height])
+    wh = rng.random((num_boxes, 2)) * 128 + 8
+    boxes = np.concatenate([ctr - wh / 2, ctr + wh / 2], axis=1).astype(np.float32)
+    scores = rng.random(num_boxes).astype(np.float32)
+    classes = rng.integers(0, num_classes, num_boxes)
+    return boxes, scores, classes
+
+
+def benchmark(fn, repeats):
+    fn()  # warm up
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t_start) / repeats
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    if torch is not None:
+        torch.set_num_threads(args.num_threads)
+    else:
+        print("pytorch is not installed, skip torchvision.ops.nms.")
+
+    print("{:>10} | {:>8} | {:>12} | {:>12} | {:>10} | {:>15} | {:>14} | {}".format(
+        "num_boxes", "classes", "reference(ms)", "np_nms(ms)", "speedup", "torchvision(ms)",
+        "soft_nms(ms)", "same"))
+    for num_boxes in args.num_boxes:
+        for num_classes in args.num_classes:
+            boxes, scores, classes = random_inputs(rng, num_boxes, num_classes)
+            # 与load_onnx_test.py中post_process相同，通过偏移量实现按类别nms
+            offset_boxes = boxes + classes[:, None].astype(np.float32) * 4096
+            bboxes = np.concatenate([offset_boxes, scores[:, None]], axis=1)
+
+            keep = np_nms.batched_nms(boxes, scores, classes, args.iou_thresh)
+            t_ref = benchmark(lambda: reference_nms(bboxes, args.iou_thresh), args.repeats)
+            t_np = benchmark(lambda: np_nms.batched_nms(boxes, scores, classes, args.iou_thresh), args.repeats)
+            t_soft = benchmark(lambda: np_nms.batched_soft_nms(boxes, scores, classes), args.repeats)
+
+            t_tv, same = float("nan"), "-"
+            if torch is not None:
+                boxes_t, scores_t = torch.from_numpy(boxes), torch.from_numpy(scores)
+                classes_t = torch.from_numpy(classes)
+                keep_tv = torchvision.ops.batched_nms(boxes_t, scores_t, classes_t, args.iou_thresh).numpy()
+                same = np.array_equal(np.sort(keep), np.sort(keep_tv))
+                t_tv = benchmark(lambda: torchvision.ops.batched_nms(boxes_t, scores_t, classes_t,
+                                                                     args.iou_thresh), args.repeats)
+
+            print("{:>10} | {:>8} | {:>12.2f} | {:>12.2f} | {:>9.2f}x | {:>15.2f} | {:>14.2f} | {}".format(
+                num_boxes, num_classes, t_ref * 1000, t_np * 1000, t_ref / t_np, t_tv * 1000,
+                t_soft * 1000, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--num-boxes', default=[100, 500, 1000, 2000, 5000], type=int, nargs='+',
+                        help='number of boxes to test')
+    parser.add_argument('--num-classes', default=[1, 20, 80], type=int, nargs='+',
+                        help='number of classes to test')
+    parser.add_argument('--iou-thresh', default=0.5, type=float, help='nms iou threshold')
+    parser.add_argument('--num-threads', default=1, type=int, help='number of cpu threads used by pytorch')
+    parser.add_argument('--repeats', default=10, type=int, help='number of timed runs per case')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
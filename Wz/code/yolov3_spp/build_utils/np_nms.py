@@ -0,0 +1,202 @@
+"""
+只依赖numpy的nms实现，用于不安装pytorch的onnxruntime部署(load_onnx_test.py)
+所有函数返回的索引都是np.int64，并且按分数从大到小排序
+"""
+import numpy as np
+
+
+def box_area(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def box_iou(boxes1: np.ndarray, boxes2: np.ndarray, area1=None, area2=None) -> np.ndarray:
+    """
+    计算两组boxes两两之间的iou
+    :param boxes1: [N, 4] (x1, y1, x2, y2)
+    :param boxes2: [M, 4] (x1, y1, x2, y2)
+    :param area1: boxes1的面积，已经计算过时可以传入避免重复计算
+    :param area2: boxes2的面积
+    :return: [N, M]
+    """
+    if area1 is None:
+        area1 = box_area(boxes1)
+    if area2 is None:
+        area2 = box_area(boxes2)
+
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])  # [N, M, 2]
+    rb = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])  # [N, M, 2]
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = area1[:, None] + area2[None, :] - inter
+    return inter / np.maximum(union, np.finfo(np.float32).eps)
+
+
+def _greedy_keep_in_block(suppress: np.ndarray, alive: np.ndarray) -> np.ndarray:
+    """
+    block内部的贪心nms
+    贪心nms的结果满足: 第j个box被保留 <=> 不存在被保留的i < j与它重叠
+    从全部保留开始迭代，第k次迭代后前k个box的结果一定正确，不再变化时即为贪心nms的结果
+    :param suppress: [B, B] 上三角矩阵, suppress[i, j]表示分数更高的第i个box会抑制第j个box
+    :param alive: [B] 没有被之前block中保留的box抑制的box
+    """
+    keep = alive
+    while True:
+        new_keep = alive & ~(suppress & keep[:, None]).any(axis=0)
+        if np.array_equal(new_keep, keep):
+            return keep
+        keep = new_keep
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float, block_size: int = 512) -> np.ndarray:
+    """
+    贪心nms，结果与torchvision.ops.nms相同(分数相同时按原始顺序)
+    将按分数排序后的boxes分成若干block依次处理，每个block只需计算:
+    1) 之前所有block中保留的box与当前block的iou
+    2) 当前block内部的iou
+    因此不需要反复拷贝数组，内存占用也只有O(block_size * N)
+    :param boxes: [N, 4] (x1, y1, x2, y2)
+    :param scores: [N]
+    :param iou_threshold: iou大于该值的box会被抑制
+    :param block_size: 每个block中box的数量
+    :return: 保留box的索引(np.int64)，按分数从大到小排序
+    """
+    if boxes.shape[0] == 0:
+        return np.empty((0,), dtype=np.int64)
+
+    order = np.argsort(-scores, kind="stable")
+    boxes = boxes[order]
+    areas = box_area(boxes)
+    num = boxes.shape[0]
+    keep = np.ones(num, dtype=bool)
+    for start in range(0, num, block_size):
+        end = min(start + block_size, num)
+        block, block_areas = boxes[start:end], areas[start:end]
+
+        alive = keep[start:end]
+        if start > 0:
+            prev = keep[:start]
+            if prev.any():
+                ious = box_iou(boxes[:start][prev], block, areas[:start][prev], block_areas)
+                alive = alive & ~(ious > iou_threshold).any(axis=0)
+
+        suppress = np.triu(box_iou(block, block, block_areas, block_areas) > iou_threshold, k=1)
+        keep[start:end] = _greedy_keep_in_block(suppress, alive)
+
+    return order[keep].astype(np.int64)
+
+
+def soft_nms(boxes: np.ndarray,
+             scores: np.ndarray,
+             iou_threshold: float = 0.3,
+             sigma: float = 0.5,
+             score_threshold: float = 0.001,
+             method: str = "gaussian"):
+    """
+    Soft-NMS，每次取出当前分数最高的box，根据iou衰减剩余box的分数
+    只在剩余的box上计算与被取出box的iou，不需要重建数组
+    :param boxes: [N, 4] (x1, y1, x2, y2)
+    :param scores: [N]
+    :param iou_threshold: linear方法中只衰减iou大于该值的box
+    :param sigma: gaussian方法的参数, weight = exp(-iou^2 / sigma)
+    :param score_threshold: 衰减后分数不大于该值的box会被移除
+    :param method: linear或者gaussian
+    :return: 保留box的索引(np.int64，按被取出的顺序)以及衰减后的分数
+    """
+    assert method in ["linear", "gaussian"]
+    num = boxes.shape[0]
+    if num == 0:
+        return np.empty((0,), dtype=np.int64), np.empty((0,), dtype=scores.dtype)
+
+    scores = scores.astype(np.float64)  # 拷贝一份，不修改输入
+    areas = box_area(boxes)
+    # 剩余box的索引，衰减后分数不大于score_threshold的box直接移除
+    remain = np.nonzero(scores > score_threshold)[0]
+
+    keep = []
+    keep_scores = []
+    while remain.size > 0:
+        max_pos = np.argmax(scores[remain])
+        best = remain[max_pos]
+        keep.append(best)
+        keep_scores.append(scores[best])
+        remain = np.delete(remain, max_pos)
+        if remain.size == 0:
+            break
+
+        ious = box_iou(boxes[best][None], boxes[remain], areas[best][None], areas[remain])[0]
+        if method == "linear":
+            weight = np.where(ious > iou_threshold, 1 - ious, 1.)
+        else:  # gaussian
+            weight = np.exp(-np.square(ious) / sigma)
+        scores[remain] *= weight
+        remain = remain[scores[remain] > score_threshold]
+
+    return np.array(keep, dtype=np.int64), np.array(keep_scores, dtype=np.float64)
+
+
+def _offset_boxes(boxes: np.ndarray, idxs: np.ndarray) -> np.ndarray:
+    # 为每个类别的boxes加上一个足够大的偏移量，使不同类别的boxes之间iou为0
+    if boxes.shape[0] == 0:
+        return boxes
+    max_coordinate = boxes.max()
+    offsets = idxs.astype(boxes.dtype) * (max_coordinate + 1)
+    return boxes + offsets[:, None]
+
+
+def batched_nms(boxes: np.ndarray, scores: np.ndarray, idxs: np.ndarray, iou_threshold: float,
+                block_size: int = 512) -> np.ndarray:
+    """
+    按类别进行贪心nms，不同类别的boxes之间不会相互抑制
+    :param boxes: [N, 4] (x1, y1, x2, y2)
+    :param scores: [N]
+    :param idxs: [N] 每个box的类别
+    :param iou_threshold: iou大于该值的box会被抑制
+    :param block_size: 见nms
+    :return: 保留box的索引(np.int64)，按分数从大到小排序
+    """
+    return nms(_offset_boxes(boxes, idxs), scores, iou_threshold, block_size)
+
+
+def batched_soft_nms(boxes: np.ndarray, scores: np.ndarray, idxs: np.ndarray,
+                     iou_threshold: float = 0.3,
+                     sigma: float = 0.5,
+                     score_threshold: float = 0.001,
+                     method: str = "gaussian"):
+    """
+    按类别进行Soft-NMS，不同类别之间iou为0，两种方法的weight都为1，即不会相互衰减
+    参数以及返回值见soft_nms
+    """
+    return soft_nms(_offset_boxes(boxes, idxs), scores, iou_threshold, sigma, score_threshold, method)
+
+
+def matrix_nms(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray,
+               kernel="gaussian", sigma=2.0, score_threshold=0.0):
+    """
+    Matrix NMS, 根据每个目标与所有更高分目标的iou一次计算出它的分数衰减系数，不同类别之间不衰减
+    :param boxes: [N, 4] (x1, y1, x2, y2)
+    :param scores: [N]
+    :param classes: 每个目标的类别
+    :param kernel: gaussian或者linear
+    :param sigma: gaussian kernel的参数
+    :param score_threshold: 衰减后分数低于该值的目标会被移除
+    :return: 保留目标的索引(np.int64，按衰减后的分数从大到小排序)以及衰减后的分数
+    """
+    assert kernel in ["gaussian", "linear"]
+    order = np.argsort(-scores, kind="stable")
+    boxes, scores, classes = boxes[order], scores[order], classes[order]
+
+    # iou[i, j]: 分数更高的第i个目标与第j个目标的iou(只计算同类别)
+    # compensate_iou[i]: 第i个目标与所有更高分目标的最大iou
+    iou = box_iou(boxes, boxes)
+    iou = np.triu(iou * (classes[:, np.newaxis] == classes[np.newaxis]), k=1)
+    compensate_iou = iou.max(axis=0)[:, np.newaxis]
+
+    if kernel == "gaussian":
+        decay = np.exp(-sigma * (np.square(iou) - np.square(compensate_iou)))
+    else:  # linear
+        decay = (1 - iou) / np.maximum(1 - compensate_iou, 1e-6)
+    scores = scores * decay.min(axis=0)
+
+    keep = np.nonzero(scores >= score_threshold)[0]
+    keep = keep[np.argsort(-scores[keep], kind="stable")]
+    return order[keep].astype(np.int64), scores[keep]
@@ -0,0 +1,112 @@
+"""
+高分辨率图像的分块(tile)推理
+将图像切分成相互重叠的tile，以batch为单位送入网络，预测结果映射回原图后通过按类别的nms合并
+"""
+import math
+
+import numpy as np
+import torch
+import torchvision
+
+from build_utils import img_utils, utils
+
+
+def get_tile_starts(length: int, tile_size: int, overlap: int):
+    """
+    计算一个方向上每个tile的起始坐标
+    tile均匀分布，第一个和最后一个tile分别与图像两侧对齐，相邻tile至少重叠overlap个像素
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    num_tiles = int(math.ceil((length - tile_size) / stride)) + 1
+    return [int(round(i * (length - tile_size) / (num_tiles - 1))) for i in range(num_tiles)]
+
+
+def get_tiles(height: int, width: int, tile_size, overlap: float):
+    """
+    :param height: 图像的高
+    :param width: 图像的宽
+    :param tile_size: tile的(高, 宽)
+    :param overlap: 相邻tile重叠部分占tile边长的比例
+    :return: 每个tile在原图中的位置(x1, y1, x2, y2)
+    """
+    tile_h, tile_w = tile_size
+    ys = get_tile_starts(height, tile_h, int(tile_h * overlap))
+    xs = get_tile_starts(width, tile_w, int(tile_w * overlap))
+    return [(x, y, min(x + tile_w, width), min(y + tile_h, height)) for y in ys for x in xs]
+
+
+def _predict(model, imgs, img_size, device, conf_thres, iou_thres):
+    """
+    对一组BGR图像(tile)进行letterbox后打包成一个batch预测
+    :return: 每张图像的预测结果[num_obj, 6] (x1, y1, x2, y2, conf, cls)，坐标对应输入的图像
+    """
+    letterboxed = [img_utils.letterbox(img, new_shape=img_size, auto=False, color=(0, 0, 0)) for img in imgs]
+    # BGR to RGB, to batch x 3 x img_size x img_size
+    batch = np.stack([img[:, :, ::-1].transpose(2, 0, 1) for img, _, _ in letterboxed], axis=0)
+    batch = torch.from_numpy(np.ascontiguousarray(batch)).to(device).float() / 255.0
+
+    pred = model(batch)[0]  # only get inference result
+    pred = utils.non_max_suppression(pred, conf_thres=conf_thres, iou_thres=iou_thres, multi_label=False)
+
+    outputs = []
+    for img, (_, ratio, pad), p in zip(imgs, letterboxed, pred):
+        if p is None:
+            p = torch.zeros((0, 6), device=device)
+        p[:, :4] = utils.scale_coords(batch.shape[2:], p[:, :4], img.shape, ratio_pad=(ratio, pad))
+        outputs.append(p)
+    return outputs
+
+
+@torch.no_grad()
+def tiled_inference(model,
+                    img_o: np.ndarray,
+                    img_size: int = 512,
+                    tile_size=(512, 512),
+                    overlap: float = 0.2,
+                    batch_size: int = 8,
+                    conf_thres: float = 0.1,
+                    iou_thres: float = 0.6,
+                    merge_iou_thres: float = 0.5,
+                    full_image: bool = True,
+                    max_num: int = -1):
+    """
+    同一时刻只有batch_size个tile在device上，显存占用与原图大小无关
+    :param model: eval模式下的Darknet
+    :param img_o: 通过opencv读入的BGR图像
+    :param img_size: 网络输入尺寸
+    :param tile_size: tile的(高, 宽)，建议与img_size相同，这样tile不会被缩放
+    :param overlap: 相邻tile重叠部分占tile边长的比例，应大于需要检测的目标的尺寸
+    :param batch_size: 每次送入网络的tile数量
+    :param conf_thres: 每个tile预测时的分数阈值
+    :param iou_thres: 每个tile内nms的iou阈值
+    :param merge_iou_thres: 合并所有tile的预测结果时nms使用的iou阈值
+    :param full_image: 是否额外对缩小后的整张图像预测一次，用于检测跨越多个tile的大目标
+    :param max_num: 合并后最多保留的目标个数，小于0表示不限制
+    :return: [num_obj, 6] (x1, y1, x2, y2, conf, cls)，坐标对应原图
+    """
+    device = next(model.parameters()).device
+    height, width = img_o.shape[:2]
+    tiles = get_tiles(height, width, tile_size, overlap)
+
+    outputs = []
+    for i in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[i:i + batch_size]
+        crops = [img_o[y1:y2, x1:x2] for x1, y1, x2, y2 in batch_tiles]
+        for (x1, y1, _, _), p in zip(batch_tiles, _predict(model, crops, img_size, device, conf_thres, iou_thres)):
+            # tile中的坐标加上tile左上角的坐标，映射回原图
+            p[:, [0, 2]] += x1
+            p[:, [1, 3]] += y1
+            outputs.append(p)
+
+    if full_image and len(tiles) > 1:
+        # letterbox会将整张图像缩小到img_size
+        outputs.extend(_predict(model, [img_o], img_size, device, conf_thres, iou_thres))
+
+    pred = torch.cat(outputs, dim=0)
+    # 同一个目标可能在多个tile中被检测到，按类别执行nms合并
+    keep = torchvision.ops.batched_nms(pred[:, :4], pred[:, 4], pred[:, 5].long(), merge_iou_thres)
+    if max_num >= 0:
+        keep = keep[:max_num]
+    return pred[keep]
@@ -407,12 +407,61 @@ def build_targets(p, targets, model):
     return tcls, tbox, indices, anch
 
 
+def matrix_nms(boxes, scores, idxs, kernel="gaussian", sigma=2.0, score_threshold=0.0, max_candidates=-1):
+    """
+    Matrix NMS(SOLOv2): 不再逐个删除与高分box重叠的boxes, 而是根据每个box与所有更高分box的iou
+    一次矩阵运算得到它的分数衰减系数, 只在相同类别(idxs相同)的boxes之间衰减
+
+    Arguments:
+        boxes (Tensor[N, 4]): boxes in (x1, y1, x2, y2) format
+        scores (Tensor[N]): scores for each one of the boxes
+        idxs (Tensor[N]): indices of the categories for each one of the boxes
+        kernel (str): "gaussian" or "linear"
+        sigma (float): gaussian kernel的参数
+        score_threshold (float): 衰减后分数低于该值的boxes会被移除
+        max_candidates (int): 只对分数最高的max_candidates个boxes计算(iou矩阵为N x N), <= 0表示全部
+
+    Returns:
+        keep (Tensor): int64 tensor with the indices of the elements that have been kept,
+            sorted in decreasing order of decayed scores
+        scores (Tensor): decayed scores of the kept elements
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device), scores.new_empty((0,))
+
+    scores, order = scores.sort(descending=True)
+    if 0 < max_candidates < order.numel():
+        scores, order = scores[:max_candidates], order[:max_candidates]
+    boxes, idxs = boxes[order], idxs[order]
+
+    # iou[i, j]: 分数更高的第i个box与第j个box的iou, 不同类别之间为0
+    # compensate_iou[i]: 第i个box与所有更高分box的最大iou, 即它自己被抑制的程度
+    same_class = torch.eq(idxs[:, None], idxs[None, :])
+    iou = torch.triu(box_iou(boxes, boxes) * same_class, diagonal=1)
+    compensate_iou = iou.max(dim=0)[0][:, None]
+
+    # decay[j] = min_i f(iou[i, j]) / f(compensate_iou[i])
+    # 分数最高的box的compensate_iou为0, 所以decay <= 1
+    if kernel == "gaussian":
+        decay = torch.exp(-sigma * (iou ** 2 - compensate_iou ** 2))
+    elif kernel == "linear":
+        decay = (1 - iou) / (1 - compensate_iou).clamp(min=1e-6)
+    else:
+        raise ValueError("kernel should be 'gaussian' or 'linear', got {}".format(kernel))
+    scores = scores * decay.min(dim=0)[0]
+
+    keep = torch.where(torch.ge(scores, score_threshold))[0]
+    scores, sort_inds = scores[keep].sort(descending=True)
+    return order[keep[sort_inds]], scores
+
+
 def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6,
-                        multi_label=True, classes=None, agnostic=False, max_num=100):
+                        multi_label=True, classes=None, agnostic=False, max_num=100, nms_method="nms"):
     """
     Performs  Non-Maximum Suppression on inference results
 
     param: prediction[batch, num_anchors, (num_classes+1+4) x num_anchors]
+    param: nms_method: "nms"使用贪心nms, "matrix"使用Matrix NMS(衰减后的conf仍然用conf_thres过滤)
     Returns detections with shape:
         nx6 (x1, y1, x2, y2, conf, cls)
     """
@@ -468,7 +517,11 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6,
         # Batched NMS
         c = x[:, 5] * 0 if agnostic else x[:, 5]  # classes
         boxes, scores = x[:, :4].clone() + c.view(-1, 1) * max_wh, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)
+        if nms_method == "matrix":  # 不同类别之间不衰减, 直接使用原始boxes
+            i, decayed_scores = matrix_nms(x[:, :4], scores, c, score_threshold=conf_thres, max_candidates=1000)
+            x[i, 4] = decayed_scores
+        else:
+            i = torchvision.ops.nms(boxes, scores, iou_thres)
         i = i[:max_num]  # 最多只保留前max_num个目标信息
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
             try:  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
@@ -10,6 +10,8 @@ from build_utils import img_utils
 
 device = torch.device("cpu")
 models.ONNX_EXPORT = True
+# 导出支持batch推理的模型(输出[batch_size, num_anchors, 85])，供onnx_detector.py使用
+models.ONNX_EXPORT_BATCH = True
 
 
 def to_numpy(tensor):
@@ -1,10 +1,8 @@
 import time
 import cv2
-import onnx
 import onnxruntime
 import numpy as np
-from matplotlib import pyplot as plt
-from draw_box_utils import draw_box
+from build_utils import np_nms
 
 
 def to_numpy(tensor):
@@ -64,10 +62,11 @@ def scale_img(img: np.ndarray,
 
 def clip_coords(boxes: np.ndarray, img_shape: tuple):
     # Clip bounding xyxy bounding boxes to image shape (height, width)
-    boxes[:, 0].clip(0, img_shape[1])  # x1
-    boxes[:, 1].clip(0, img_shape[0])  # y1
-    boxes[:, 2].clip(0, img_shape[1])  # x2
-    boxes[:, 3].clip(0, img_shape[0])  # y2
+    # 使用out参数原地修改, 直接调用clip会返回新的数组而不会修改boxes
+    np.clip(boxes[:, 0], 0, img_shape[1], out=boxes[:, 0])  # x1
+    np.clip(boxes[:, 1], 0, img_shape[0], out=boxes[:, 1])  # y1
+    np.clip(boxes[:, 2], 0, img_shape[1], out=boxes[:, 2])  # x2
+    np.clip(boxes[:, 3], 0, img_shape[0], out=boxes[:, 3])  # y2
 
 
 def turn_back_coords(img1_shape, coords, img0_shape, ratio_pad=None):
@@ -104,21 +103,6 @@ def xywh2xyxy(x: np.ndarray):
     return y
 
 
-def bboxes_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
-    boxes1_area = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
-    boxes2_area = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
-
-    left_up = np.maximum(boxes1[..., :2], boxes2[..., :2])
-    right_down = np.minimum(boxes1[..., 2:], boxes2[..., 2:])
-
-    inter_section = np.maximum(right_down - left_up, 0.0)
-    inter_area = inter_section[..., 0] * inter_section[..., 1]
-    union_area = boxes1_area + boxes2_area - inter_area
-    ious = np.maximum(1.0 * inter_area / union_area, np.finfo(np.float32).eps)
-
-    return ious
-
-
 def nms(bboxes: np.ndarray, iou_threshold=0.5, soft_threshold=0.3, sigma=0.5, method="nms", ) -> np.ndarray:
     """
     单独对一个类别进行NMS处理
@@ -127,39 +111,26 @@ def nms(bboxes: np.ndarray, iou_threshold=0.5, soft_threshold=0.3, sigma=0.5, me
     :param soft_threshold: soft-nms算法中使用到的阈值
     :param sigma: soft-nms gaussian sigma
     :param method: nms或者soft-nms
-    :return: 返回保留目标的索引
+    :return: 返回保留目标的索引(np.int64)
     """
     assert method in ["nms", "soft-nms"]
-    # [x1, y1, x2, y2, score] -> [x1, y1, x2, y2, score, index]
-    bboxes = np.concatenate([bboxes, np.arange(bboxes.shape[0]).reshape(-1, 1)], axis=1)
-
-    best_bboxes_index = []
-    while len(bboxes) > 0:
-        max_ind = np.argmax(bboxes[:, 4])  # 寻找概率最大目标索引
-        best_bbox = bboxes[max_ind]
-        best_bboxes_index.append(best_bbox[5])
-        bboxes = np.concatenate([bboxes[:max_ind], bboxes[max_ind + 1:]])  # 将最大概率目标去除
-        ious = bboxes_iou(best_bbox[np.newaxis, :4], bboxes[:, :4])
-
-        if method == "nms":
-            iou_mask = np.less(ious, iou_threshold)  # <
-        else:  # soft-nms
-            weight = np.exp(-(np.square(ious) / sigma))
-            bboxes[:, 4] = bboxes[:, 4] * weight
-            iou_mask = np.greater(bboxes[:, 4], soft_threshold)  # >
-
-        bboxes = bboxes[iou_mask]
+    if method == "nms":
+        return np_nms.nms(bboxes[:, :4], bboxes[:, 4], iou_threshold)
+    else:  # soft-nms
+        keep, _ = np_nms.soft_nms(bboxes[:, :4], bboxes[:, 4], sigma=sigma,
+                                  score_threshold=soft_threshold, method="gaussian")
+        return keep
 
-    return np.array(best_bboxes_index, dtype=np.int8)
 
-
-def post_process(pred: np.ndarray, multi_label=False, conf_thres=0.3):
+def post_process(pred: np.ndarray, multi_label=False, conf_thres=0.3, nms_method="nms", iou_thres=0.5):
     """
     输入的xywh都是归一化后的值
     :param pred: [num_obj, [x1, y1, x2, y2, objectness, cls1, cls1...]]
     :param img_size:
     :param multi_label:
     :param conf_thres:
+    :param nms_method: nms或者matrix(Matrix NMS, 衰减后的分数仍然用conf_thres过滤)
+    :param iou_thres: nms算法中使用到的阈值
     :return:
     """
     min_wh, max_wh = 2, 4096
@@ -190,15 +161,23 @@ def post_process(pred: np.ndarray, multi_label=False, conf_thres=0.3):
 
     cls = pred[:, 5]  # classes
     boxes, scores = pred[:, :4] + cls.reshape(-1, 1) * max_wh, pred[:, 4:5]
-    t1 = time.time()
-    indexes = nms(np.concatenate([boxes, scores], axis=1))
-    print("NMS time is {}".format(time.time() - t1))
-    pred = pred[indexes]
+    if nms_method == "matrix":
+        # 不同类别之间不衰减, 直接使用原始boxes
+        indexes, decayed_scores = np_nms.matrix_nms(pred[:, :4], pred[:, 4], cls, score_threshold=conf_thres)
+        pred = pred[indexes]
+        pred[:, 4] = decayed_scores
+    else:
+        indexes = nms(np.concatenate([boxes, scores], axis=1), iou_threshold=iou_thres)
+        pred = pred[indexes]
 
     return pred
 
 
 def main():
+    import onnx
+    from matplotlib import pyplot as plt
+    from draw_box_utils import draw_box
+
     img_size = 512
     save_path = "yolov3spp.onnx"
     img_path = "test.jpg"
@@ -230,12 +209,16 @@ def main():
     pred = ort_session.run(None, ort_inputs)[0]
     t2 = time.time()
     print(t2 - t1)
+    if pred.ndim == 3:  # 使用ONNX_EXPORT_BATCH导出的模型: [batch_size, num_obj, 85]
+        pred = pred[0]
     # print(predictions.shape[0])
     # process detections
     # 这里预测的数值是相对坐标(0-1之间)，乘上图像尺寸转回绝对坐标
     pred[:, [0, 2]] *= input_size[1]
     pred[:, [1, 3]] *= input_size[0]
+    t1 = time.time()
     pred = post_process(pred)
+    print("NMS time is {}".format(time.time() - t1))
 
     # 将预测的bbox缩放回原图像尺度
     p_boxes = turn_back_coords(img1_shape=img.shape[2:],
@@ -2,6 +2,8 @@ from build_utils.layers import *
 from build_utils.parse_config import *
 
 ONNX_EXPORT = False
+# 导出onnx时保留batch维度, 输出[batch_size, num_anchors, 85], 否则只支持batch_size=1, 输出[num_anchors, 85]
+ONNX_EXPORT_BATCH = False
 
 
 def create_modules(modules_defs: list, img_size):
@@ -249,7 +251,7 @@ class YOLOLayer(nn.Module):
         p: 预测参数   [b, _, h, w]
         """
         if ONNX_EXPORT:
-            bs = 1  # batch size
+            bs = -1 if ONNX_EXPORT_BATCH else 1  # batch size
         else:
             #-------------------------------------------------#
             #   batch_size, predict_param(255), grid(13), grid(13)
@@ -278,6 +280,16 @@ class YOLOLayer(nn.Module):
             grid = self.grid.repeat(1, self.na, 1, 1, 1).view(m, 2)
             anchor_wh = self.anchor_wh.repeat(1, 1, self.nx, self.ny, 1).view(m, 2) * ng
 
+            if ONNX_EXPORT_BATCH:
+                #-------------------------------------------------#
+                #   [bs, m, 85], 不使用inplace赋值, batch维度可以是动态的
+                #-------------------------------------------------#
+                p = p.view(bs, m, self.no)
+                xy = (torch.sigmoid(p[..., 0:2]) + grid) * ng
+                wh = torch.exp(p[..., 2:4]) * anchor_wh
+                conf = torch.sigmoid(p[..., 4:])
+                return torch.cat([xy, wh, conf[..., :1], conf[..., 1:] * conf[..., :1]], dim=-1)
+
             p = p.view(m, self.no)
             # xy = torch.sigmoid(p[:, 0:2]) + grid  # x, y
             # wh = torch.exp(p[:, 2:4]) * anchor_wh  # width, height
@@ -393,7 +405,7 @@ class Darknet(nn.Module):
         elif ONNX_EXPORT:  # export
             # x = [torch.cat(x, 0) for x in zip(*yolo_out)]
             # return x[0], torch.cat(x[1:3], 1)  # scores, boxes: 3780x80, 3780x4
-            p = torch.cat(yolo_out, dim=0)
+            p = torch.cat(yolo_out, dim=1 if ONNX_EXPORT_BATCH else 0)
 
             # # 根据objectness虑除低概率目标
             # mask = torch.nonzero(torch.gt(p[:, 4], 0.1), as_tuple=False).squeeze(1)
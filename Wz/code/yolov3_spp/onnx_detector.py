@@ -0,0 +1,203 @@
+"""
+使用onnxruntime进行YOLOv3-SPP推理，不依赖pytorch，可以直接部署在只有CPU的机器上
+模型需要通过export_onnx.py导出(建议设置models.ONNX_EXPORT_BATCH = True以支持batch推理)
+python onnx_detector.py --weights yolov3spp.onnx --images test.jpg street.jpg --batch-size 2
+"""
+import time
+import argparse
+
+import cv2
+import numpy as np
+import onnxruntime
+
+from load_onnx_test import turn_back_coords, post_process
+
+
+class OnnxYoloDetector(object):
+    """
+    整个生命周期只创建一个InferenceSession，输入输出都使用预先分配好的内存:
+    1) 一个batch的图像先letterbox到uint8的缓存中，再一次性完成BGR->RGB, HWC->CHW以及归一化，写入float32输入缓存
+    2) 通过io binding将输入输出直接绑定到缓存上，避免onnxruntime额外的拷贝
+    3) 后处理得到的boxes通过turn_back_coords映射回原图尺度
+    """
+    def __init__(self,
+                 model_path: str,
+                 batch_size: int = 8,
+                 conf_thres: float = 0.3,
+                 iou_thres: float = 0.5,
+                 nms_method: str = "nms",
+                 intra_op_num_threads: int = 0,
+                 inter_op_num_threads: int = 1,
+                 pad_color=(0, 0, 0)):
+        """
+        :param model_path: onnx模型路径
+        :param batch_size: 每次送入网络的最大图像数量(导出时没有保留batch维度的模型每次只处理一张图像)
+        :param conf_thres: 后处理中的分数阈值
+        :param iou_thres: nms算法中使用到的阈值
+        :param nms_method: nms或者matrix, 见load_onnx_test.post_process
+        :param intra_op_num_threads: 单个算子使用的线程数，0表示由onnxruntime根据CPU核数决定
+        :param inter_op_num_threads: 并行执行不同算子的线程数(只在ORT_PARALLEL模式下生效)
+        :param pad_color: letterbox填充的颜色(BGR)
+        """
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                                    providers=["CPUExecutionProvider"])
+
+        model_input = self.session.get_inputs()[0]
+        model_output = self.session.get_outputs()[0]
+        self.input_name = model_input.name
+        self.output_name = model_output.name
+        # 导出时模型的grid尺寸已经固定，输入尺寸必须与导出时相同
+        self.input_size = tuple(model_input.shape[2:])  # [h, w]
+        assert all(isinstance(s, int) for s in self.input_size), "input height and width must be static."
+        # 输出为[batch_size, num_anchors, 85]时支持batch推理，[num_anchors, 85]时只支持batch_size=1
+        self.batched = len(model_output.shape) == 3
+        self.batch_size = batch_size if self.batched else 1
+
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.nms_method = nms_method
+        self.pad_color = np.array(pad_color, dtype=np.uint8)
+
+        h, w = self.input_size
+        self.letterbox_buffer = np.empty((self.batch_size, h, w, 3), dtype=np.uint8)
+        self.input_buffer = np.empty((self.batch_size, 3, h, w), dtype=np.float32)
+        # 网络预测的xywh是相对坐标(0-1之间)，乘上输入尺寸转回绝对坐标
+        self.coords_scale = np.array([w, h, w, h], dtype=np.float32)
+
+        # 先用全0输入推理一次，得到输出的尺寸并分配输出缓存(同时起到warm up的作用)
+        self.input_buffer.fill(0)
+        output = self.session.run(None, {self.input_name: self.input_buffer})[0]
+        self.output_buffer = np.empty((self.batch_size,) + output.shape[-2:], dtype=np.float32)
+        self.io_binding = self.session.io_binding()
+
+    def letterbox(self, images):
+        """
+        将一个batch的图像等比例缩放并居中填充到输入尺寸，写入letterbox_buffer
+        与load_onnx_test.scale_img(auto=False)的结果相同
+        :param images: BGR格式的图像列表
+        :return: 每张图像的(ratio, pad)，用于turn_back_coords
+        """
+        h, w = self.input_size
+        shapes = np.array([img.shape[:2] for img in images], dtype=np.float64)  # [n, 2] (h, w)
+        ratios = np.minimum(h / shapes[:, 0], w / shapes[:, 1])
+        new_unpad = np.round(shapes * ratios[:, None]).astype(np.int64)  # [n, 2] (h, w)
+        pads = (np.array([h, w]) - new_unpad) / 2  # [n, 2] (dh, dw)
+        tops = np.round(pads[:, 0] - 0.1).astype(np.int64)
+        lefts = np.round(pads[:, 1] - 0.1).astype(np.int64)
+
+        self.letterbox_buffer[:len(images)] = self.pad_color
+        for i, img in enumerate(images):
+            nh, nw = new_unpad[i]
+            if img.shape[0] != nh or img.shape[1] != nw:
+                img = cv2.resize(img, (int(nw), int(nh)), interpolation=cv2.INTER_LINEAR)
+            self.letterbox_buffer[i, tops[i]:tops[i] + nh, lefts[i]:lefts[i] + nw] = img
+
+        return [((r, r), (dw, dh)) for r, (dh, dw) in zip(ratios.tolist(), pads.tolist())]
+
+    def preprocess(self, images):
+        """
+        letterbox后一次性完成BGR->RGB, HWC->CHW, uint8->float32以及归一化
+        :return: 输入缓存中有效的部分，每张图像的(ratio, pad)
+        """
+        n = len(images)
+        ratio_pads = self.letterbox(images)
+        inputs = self.input_buffer[:n]
+        np.multiply(self.letterbox_buffer[:n, :, :, ::-1].transpose(0, 3, 1, 2), 1 / 255.,
+                    out=inputs, casting="unsafe")
+        return inputs, ratio_pads
+
+    def infer(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        通过io binding直接使用输入输出缓存进行推理
+        :param inputs: [n, 3, h, w], 输入缓存的前n个
+        :return: [n, num_anchors, 85], 输出缓存的前n个(下次推理时会被覆盖)
+        """
+        n = inputs.shape[0]
+        outputs = self.output_buffer[:n]
+        output_shape = outputs.shape if self.batched else outputs.shape[1:]
+
+        self.io_binding.bind_input(name=self.input_name, device_type="cpu", device_id=0,
+                                   element_type=np.float32, shape=inputs.shape,
+                                   buffer_ptr=inputs.ctypes.data)
+        self.io_binding.bind_output(name=self.output_name, device_type="cpu", device_id=0,
+                                    element_type=np.float32, shape=output_shape,
+                                    buffer_ptr=outputs.ctypes.data)
+        self.session.run_with_iobinding(self.io_binding)
+        return outputs
+
+    def detect_batch(self, images):
+        """
+        :param images: BGR格式的图像列表，数量不超过batch_size
+        :return: 每张图像的检测结果[num_obj, 6] (x1, y1, x2, y2, score, class)，坐标对应原图尺度
+        """
+        assert len(images) <= self.batch_size
+        inputs, ratio_pads = self.preprocess(images)
+        outputs = self.infer(inputs)
+        outputs[..., :4] *= self.coords_scale
+
+        results = []
+        for pred, img, ratio_pad in zip(outputs, images, ratio_pads):
+            pred = post_process(pred, conf_thres=self.conf_thres, nms_method=self.nms_method,
+                                iou_thres=self.iou_thres)
+            turn_back_coords(img1_shape=self.input_size, coords=pred[:, :4],
+                             img0_shape=img.shape, ratio_pad=ratio_pad)
+            results.append(pred)
+        return results
+
+    def __call__(self, images):
+        """
+        :param images: 单张BGR图像或者BGR图像列表，数量可以超过batch_size
+        :return: 单张图像时返回[num_obj, 6]，否则返回每张图像结果的列表
+        """
+        if isinstance(images, np.ndarray):
+            return self.detect_batch([images])[0]
+
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            results.extend(self.detect_batch(images[i:i + self.batch_size]))
+        return results
+
+
+def main(args):
+    detector = OnnxYoloDetector(args.weights,
+                                batch_size=args.batch_size,
+                                conf_thres=args.conf_thres,
+                                iou_thres=args.iou_thres,
+                                nms_method=args.nms_method,
+                                intra_op_num_threads=args.num_threads)
+    print("input size: {}, batched model: {}".format(detector.input_size, detector.batched))
+
+    images = []
+    for img_path in args.images:
+        img = cv2.imread(img_path)  # BGR
+        assert img is not None, "Image Not Found " + img_path
+        images.append(img)
+
+    t1 = time.time()
+    results = detector(images)
+    t2 = time.time()
+    print("{} images, {:.1f}ms/image".format(len(images), (t2 - t1) / len(images) * 1000))
+    for img_path, pred in zip(args.images, results):
+        print("{}: {} objects".format(img_path, pred.shape[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--weights', default='yolov3spp.onnx', help='onnx model path')
+    parser.add_argument('--images', default=['test.jpg'], nargs='+', help='images to detect')
+    parser.add_argument('--batch-size', default=8, type=int, help='max number of images per inference')
+    parser.add_argument('--conf-thres', default=0.3, type=float, help='score threshold')
+    parser.add_argument('--iou-thres', default=0.5, type=float, help='nms iou threshold')
+    parser.add_argument('--nms-method', default='nms', choices=['nms', 'matrix'], help='nms method')
+    parser.add_argument('--num-threads', default=0, type=int, help='onnxruntime intra op threads, 0 for auto')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -0,0 +1,214 @@
+"""
+该脚本用于对大量图像进行离线批量预测，结果以json lines格式保存(每行对应一张图像)
+图像的读取解码在后台线程池中进行(预取的数量有上限)，模型推理与结果写入相互重叠
+结束后打印images/s以及解码、推理、后处理、写入各部分的耗时
+python predict_batch.py --cfg cfg/my_yolov3.cfg --weights weights/yolov3spp-voc-512.pt --inputs ./test_images --output results.jsonl
+--inputs可以是图像目录、glob表达式(需要加引号)或者每行一个图像路径的.txt文件，可以同时指定多个
+高分辨率图像可以通过--tile-size启用分块推理(每张图像的tile按--batch-size组成batch)
+"""
+import os
+import glob
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+from build_utils import img_utils, utils
+from build_utils.tiled_inference import tiled_inference
+from models import Darknet
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def time_synchronized():
+    torch.cuda.synchronize() if torch.cuda.is_available() else None
+    return time.time()
+
+
+def collect_images(inputs):
+    """
+    将输入的目录、glob表达式、.txt文件列表展开成图像路径列表
+    """
+    img_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            img_paths.extend(sorted(os.path.join(item, name) for name in os.listdir(item)
+                                    if name.lower().endswith(IMG_EXTENSIONS)))
+        elif item.endswith(".txt"):
+            with open(item) as f:
+                img_paths.extend(line.strip() for line in f if line.strip())
+        else:
+            img_paths.extend(sorted(glob.glob(item)))
+    return img_paths
+
+
+def load_image(img_path, img_size, tiled=False):
+    """
+    分块推理时直接返回原图, 由tiled_inference切分和缩放
+    在后台线程中执行: 通过opencv读入图片(BGR格式), 等比例缩放并填充到img_size x img_size(保证一个batch的尺寸相同)
+    返回uint8的图像, 原图尺寸, 缩放比例以及pad, 解码耗时
+    """
+    t_start = time.time()
+    img_o = cv2.imread(img_path)
+    assert img_o is not None, "Image Not Found " + img_path
+    if tiled:
+        return img_path, (img_o, img_o.shape, None), time.time() - t_start
+    img, ratio, pad = img_utils.letterbox(img_o, new_shape=img_size, auto=False, color=(0, 0, 0))
+    # BGR to RGB, to 3 x img_size x img_size
+    img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))
+    return img_path, (img, img_o.shape, (ratio, pad)), time.time() - t_start
+
+
+def load_batches(img_paths, img_size, tiled, batch_size, num_workers, prefetch_batches, timer):
+    """
+    使用线程池预取图像并组成batch
+    同时处于读取中或已读取但还没被使用的图像最多为batch_size * prefetch_batches张，避免占用过多内存
+    读取失败的图像会被跳过
+    """
+    max_pending = batch_size * prefetch_batches
+    paths = iter(img_paths)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque(pool.submit(load_image, p, img_size, tiled) for _, p in zip(range(max_pending), paths))
+        batch = []
+        while len(pending) > 0:
+            t_start = time.time()
+            future = pending.popleft()
+            try:
+                img_path, img, decode_time = future.result()
+                batch.append((img_path, img))
+                timer["decode"] += decode_time
+            except Exception as e:
+                print("skip image: {}".format(e))
+            timer["wait_data"] += time.time() - t_start
+
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(pool.submit(load_image, next_path, img_size, tiled))
+
+            if len(batch) == batch_size or (len(pending) == 0 and len(batch) > 0):
+                yield batch
+                batch = []
+
+
+def write_results(f, records):
+    """在写入线程中执行"""
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print("using {} device.".format(device))
+
+    img_paths = collect_images(args.inputs)
+    assert len(img_paths) > 0, "no image found in {}".format(args.inputs)
+    print("{} images to predict.".format(len(img_paths)))
+
+    #-----------------------------------------------------------#
+    # create model
+    #-----------------------------------------------------------#
+    assert os.path.exists(args.cfg), "cfg file {} dose not exist.".format(args.cfg)
+    assert os.path.exists(args.weights), "weights file {} dose not exist.".format(args.weights)
+    model = Darknet(args.cfg, args.img_size)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu')["model"])
+    model.to(device)
+    model.eval()
+    # 输入尺寸固定为img_size x img_size
+    torch.backends.cudnn.benchmark = True
+
+    timer = {"decode": 0., "wait_data": 0., "model": 0., "postprocess": 0., "wait_write": 0.}
+    num_images = 0
+    #-----------------------------------------------------------#
+    # 结果写入在单独的线程中进行，只保留有限个还未完成的写入任务
+    #-----------------------------------------------------------#
+    writes = deque()
+    with open(args.output, "w") as f, ThreadPoolExecutor(max_workers=1) as writer, torch.inference_mode():
+        t_begin = time_synchronized()
+        tiled = args.tile_size > 0
+        for batch in load_batches(img_paths, args.img_size, tiled, args.batch_size, args.num_workers,
+                                  args.prefetch, timer):
+            if tiled:
+                # 分块推理: 每个tile的预测、nms以及合并都在tiled_inference中完成, 全部算作推理时间
+                t_start = time_synchronized()
+                outputs = [tiled_inference(model, img_o, img_size=args.img_size,
+                                           tile_size=(args.tile_size, args.tile_size), overlap=args.tile_overlap,
+                                           batch_size=args.batch_size, conf_thres=args.conf_thres,
+                                           iou_thres=args.iou_thres)
+                           for _, (img_o, _, _) in batch]
+                t_model = time_synchronized()
+            else:
+                images = torch.from_numpy(np.stack([img for _, (img, _, _) in batch], axis=0))
+                images = images.to(device, non_blocking=True).float() / 255.0  # scale (0, 255) to (0, 1)
+
+                t_start = time_synchronized()
+                pred = model(images)[0]  # only get inference result
+                t_model = time_synchronized()
+
+                # 非极大值抑制也算作后处理
+                outputs = utils.non_max_suppression(pred, conf_thres=args.conf_thres, iou_thres=args.iou_thres,
+                                                    multi_label=False)
+                for i, ((_, (_, img0_shape, ratio_pad)), output) in enumerate(zip(batch, outputs)):
+                    if output is None:
+                        output = torch.zeros((0, 6))
+                    # 将预测的bbox映射回原图像尺度
+                    output[:, :4] = utils.scale_coords(images.shape[2:], output[:, :4], img0_shape, ratio_pad)
+                    outputs[i] = output
+
+            records = []
+            for (img_path, _), output in zip(batch, outputs):
+                output = output.cpu()
+                records.append({"image": img_path,
+                                "boxes": output[:, :4].tolist(),
+                                "labels": (output[:, 5].long() + 1).tolist(),  # 类别索引从1开始, 与json标签文件对应
+                                "scores": output[:, 4].tolist()})
+            t_post = time.time()
+            timer["model"] += t_model - t_start
+            timer["postprocess"] += t_post - t_model
+
+            writes.append(writer.submit(write_results, f, records))
+            while len(writes) > args.prefetch:
+                writes.popleft().result()
+            timer["wait_write"] += time.time() - t_post
+            num_images += len(batch)
+
+        t_start = time.time()
+        for w in writes:
+            w.result()
+        timer["wait_write"] += time.time() - t_start
+        total_time = time_synchronized() - t_begin
+
+    print("{} images in {:.1f}s, {:.2f} images/s".format(num_images, total_time, num_images / total_time))
+    print("decode(sum of {} threads): {:.1f}s, wait for data: {:.1f}s, model: {:.1f}s, "
+          "postprocess: {:.1f}s, wait for write: {:.1f}s".format(
+           args.num_workers, timer["decode"], timer["wait_data"], timer["model"],
+           timer["postprocess"], timer["wait_write"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--device', default='cuda:0', help='device')
+    parser.add_argument('--cfg', default='cfg/my_yolov3.cfg', help='*.cfg path')
+    parser.add_argument('--weights', default='weights/yolov3spp-voc-512.pt', help='trained weights')
+    parser.add_argument('--img-size', default=512, type=int, help='input size, 必须是32的整数倍')
+    parser.add_argument('--inputs', nargs='+', required=True, help='image dirs, glob patterns or .txt image lists')
+    parser.add_argument('--output', default='predict_results.jsonl', help='json lines file to save results')
+    parser.add_argument('--batch-size', default=16, type=int, help='number of images per inference')
+    parser.add_argument('--num-workers', default=4, type=int, help='number of image decoding threads')
+    parser.add_argument('--prefetch', default=2, type=int, help='max number of batches being prefetched')
+    parser.add_argument('--conf-thres', default=0.1, type=float, help='min score of saved boxes')
+    parser.add_argument('--iou-thres', default=0.6, type=float, help='nms iou threshold')
+
+    parser.add_argument('--tile-size', default=0, type=int,
+                        help='tile size for sliced inference of high resolution images, 0 to disable')
+    parser.add_argument('--tile-overlap', default=0.2, type=float, help='overlap ratio between adjacent tiles')
+
+    args = parser.parse_args()
+    print(args)
+
+    main(args)
@@ -126,12 +126,20 @@ def main(parser_data):
     cpu_device = torch.device("cpu")
 
     model.eval()
+    infer_time, nms_time, num_images = 0., 0., 0
     with torch.inference_mode():
         for imgs, targets, paths, shapes, img_index in tqdm(val_dataset_loader, desc="validation..."):
             imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
+            t1 = torch_utils.time_synchronized()
             pred = model(imgs)[0]  # only get inference result
-            pred = non_max_suppression(pred, conf_thres=0.01, iou_thres=0.6, multi_label=False)
+            t2 = torch_utils.time_synchronized()
+            pred = non_max_suppression(pred, conf_thres=0.01, iou_thres=0.6, multi_label=False,
+                                       nms_method=parser_data.nms_method)
+            t3 = torch_utils.time_synchronized()
+            infer_time += t2 - t1
+            nms_time += t3 - t2
+            num_images += imgs.shape[0]
 
             outputs = []
             for index, p in enumerate(pred):
@@ -174,9 +182,15 @@ def main(parser_data):
     print_voc = "\n".join(voc_map_info_list)
     print(print_voc)
 
+    print_time = "nms method: {}, inference time: {:.1f}ms/image, nms time: {:.1f}ms/image".format(
+        parser_data.nms_method, infer_time / max(num_images, 1) * 1000, nms_time / max(num_images, 1) * 1000)
+    print(print_time)
+
     # 将验证结果保存至txt文件中
     with open("record_mAP.txt", "w") as f:
-        record_lines = ["COCO results:",
+        record_lines = [print_time,
+                        "",
+                        "COCO results:",
                         print_coco,
                         "",
                         "mAP(IoU=0.5) for each category:",
@@ -208,6 +222,9 @@ if __name__ == "__main__":
     parser.add_argument('--batch_size', default=1, type=int, metavar='N',
                         help='batch size when validation.')
 
+    # 后处理使用的nms方法: nms(贪心nms)或matrix(Matrix NMS), 分别验证后可以对比mAP和推理时间
+    parser.add_argument('--nms-method', default='nms', choices=['nms', 'matrix'], help='nms method')
+
     args = parser.parse_args()
 
     main(args)